@@ -0,0 +1,91 @@
+"""AgentCoreランタイムの代わりに応答するローカルのスタブHTTPサーバー
+
+AWSに接続せずに web_app.py の /api/analyze と /api/analyze/stream を試すためのもの。
+
+    python stub_runtime.py --port 8081 --delay 0.05
+    AGENTCORE_ENDPOINT_URL=http://127.0.0.1:8081 AWS_PROFILE_NAME= \
+        AWS_ACCESS_KEY_ID=stub AWS_SECRET_ACCESS_KEY=stub python web_app.py
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_ORDINANCE = """【条例名】
+子育て世帯の保育環境の充実に関する条例
+
+第一条（目的）
+この条例は、子育て世帯が安心して子どもを預けられる環境を整備することを目的とする。
+
+第二条（定義）
+この条例において、次の各号に掲げる用語の意義は、当該各号に定めるところによる。
+（一）保育施設 児童福祉法に規定する保育所及び小規模保育事業所をいう。
+（二）待機児童 保育施設への入所を申し込み、入所できない児童をいう。
+
+附則
+この条例は、公布の日から施行する。
+
+【提案理由書】
+待機児童の解消と保育の質の向上のため、本条例を提案する。
+
+【財政影響調書】
+初年度の所要額は約5億円を見込み、国庫補助金と一般財源で賄う。
+"""
+
+def make_handler(delay, chunk_size):
+    class StubRuntimeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if not self.path.startswith("/runtimes/") or "/invocations" not in self.path:
+                self.send_error(404)
+                return
+
+            length = int(self.headers.get("Content-Length", "0"))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            session_id = self.headers.get("X-Amzn-Bedrock-AgentCore-Runtime-Session-Id", "")
+            text = f"【市民の意見】{payload.get('prompt', '')}\n\n{SAMPLE_ORDINANCE}"
+
+            if payload.get("stream"):
+                # 実際のランタイムと同じく、チャンクごとに data: <JSON文字列> を送る
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("X-Amzn-Bedrock-AgentCore-Runtime-Session-Id", session_id)
+                self.end_headers()
+                for start in range(0, len(text), chunk_size):
+                    frame = f"data: {json.dumps(text[start:start + chunk_size], ensure_ascii=False)}\n\n".encode("utf-8")
+                    self.wfile.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(delay)
+                self.wfile.write(b"0\r\n\r\n")
+                return
+
+            time.sleep(delay * (len(text) // chunk_size + 1))
+            body = json.dumps({"result": {"role": "assistant", "content": [{"text": text}]}}, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Amzn-Bedrock-AgentCore-Runtime-Session-Id", session_id)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubRuntimeHandler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.05, help="チャンクごとの待ち時間（秒）")
+    parser.add_argument("--chunk-size", type=int, default=20, help="1チャンクあたりの文字数")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.delay, args.chunk_size))
+    print(f"スタブランタイム起動: http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 import boto3
+from botocore.config import Config
 import json
+import threading
 import uuid
 import os
 from datetime import datetime
@@ -8,8 +10,78 @@ from datetime import datetime
 app = Flask(__name__)
 
 # AWS設定
-AGENT_RUNTIME_ARN = 'arn:aws:bedrock-agentcore:us-west-2:047786098634:runtime/app-3oJHjL6TFx'
-REGION_NAME = 'us-west-2'
+AGENT_RUNTIME_ARN = os.environ.get('AGENT_RUNTIME_ARN', 'arn:aws:bedrock-agentcore:us-west-2:047786098634:runtime/app-3oJHjL6TFx')
+REGION_NAME = os.environ.get('AWS_REGION_NAME', 'us-west-2')
+# 空文字を指定した場合は既定の認証情報チェーン（環境変数・IAMロールなど）を使う
+AWS_PROFILE_NAME = os.environ.get('AWS_PROFILE_NAME', 'default')
+
+# AgentCoreクライアントの接続設定
+#   AGENTCORE_ENDPOINT_URL          接続先を差し替える（ローカルのスタブサーバーで試す場合など）
+#   AGENTCORE_MAX_POOL_CONNECTIONS  プロセス全体で保持するHTTP接続数（既定: 50）
+#   AGENTCORE_CONNECT_TIMEOUT       接続タイムアウト（秒、既定: 10）
+#   AGENTCORE_READ_TIMEOUT          応答の読み取りタイムアウト（秒、既定: 300）
+AGENTCORE_ENDPOINT_URL = os.environ.get('AGENTCORE_ENDPOINT_URL') or None
+AGENTCORE_MAX_POOL_CONNECTIONS = int(os.environ.get('AGENTCORE_MAX_POOL_CONNECTIONS', '50'))
+AGENTCORE_CONNECT_TIMEOUT = float(os.environ.get('AGENTCORE_CONNECT_TIMEOUT', '10'))
+AGENTCORE_READ_TIMEOUT = float(os.environ.get('AGENTCORE_READ_TIMEOUT', '300'))
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_agentcore_client():
+    """プロセス全体で共有するAgentCoreクライアント（初回呼び出し時に作成）
+
+    boto3のクライアントはスレッドセーフなので、リクエストごとにセッションを作らず接続プールを使い回す。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                session = boto3.Session(profile_name=AWS_PROFILE_NAME or None)
+                config = Config(
+                    max_pool_connections=AGENTCORE_MAX_POOL_CONNECTIONS,
+                    connect_timeout=AGENTCORE_CONNECT_TIMEOUT,
+                    read_timeout=AGENTCORE_READ_TIMEOUT,
+                    tcp_keepalive=True,
+                    retries={'max_attempts': 2, 'mode': 'standard'},
+                )
+                _client = session.client(
+                    'bedrock-agentcore',
+                    region_name=REGION_NAME,
+                    endpoint_url=AGENTCORE_ENDPOINT_URL,
+                    config=config,
+                )
+    return _client
+
+def new_session_id():
+    """セッションIDを生成（33文字以上必要）"""
+    return str(uuid.uuid4()).replace('-', '') + str(uuid.uuid4()).replace('-', '')[:5]
+
+def invoke_runtime(payload, session_id):
+    """エージェントランタイムを呼び出す"""
+    return get_agentcore_client().invoke_agent_runtime(
+        agentRuntimeArn=AGENT_RUNTIME_ARN,
+        runtimeSessionId=session_id,
+        payload=json.dumps(payload),
+        qualifier="DEFAULT"
+    )
+
+def extract_text(response_data):
+    """ランタイムの応答から条例内容のテキストを抽出"""
+    content = response_data.get('result', {}).get('content', [])
+    if content and len(content) > 0:
+        return content[0].get('text', '')
+    return None
+
+def build_structured_data(text_content, session_id):
+    """構造化されたデータを作成"""
+    return {
+        'ai_response': text_content,
+        'ai_engine': 'Bedrock AgentCore',
+        'timestamp': datetime.now().isoformat(),
+        'output_quality': '議会提出可能レベル',
+        'session_id': session_id
+    }
 
 @app.route('/')
 def index():
@@ -20,51 +92,26 @@ def analyze_policy():
     try:
         data = request.get_json()
         prompt = data.get('prompt', '')
-        
+
         if not prompt:
             return jsonify({'success': False, 'error': '入力が空です'})
-        
-        # boto3セッションとクライアントを作成
-        session = boto3.Session(profile_name='default')
-        client = session.client('bedrock-agentcore', region_name=REGION_NAME)
-        
-        # ペイロードを準備
-        payload = json.dumps({"prompt": prompt})
-        
-        # セッションIDを生成（33文字以上必要）
-        session_id = str(uuid.uuid4()).replace('-', '') + str(uuid.uuid4()).replace('-', '')[:5]
-        
+
+        session_id = new_session_id()
+
         # エージェントを呼び出し
-        response = client.invoke_agent_runtime(
-            agentRuntimeArn=AGENT_RUNTIME_ARN,
-            runtimeSessionId=session_id,
-            payload=payload,
-            qualifier="DEFAULT"
-        )
-        
+        response = invoke_runtime({"prompt": prompt}, session_id)
+
         # レスポンスを読み取り
         response_body = response['response'].read()
         response_data = json.loads(response_body)
-        
+
         # レスポンスから条例内容を抽出
-        result = response_data.get('result', {})
-        content = result.get('content', [])
-        
-        if content and len(content) > 0:
-            text_content = content[0].get('text', '')
-            
-            # 構造化されたデータを作成
-            structured_data = {
-                'ai_response': text_content,
-                'ai_engine': 'Bedrock AgentCore',
-                'timestamp': datetime.now().isoformat(),
-                'output_quality': '議会提出可能レベル',
-                'session_id': session_id
-            }
-            
+        text_content = extract_text(response_data)
+
+        if text_content is not None:
             return jsonify({
                 'success': True,
-                'data': structured_data
+                'data': build_structured_data(text_content, session_id)
             })
         else:
             return jsonify({
@@ -72,12 +119,85 @@ def analyze_policy():
                 'error': 'レスポンス内容が空です',
                 'raw_response': response_data
             })
-            
+
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'エラー: {str(e)}'
         })
 
+def sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def iter_received(body, chunk_size=4096):
+    """応答本文を受信できた分ずつ返す
+
+    StreamingBody.iter_chunks は chunk_size が埋まるまで待つため、下位のストリームの read1 を使う。
+    """
+    with body as raw:
+        read = getattr(raw, 'read1', None) or raw.read
+        while True:
+            piece = read(chunk_size)
+            if not piece:
+                break
+            yield piece
+
+def relay_runtime_stream(body):
+    """ランタイムのSSE応答（data: にテキストチャンクのJSON）からチャンクを順に取り出す"""
+    buffer = b''
+    for piece in iter_received(body):
+        buffer += piece
+        while b'\n\n' in buffer:
+            frame, buffer = buffer.split(b'\n\n', 1)
+            for line in frame.decode('utf-8').split('\n'):
+                if line.startswith('data: '):
+                    chunk = json.loads(line[6:])
+                    if isinstance(chunk, dict) and 'error' in chunk:
+                        raise RuntimeError(chunk.get('error'))
+                    if isinstance(chunk, dict) and 'metrics' in chunk:
+                        # ランタイムの計測値は条例案の本文に含めない
+                        continue
+                    yield chunk if isinstance(chunk, str) else json.dumps(chunk, ensure_ascii=False)
+
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_policy_stream():
+    """/api/analyze のストリーミング版: 生成途中の条例案を逐次SSEで中継する
+
+    イベント: {"type": "chunk", "data": テキスト} を繰り返し、最後に
+    {"type": "complete", "data": /api/analyze と同じ構造化データ} または {"type": "error", "data": メッセージ} を返す。
+    """
+    data = request.get_json()
+    prompt = data.get('prompt', '')
+
+    if not prompt:
+        return jsonify({'success': False, 'error': '入力が空です'})
+
+    def generate():
+        session_id = new_session_id()
+        try:
+            response = invoke_runtime({"prompt": prompt, "stream": True}, session_id)
+            body = response['response']
+            try:
+                if 'text/event-stream' in response.get('contentType', ''):
+                    parts = []
+                    for chunk in relay_runtime_stream(body):
+                        parts.append(chunk)
+                        yield sse({"type": "chunk", "data": chunk})
+                    text_content = ''.join(parts)
+                else:
+                    # ストリーミングに対応していないランタイムの場合は一括の応答をそのまま返す
+                    text_content = extract_text(json.loads(body.read()))
+            finally:
+                body.close()
+
+            if text_content:
+                yield sse({"type": "complete", "data": build_structured_data(text_content, session_id)})
+            else:
+                yield sse({"type": "error", "data": 'レスポンス内容が空です'})
+        except Exception as e:
+            yield sse({"type": "error", "data": f'エラー: {str(e)}'})
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
@@ -1,11 +1,10 @@
 from bedrock_agentcore import BedrockAgentCoreApp
 from strands import Agent
+from llm_cache import cached_call, cached_stream_async
+from model_registry import model_for
+from telemetry import CallTimer, measure
 
 app = BedrockAgentCoreApp()
-agent = Agent(
-    model="us.anthropic.claude-sonnet-4-20250514-v1:0",
-    name="PolicyAnalysisAgent"
-)
 
 @app.entrypoint
 def invoke(payload):
@@ -50,8 +49,38 @@ def invoke(payload):
 実際の政策文書として使用できるレベルで作成し、法的根拠や他法令との整合性も考慮してください。
 """
     
-    result = agent(prompt)
-    return {"result": result.message}
+    # リクエストごとにエージェントを作成し、他のリクエストの会話履歴がキャッシュキーやプロンプトに混ざらないようにする
+    # モデルは割り当て表の ordinance（リクエストの models で上書き可、例: {"ordinance": "fast"}）
+    try:
+        model = model_for("ordinance", payload.get("models"))
+    except ValueError as e:
+        return {"error": str(e)}
+    agent = Agent(
+        model=model,
+        name="PolicyAnalysisAgent"
+    )
+
+    # 所要時間・トークン数などの計測値は、応答の metrics（ストリーミング時は最後の {"metrics": ...}）で返す
+    timer = CallTimer("ordinance", kind="entrypoint")
+
+    # stream: true の場合は生成途中のテキストを逐次返す（ランタイムがSSEとして中継する）
+    if payload.get("stream"):
+        return stream_text(agent, prompt, timer)
+
+    try:
+        text = cached_call(agent, prompt, step="ordinance")
+    except Exception as e:
+        timer.finish(error=e)
+        raise
+    timer.add_usage(agent.event_loop_metrics.accumulated_usage)
+    return {"result": {"role": "assistant", "content": [{"text": text}]}, "metrics": timer.finish()}
+
+async def stream_text(agent, prompt, timer):
+    """モデル出力のテキストチャンクを順に返し、最後に計測値を返す"""
+    async for event in measure(cached_stream_async(agent, prompt, timer.step), timer):
+        if "data" in event:
+            yield event["data"]
+    yield {"metrics": timer.record}
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
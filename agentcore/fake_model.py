@@ -0,0 +1,490 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import uuid
+
+from strands.models.model import Model
+from strands.types.exceptions import ModelThrottledException
+
+# 負荷試験用の偽モデル（Bedrockを呼び出さず、ステップごとの定型の応答を一定の速度でストリーミングする）
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# モデルIDに "fake"（または "fake:ttft_ms=200,tokens_per_sec=80" のように設定付き）を割り当てると、
+# model_registry がそのステップのエージェントにこのモデルを渡す（例: MODEL_DEFAULT=fake で全ステップを置き換え）。
+# 応答は各ステップのプロンプトが指定する形式どおりのJSON（またはテキスト）で、内容はプロンプトから決まる（毎回同じ）。
+#
+# 環境変数（モデルIDで指定しなかった設定の既定値）:
+#   FAKE_MODEL_TTFT_MS          最初のトークンまでの時間（ミリ秒、既定: 300）
+#   FAKE_MODEL_TOKENS_PER_SEC   出力の速度（トークン/秒、既定: 60）
+#   FAKE_MODEL_CHUNK_TOKENS     1チャンクあたりのトークン数（既定: 4）
+#   FAKE_MODEL_SLOW_RATE        最初のトークンが遅れる呼び出しの割合（0〜1、既定: 0。裾の遅延の再現用）
+#   FAKE_MODEL_SLOW_MS          遅れる呼び出しで ttft_ms に加える時間（ミリ秒、既定: 5000）
+#   FAKE_MODEL_THROTTLE_RATE    スロットリング（ModelThrottledException）で失敗する呼び出しの割合（0〜1、既定: 0）
+#   FAKE_MODEL_SEED             遅延・スロットリングを決める乱数のシード（既定: 0）
+
+FAKE_MODEL_PREFIX = "fake"
+DEFAULT_TTFT_MS = float(os.environ.get("FAKE_MODEL_TTFT_MS", "300"))
+DEFAULT_TOKENS_PER_SEC = float(os.environ.get("FAKE_MODEL_TOKENS_PER_SEC", "60"))
+DEFAULT_CHUNK_TOKENS = int(os.environ.get("FAKE_MODEL_CHUNK_TOKENS", "4"))
+DEFAULT_SLOW_RATE = float(os.environ.get("FAKE_MODEL_SLOW_RATE", "0"))
+DEFAULT_SLOW_MS = float(os.environ.get("FAKE_MODEL_SLOW_MS", "5000"))
+DEFAULT_THROTTLE_RATE = float(os.environ.get("FAKE_MODEL_THROTTLE_RATE", "0"))
+CONFIG_KEYS = ("ttft_ms", "tokens_per_sec", "chunk_tokens", "slow_rate", "slow_ms", "throttle_rate")
+# トークン数の換算（日本語の文章はおおよそ2文字で1トークン）
+CHARS_PER_TOKEN = 2
+
+# プロンプトキャッシュの書き込み済みの接頭辞（cachePoint より前のシステムプロンプトのハッシュ）
+_cached_prefixes = set()
+# 遅延・スロットリングの抽選（プロセス内で共有し、同じシードなら同じ順に当たる）
+_rng = random.Random(int(os.environ.get("FAKE_MODEL_SEED", "0")))
+
+def is_fake_model(model_id):
+    return isinstance(model_id, str) and (model_id == FAKE_MODEL_PREFIX or model_id.startswith(FAKE_MODEL_PREFIX + ":"))
+
+def parse_fake_model_id(model_id):
+    """"fake:ttft_ms=200,tokens_per_sec=80" を設定の dict に変換"""
+    _, _, spec = model_id.partition(":")
+    config = {}
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        if key.strip() not in CONFIG_KEYS:
+            raise ValueError(f"偽モデルの設定が不正です: {item}（指定できる設定: {', '.join(CONFIG_KEYS)}）")
+        config[key.strip()] = float(value)
+    return config
+
+def _digest(*parts):
+    return int(hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()[:8], 16)
+
+def _score(low, high, *parts):
+    """内容から決まる low〜high の整数（同じ入力には同じ値）"""
+    return low + _digest(*parts) % (high - low + 1)
+
+def _message_text(message):
+    return "\n".join(block["text"] for block in message.get("content", []) if "text" in block)
+
+def _last_user_text(messages):
+    for message in reversed(messages):
+        if message["role"] == "user":
+            text = _message_text(message)
+            if text:
+                return text
+    return ""
+
+def _opinion(text):
+    match = re.search(r"(?:市民意見[「:：]|【市民の意見】)\s*(.+?)(?:」|\n|$)", text)
+    return match.group(1).strip() if match else "市民意見"
+
+def _as_json(data, fenced):
+    text = json.dumps(data, ensure_ascii=False, indent=2)
+    return f"```json\n{text}\n```" if fenced else text
+
+def research_response(opinion):
+    return {
+        "similar_policies": [
+            {"municipality": municipality, "policy_name": f"{opinion[:20]}に関する{name}", "summary": "既存制度を拡充し対象者への支援を強化", "results": "利用者数が導入前から2割増加"}
+            for municipality, name in (("大阪市", "支援事業"), ("堺市", "モデル事業"), ("神戸市", "実証事業"))
+        ],
+        "has_references": True,
+        "search_scope": "大阪市",
+    }
+
+def demographics_response():
+    return {
+        "target_area": "大阪市",
+        "age_distribution": {"20代": 13, "30代": 14, "40代": 16, "50代": 15, "60代以上": 42},
+        "gender_ratio": {"male": 48, "female": 52},
+        "family_types": [
+            {"type": "単身世帯", "percentage": 45},
+            {"type": "夫婦のみ", "percentage": 18},
+            {"type": "子育て世帯", "percentage": 20},
+            {"type": "三世代同居", "percentage": 5},
+            {"type": "高齢者のみ", "percentage": 12},
+        ],
+        "data_source": "偽モデルの定型データ",
+        "data_scope": "大阪市",
+    }
+
+# 市民エージェントの定型の人物（名前, 年齢, 性別, 家族構成, 職業, 立場）
+PERSONAS = [
+    ("田中恵美", 35, "女性", "夫・未就学児2人", "会社員", "支持派"),
+    ("佐藤隆", 50, "男性", "妻・大学生の子1人", "自営業", "中立派"),
+    ("鈴木良子", 68, "女性", "夫と二人暮らし", "年金生活者", "慎重派"),
+    ("高橋健太", 28, "男性", "単身", "会社員", "条件付き支持派"),
+    ("伊藤由美", 41, "女性", "ひとり親・小学生1人", "パート勤務", "支持派"),
+    ("渡辺誠", 45, "男性", "妻・中学生と小学生", "会社員", "条件付き支持派"),
+    ("山本花子", 75, "女性", "単身", "年金生活者", "慎重派"),
+    ("中村翔", 22, "男性", "単身", "大学生", "中立派"),
+    ("小林真理", 33, "女性", "夫・乳児1人", "看護師", "支持派"),
+    ("加藤博", 60, "男性", "妻・同居の孫", "会社員", "反対派"),
+]
+
+def _persona(index):
+    name, age, gender, family, occupation, stake = PERSONAS[index % len(PERSONAS)]
+    if index >= len(PERSONAS):
+        name = f"{name}{index // len(PERSONAS) + 1}"
+    return name, age, gender, family, occupation, stake
+
+def agent_defs_response(opinion, citizen_count=10):
+    citizens = []
+    for index in range(citizen_count):
+        name, age, gender, family, occupation, stake = _persona(index)
+        citizens.append({
+            "name": name, "age": age, "gender": gender, "family": family,
+            "profile": f"{occupation}。{family}。", "is_directly_affected": stake in ("支持派", "条件付き支持派"),
+            "system_prompt": f"あなたは{name}です。{age}歳の{occupation}で、{family}という家族構成です。自分の生活に基づいて率直に評価してください。",
+        })
+    return {
+        "policy_agents": [
+            {"name": "政策立案専門家", "expertise": "自治体政策", "system_prompt": f"「{opinion}」に対する政策を立案してください。"},
+            {"name": "財政担当者", "expertise": "予算・財源", "system_prompt": "予算と財源の観点から政策を検討してください。"},
+        ],
+        "citizen_agents": citizens,
+        "reviewer_agent": {"name": "法務担当者", "expertise": "法令・実現性", "system_prompt": "法律と実現性の観点でレビューしてください。"},
+    }
+
+def policy_response(opinion):
+    return {
+        "policy_title": f"{opinion[:30]}に向けた総合支援策",
+        "summary": "対象者への支援を拡充し、申請手続きを一本化する。",
+        "referenced_policies": ["大阪市 支援事業", "堺市 モデル事業"],
+        "problem_analysis": "支援の受け皿が不足しており、手続きも分かりにくい。",
+        "policy_options": [
+            {"option_name": "受け皿の拡充", "description": "定員を3年間で20%拡充する", "merits": ["待機の解消"], "demerits": ["財政負担"]},
+        ],
+        "recommended_policy": "公有地を活用した受け皿の拡充とオンライン申請の一本化",
+        "implementation_plan": "1年目に実証、2年目から全市展開",
+        "expected_effects": "待機者の半減と手続き時間の短縮",
+        "risks": "人材確保の遅れ",
+        "is_temporary": False,
+    }
+
+def review_response():
+    return {
+        "legal_compliance": {"score": 5, "issues": [], "recommendations": ["関連条例との整合を確認する"]},
+        "feasibility": {"score": 4, "issues": ["人材確保"], "recommendations": ["段階的に実施する"]},
+        "overall_assessment": "法令上の問題はなく、実現可能性も高い。",
+        "approved": True,
+        "improvement_suggestions": "",
+    }
+
+def citizen_evaluation(name, policy, age=None):
+    """persona_evaluation / Flask_Streaming の市民評価（1〜5の評価。age は future_evaluation と揃えるためのもので使わない）"""
+    rating = _score(2, 5, "overall", name, policy)
+    return {
+        "evaluator_name": name,
+        "overall_rating": rating,
+        "detailed_evaluation": {
+            key: {"score": _score(1, 5, key, name, policy), "reason": reason}
+            for key, reason in (("personal_impact", "自分への影響"), ("family_impact", "家族への影響"), ("community_impact", "地域への影響"),
+                                ("fairness", "公平性"), ("sustainability", "持続可能性"))
+        },
+        "expectations": "手続きが簡単になり、必要な支援を受けやすくなることを期待する。",
+        "concerns": "財源の確保と、対象外の世帯との公平性が気になる。",
+        "recommendations": "効果を毎年検証し、結果を公表してほしい。",
+        "personal_story": f"{name}の生活では、送迎や手続きの負担が少し軽くなりそうだ。",
+    }
+
+def future_evaluation(name, policy, age=None):
+    """10年後評価（age は10年後の年齢）"""
+    return {
+        "evaluator_name": f"{name} (10年後)",
+        "age_now": age,
+        "ten_year_rating": _score(2, 5, "future", name, policy),
+        "changes_observed": "支援の利用者が増え、地域の子育て環境が改善した。",
+        "long_term_impact": "若い世帯の転入が増えた。",
+        "unexpected_outcomes": "担い手の不足が続いた。",
+        "current_opinion": "おおむね良い政策だったと思う。",
+    }
+
+METRIC_KEYS = ("personal_impact", "feasibility", "cost_effectiveness", "coverage", "fairness", "risks", "sustainability", "innovation")
+
+def panel_evaluation(persona, policy):
+    """multi_agent_app の市民評価（8つの観点、100点満点。承認ラインの70点以上になるようにする）"""
+    evaluation = {key: {"score": _score(70, 95, key, persona, policy), "comment": "生活の実感から見て妥当"} for key in METRIC_KEYS}
+    evaluation["reasoning"] = "生活への効果が見込め、費用も妥当と考える。"
+    evaluation["improvement_suggestions"] = "申請手続きをさらに簡単にしてほしい。"
+    return evaluation
+
+def broadlistening_collection(opinion):
+    samples = [f"{opinion[:40]}について。{topic}があると助かる。#大阪 #{tag}" for topic, tag in (
+        ("相談窓口の拡充", "相談"), ("オンライン申請の改善", "申請"), ("送迎時間の柔軟化", "保育園"), ("家賃補助", "住まい"),
+        ("学童の定員拡大", "学童"), ("夜間の窓口", "窓口"), ("地域の見守り", "地域"), ("情報発信の一本化", "情報"),
+    ) for _ in range(3)]
+    samples = [f"{sample}（{index + 1}）" for index, sample in enumerate(samples)]
+    return {
+        "query": f"{opinion[:20]} OR 子育て支援 OR 保育園 lang:ja",
+        "collection_window": {"from": "2025-09-01T00:00:00Z", "to": "2025-10-01T00:00:00Z", "timezone": "Asia/Tokyo"},
+        "meta": {"language": "ja", "total_collected": 60, "filtered_count": len(samples)},
+        "samples": samples,
+    }
+
+def broadlistening_analysis():
+    return {
+        "main_themes": ["手続きの負担", "受け皿の不足", "情報の届きにくさ"],
+        "sentiment_analysis": {"positive_ratio": 0.3, "negative_ratio": 0.5, "neutral_ratio": 0.2},
+        "priority_issues": [
+            {"issue": "受け皿の不足", "frequency": "40%", "urgency": "高", "impact": "子育て世帯全体"},
+            {"issue": "申請手続きの煩雑さ", "frequency": "25%", "urgency": "中", "impact": "共働き世帯"},
+        ],
+        "demographic_insights": {"target_groups": ["共働き世帯", "ひとり親世帯"], "regional_patterns": "都心部で不足感が強い", "age_group_concerns": "30〜40代は送迎、60代以上は財政負担"},
+        "policy_recommendations": ["受け皿の拡充", "オンライン申請の一本化", "情報発信の強化"],
+        "implementation_considerations": ["人材確保", "財源の確保"],
+    }
+
+def policy_agent_config(opinion):
+    return {
+        "role": "子育て支援専門家",
+        "specialty": "保育・子育て支援政策",
+        "background": "自治体子育て支援課長として計画3本を主導",
+        "system_prompt": f"あなたは子育て支援専門家として、「{opinion}」に対する実現可能な政策を立案します。",
+    }
+
+def citizen_agents_config(count):
+    config = {}
+    for index in range(count):
+        name, age, _, family, occupation, stake = _persona(index)
+        config[f"citizen_agent_{index + 1}"] = {
+            "name": name, "age": age, "occupation": occupation, "family": family, "stake_in_policy": stake,
+            "values": "家族の時間と公平な負担", "personal_context": f"{occupation}として日々の生活に関わる。",
+            "system_prompt": f"あなたは{name}です。{age}歳の{occupation}で、{family}という家族構成です。\n立場: {stake}",
+        }
+    return config
+
+def policy_document(opinion):
+    return f"""【政策サマリー】
+- 「{opinion}」に応え、受け皿の拡充と手続きの一本化を行う。
+- 対象は市内の子育て世帯、3年間で待機の解消を目指す。
+
+【施策案】
+1. 子育て支援総合パッケージ
+2. 受け皿の不足と手続きの煩雑さを解消する
+3. 公有地の活用、オンライン申請の一本化、実証事業
+4. 児童福祉法・既存の子育て支援計画と整合
+5. 待機者数・申請時間を毎年評価
+
+【提案理由書】
+- 市民の声とブロードリスニングで受け皿の不足が最多の課題だった。
+
+【財政影響調書】
+- 初年度12億円、国庫補助を活用し実質負担は半分
+
+【リスク・対応策／利害関係者】
+- 人材不足には処遇改善で対応
+
+【市民向け要約】
+- 保育の受け皿を増やし、申請をスマホで完結できるようにします。
+"""
+
+def ordinance_document(opinion):
+    return f"""【条例名】
+子育て支援の推進に関する条例
+
+第一条（目的）
+この条例は、「{opinion}」という市民の声を受け、子育て支援を推進することを目的とする。
+
+第二条（定義）
+（一）子育て世帯 市内に住所を有し、18歳未満の子を養育する世帯をいう。
+
+附則
+この条例は、公布の日から施行する。
+
+【提案理由書】
+受け皿の不足を解消するため。
+
+【財政影響調書】
+初年度12億円（国庫補助を活用）
+"""
+
+class FakeModel(Model):
+    """ステップごとの定型の応答を ttft_ms 待ってから tokens_per_sec の速度で返す Strands のモデル"""
+    def __init__(self, model_id=FAKE_MODEL_PREFIX, step=None, **config):
+        config = {**parse_fake_model_id(model_id), **config}
+        self.config = {
+            "model_id": model_id,
+            "step": step,
+            "ttft_ms": config.get("ttft_ms", DEFAULT_TTFT_MS),
+            "tokens_per_sec": config.get("tokens_per_sec", DEFAULT_TOKENS_PER_SEC),
+            "chunk_tokens": int(config.get("chunk_tokens", DEFAULT_CHUNK_TOKENS)),
+            "slow_rate": config.get("slow_rate", DEFAULT_SLOW_RATE),
+            "slow_ms": config.get("slow_ms", DEFAULT_SLOW_MS),
+            "throttle_rate": config.get("throttle_rate", DEFAULT_THROTTLE_RATE),
+        }
+
+    def update_config(self, **model_config):
+        self.config.update(model_config)
+
+    def get_config(self):
+        return self.config
+
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        raise NotImplementedError("偽モデルは構造化出力に対応していません")
+        yield
+
+    def respond(self, messages, system_text):
+        """応答（("text", テキスト) または ("tool", [(ツール名, 入力), ...])）"""
+        step = self.config["step"]
+        prompt = _last_user_text(messages)
+        text = f"{system_text}\n{prompt}"
+        fenced = "```json" in text
+        opinion = _opinion(text)
+
+        if step == "supervisor":
+            return supervisor_turn(messages)
+        if prompt.startswith("直前の出力のうち") and "```json" in prompt:
+            # 形式を満たさない項目だけの聞き直し（step_schemas）には、示された形式の例をそのまま返す
+            return "text", "```json\n" + prompt.split("```json", 1)[1].split("```", 1)[0].strip() + "\n```"
+        if step == "research":
+            return "text", _as_json(research_response(opinion), fenced)
+        if step == "demographics":
+            if "地域名" in system_text and "だけ" in system_text:
+                return "text", "大阪市"
+            return "text", _as_json(demographics_response(), fenced)
+        if step == "sv_agent":
+            return "text", _as_json(agent_defs_response(opinion), fenced)
+        if step == "swarm":
+            return "text", _as_json(policy_response(opinion), fenced)
+        if step == "reviewer":
+            return "text", _as_json(review_response(), fenced)
+        if step in ("citizen", "future"):
+            if "8つの観点" in text:
+                return "text", _as_json(panel_evaluation(prompt, system_text), fenced)
+            evaluate = future_evaluation if step == "future" else citizen_evaluation
+            # 評価する市民（persona_evaluation は「名前: 」「年齢: 」の行、Flask_Streaming/multi_agent_app.py は evaluator_name）
+            personas = [(name, int(age)) for name, age in re.findall(r"^名前: (.+)\n.*\n年齢: (\d+)歳", prompt, re.MULTILINE)]
+            personas = personas or [(name, None) for name in re.findall(r'"evaluator_name": "([^"]+)"', prompt)] or [("市民", None)]
+            if '"evaluations"' in text:
+                return "text", _as_json({"evaluations": [evaluate(name, system_text, age) for name, age in personas]}, fenced)
+            name, age = personas[0]
+            return "text", _as_json(evaluate(name, text, age), fenced)
+        if step == "broadlistening":
+            if "samples" in prompt and "SNSリサーチャー" in prompt:
+                return "text", json.dumps(broadlistening_collection(opinion), ensure_ascii=False)
+            if "lang:ja" in prompt and "SNSリサーチャー" in prompt:
+                return "text", f"{opinion[:20]} OR 子育て支援 OR 保育園 送迎 lang:ja"
+            return "text", _as_json(broadlistening_analysis(), fenced)
+        if step == "setup":
+            count = re.search(r"(\d+)人の市民エージェント", prompt)
+            if count:
+                return "text", _as_json(citizen_agents_config(int(count.group(1))), fenced)
+            return "text", _as_json(policy_agent_config(opinion), fenced)
+        if step == "policy":
+            return "text", policy_document(opinion)
+        return "text", ordinance_document(opinion)
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, *, system_prompt_content=None, **kwargs):
+        blocks = system_prompt_content or ([{"text": system_prompt}] if system_prompt else [])
+        system_text = "\n".join(block["text"] for block in blocks if "text" in block)
+        kind, output = self.respond(messages, system_text)
+
+        input_tokens = (len(system_text) + sum(len(json.dumps(m["content"], ensure_ascii=False)) for m in messages)) // CHARS_PER_TOKEN
+        usage = {"inputTokens": input_tokens, "outputTokens": 0, "totalTokens": 0}
+        if any("cachePoint" in block for block in blocks):
+            # cachePoint より前の部分は2回目以降キャッシュから読み込んだものとして数える
+            prefix = "".join(block.get("text", "") for block in blocks[:next(i for i, b in enumerate(blocks) if "cachePoint" in b)])
+            cached = len(prefix) // CHARS_PER_TOKEN
+            key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+            usage["cacheReadInputTokens" if key in _cached_prefixes else "cacheWriteInputTokens"] = cached
+            usage["inputTokens"] = max(input_tokens - cached, 0)
+            _cached_prefixes.add(key)
+
+        started = asyncio.get_running_loop().time()
+        ttft_ms = self.config["ttft_ms"]
+        if _rng.random() < self.config["throttle_rate"]:
+            await asyncio.sleep(ttft_ms / 1000)
+            raise ModelThrottledException("偽モデルのスロットリング")
+        if _rng.random() < self.config["slow_rate"]:
+            ttft_ms += self.config["slow_ms"]
+        await asyncio.sleep(ttft_ms / 1000)
+        yield {"messageStart": {"role": "assistant"}}
+        chunk_chars = self.config["chunk_tokens"] * CHARS_PER_TOKEN
+        chunk_seconds = self.config["chunk_tokens"] / self.config["tokens_per_sec"]
+
+        if kind == "text":
+            yield {"contentBlockStart": {"start": {}}}
+            for index in range(0, len(output), chunk_chars):
+                if index:
+                    await asyncio.sleep(chunk_seconds)
+                yield {"contentBlockDelta": {"delta": {"text": output[index:index + chunk_chars]}}}
+            yield {"contentBlockStop": {}}
+            usage["outputTokens"] = len(output) // CHARS_PER_TOKEN
+            stop_reason = "end_turn"
+        else:
+            for name, tool_input in output:
+                arguments = json.dumps(tool_input, ensure_ascii=False)
+                await asyncio.sleep(len(arguments) / chunk_chars * chunk_seconds)
+                yield {"contentBlockStart": {"start": {"toolUse": {"toolUseId": f"tooluse_{uuid.uuid4().hex[:20]}", "name": name}}}}
+                yield {"contentBlockDelta": {"delta": {"toolUse": {"input": arguments}}}}
+                yield {"contentBlockStop": {}}
+                usage["outputTokens"] += len(arguments) // CHARS_PER_TOKEN
+            stop_reason = "tool_use"
+
+        usage["totalTokens"] = usage["inputTokens"] + usage["outputTokens"]
+        yield {"messageStop": {"stopReason": stop_reason}}
+        latency_ms = round((asyncio.get_running_loop().time() - started) * 1000)
+        yield {"metadata": {"usage": usage, "metrics": {"latencyMs": latency_ms}}}
+
+def _tool_uses(message):
+    return [block["toolUse"] for block in message.get("content", []) if "toolUse" in block]
+
+def _tool_results(messages):
+    return [
+        "\n".join(part.get("text", "") for part in block["toolResult"].get("content", []))
+        for message in messages for block in message.get("content", []) if "toolResult" in block
+    ]
+
+def _latest_handle(results, kind):
+    handles = re.findall(rf"artifact://{kind}/\d+", "\n".join(results))
+    return handles[-1] if handles else None
+
+def supervisor_turn(messages):
+    """監督エージェントの手順（run_supervised のプロンプトの1〜5）をツール結果に応じて1ターンずつ進める"""
+    opinion = _opinion(_message_text(messages[0]))
+    last_calls = next((_tool_uses(m) for m in reversed(messages) if m["role"] == "assistant" and _tool_uses(m)), [])
+    last = {call["name"] for call in last_calls}
+    results = _tool_results(messages)
+
+    if not last:
+        return "tool", [("generate_broadlistening_collection_mock", {"citizen_opinion": opinion})]
+    if "generate_broadlistening_collection_mock" in last:
+        return "tool", [("analyze_broadlistening_results", {"citizen_opinion": opinion, "broadlistening_data": _latest_handle(results, "bl")})]
+    if "analyze_broadlistening_results" in last:
+        return "tool", [("setup_policy_agent", {"citizen_opinion": opinion}), ("setup_citizen_agents", {"citizen_opinion": opinion})]
+    if last & {"setup_policy_agent", "setup_citizen_agents"}:
+        return "tool", [("create_policy", {"citizen_opinion": opinion})]
+    if last & {"create_policy", "improve_policy"}:
+        return "tool", [("evaluate_policy_panel", {"policy_text": _latest_handle(results, "policy")})]
+    if "evaluate_policy_panel" in last:
+        return "tool", [("calculate_final_score", {"evaluations": _latest_handle(results, "evaluations")})]
+
+    loops = sum(1 for m in messages if m["role"] == "assistant" for call in _tool_uses(m) if call["name"] == "calculate_final_score")
+    try:
+        score = json.loads(results[-1])
+    except (IndexError, ValueError):
+        score = {}
+    if score.get("needs_improvement") and loops < 3:
+        return "tool", [("improve_policy", {
+            "current_policy": _latest_handle(results, "policy"),
+            "improvement_points": _latest_handle(results, "improvement_points"),
+        })]
+    verdict = f"{score.get('status', '不明')}（{score.get('average_weighted_score', '-')}点）"
+    # 報告はプロンプトで指定された見出しの順に並べ、最後の見出しに政策案のハンドルを書く
+    prompt = _message_text(messages[0])
+    title = re.search(r"^# (.+)$", prompt, re.M)
+    headings = re.findall(r"^## (.+)$", prompt, re.M)
+    if not headings:
+        return "text", f"""# 政策検討結果報告
+
+市民意見「{opinion}」について、ブロードリスニング分析の主要テーマを前提に政策案を作成し、市民エージェントの評価を受けました。
+最終判定: {verdict}
+
+{_latest_handle(results, 'policy')}
+"""
+    body = {heading: f"市民意見「{opinion}」について、ブロードリスニング分析の主要テーマを前提に検討しました。" for heading in headings}
+    body.update({heading: verdict for heading in headings if "判定" in heading})
+    body[headings[-1]] = _latest_handle(results, "policy")
+    sections = "\n\n".join(f"## {heading}\n{body[heading]}" for heading in headings)
+    return "text", f"# {title.group(1) if title else '政策検討結果報告'}\n\n{sections}\n"
@@ -0,0 +1,144 @@
+import json
+import os
+
+# ステップごとのモデル割り当て
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# 割り当ての値にはティア名（standard / fast / fake）またはBedrockのモデルIDを指定する。
+# fake（"fake:ttft_ms=200,tokens_per_sec=80" のような設定付きのIDも可）はBedrockを呼び出さない負荷試験用の偽モデル（fake_model.py）。
+# 優先順位: リクエストの models > MODEL_ROUTE_<ステップ> > MODEL_ROUTING_FILE > MODEL_DEFAULT
+# リクエストの models で指定できるのは MODEL_ALLOWED_OVERRIDES のティア名・モデルIDだけで、
+# 偽モデル（fake、または fake を割り当てたティア）は MODEL_ALLOW_FAKE_OVERRIDES=1 の場合だけ指定できる。
+#
+# 環境変数:
+#   MODEL_DEFAULT        割り当てのないステップのモデル（既定: standard）
+#   MODEL_ROUTING_FILE   割り当てを記述したJSONファイル
+#                        例: {"routes": {"citizen": "fast", "future": "fast"}, "tiers": {"fast": "モデルID"}}
+#   MODEL_ROUTE_<STEP>   ステップごとの割り当て（例: MODEL_ROUTE_CITIZEN=fast）
+#   MODEL_TIER_<TIER>    ティアのモデルIDの差し替え（例: MODEL_TIER_FAST=us.anthropic.claude-3-5-haiku-20241022-v1:0）
+#   MODEL_ALLOWED_OVERRIDES     リクエストの models で指定できるティア名・モデルID（カンマ区切り、既定: standard,fast）
+#   MODEL_ALLOW_FAKE_OVERRIDES  "1" でリクエストの models での偽モデルの指定を許可（負荷試験・テスト用、既定: 無効）
+#   MODEL_CASSETTE       モデル呼び出しを記録・再生するカセットのファイル（MODEL_CASSETTE_MODE などは model_cassette.py を参照）
+#   MODEL_RESILIENCE     "0" でモデル呼び出しの期限・再試行・ヘッジを無効化（MODEL_HEDGE_STEPS などは model_resilience.py を参照）
+
+ALLOWED_OVERRIDES = {
+    target.strip() for target in os.environ.get("MODEL_ALLOWED_OVERRIDES", "standard,fast").split(",") if target.strip()
+}
+ALLOW_FAKE_OVERRIDES = os.environ.get("MODEL_ALLOW_FAKE_OVERRIDES", "0") == "1"
+
+DEFAULT_TIERS = {
+    "standard": "us.anthropic.claude-sonnet-4-20250514-v1:0",
+    "fast": "us.anthropic.claude-3-5-haiku-20241022-v1:0",
+    "fake": "fake",
+}
+
+# 割り当てを指定できるステップ（ツール）名
+STEPS = {
+    "research": "類似政策の調査",
+    "demographics": "人口動態調査",
+    "sv_agent": "エージェント定義の生成",
+    "swarm": "Swarmによる政策立案・改善",
+    "reviewer": "法律・実現性のレビュー",
+    "citizen": "市民評価",
+    "future": "10年後評価",
+    "supervisor": "監督エージェント",
+    "ordinance": "条例案の作成",
+    "broadlistening": "ブロードリスニングの収集・分析",
+    "setup": "政策作成・市民エージェントの設定",
+    "policy": "政策案の作成・改善",
+}
+
+def is_fake(model_id):
+    """偽モデル（"fake" または "fake:設定"）のIDか"""
+    return model_id.split(":", 1)[0] == "fake"
+
+def check_step(step):
+    if step not in STEPS:
+        raise ValueError(f"不明なステップです: {step}（指定できるステップ: {', '.join(STEPS)}）")
+    return step
+
+class ModelRegistry:
+    """ステップ名からモデルIDを引く割り当て表"""
+    def __init__(self, routes=None, tiers=None, default="standard"):
+        self.tiers = {**DEFAULT_TIERS, **(tiers or {})}
+        self.default = self._check_target(default)
+        self.routes = {check_step(step): self._check_target(target) for step, target in (routes or {}).items()}
+
+    @classmethod
+    def from_env(cls):
+        """環境変数（と MODEL_ROUTING_FILE）から作成"""
+        config = {}
+        path = os.environ.get("MODEL_ROUTING_FILE")
+        if path:
+            with open(path, encoding="utf-8") as f:
+                config = json.load(f)
+
+        tiers = dict(config.get("tiers", {}))
+        routes = dict(config.get("routes", {}))
+        for key, value in os.environ.items():
+            if key.startswith("MODEL_TIER_") and value:
+                tiers[key[len("MODEL_TIER_"):].lower()] = value
+            elif key.startswith("MODEL_ROUTE_") and value:
+                routes[key[len("MODEL_ROUTE_"):].lower()] = value
+        default = os.environ.get("MODEL_DEFAULT") or config.get("default", "standard")
+        return cls(routes, tiers, default)
+
+    def _check_target(self, target):
+        """ティア名またはモデルID（"." か ":" を含む）以外は設定の誤りとみなす"""
+        if not isinstance(target, str) or not (target in self.tiers or "." in target or ":" in target):
+            raise ValueError(f"不明なティアです: {target}（ティア名 {', '.join(self.tiers)} またはモデルIDを指定してください）")
+        return target
+
+    def model_id(self, step):
+        """ステップに割り当てたモデルID"""
+        target = self.routes.get(check_step(step), self.default)
+        return self.tiers.get(target, target)
+
+    def model_for(self, step):
+        """ステップのエージェントに渡すモデル（モデルID、偽モデルの場合はそのステップ用の FakeModel）
+
+        MODEL_CASSETTE を指定した場合は、呼び出しを記録・再生するモデル（model_cassette.py）で包む。
+        さらに期限・再試行・ヘッジ付きのモデル（model_resilience.py）で包む（MODEL_RESILIENCE=0 の場合を除く）。
+        """
+        model = model_id = self.model_id(step)
+        # 偽モデル・カセット・再試行は strands に依存するため、使う場合だけ読み込む
+        if is_fake(model_id):
+            from fake_model import FakeModel
+            model = FakeModel(model_id, step)
+        if os.environ.get("MODEL_CASSETTE"):
+            from model_cassette import cassette_model
+            model = cassette_model(model, step)
+        if os.environ.get("MODEL_RESILIENCE", "1") != "0":
+            from model_resilience import resilient_model
+            model = resilient_model(model, step)
+        return model
+
+    def with_overrides(self, overrides):
+        """リクエストごとの割り当て（{ステップ名: ティア名またはモデルID}）で上書きした割り当て表"""
+        if not overrides:
+            return self
+        if not isinstance(overrides, dict):
+            raise ValueError("models は {ステップ名: ティア名またはモデルID} の形式で指定してください")
+        return ModelRegistry({**self.routes, **overrides}, self.tiers, self.default)
+
+    def with_request_overrides(self, overrides):
+        """リクエストの models で上書きした割り当て表（MODEL_ALLOWED_OVERRIDES にないティア・モデルIDや偽モデルは拒否する）"""
+        if isinstance(overrides, dict):
+            for step, target in overrides.items():
+                fake = isinstance(target, str) and is_fake(self.tiers.get(target, target))
+                if fake and not ALLOW_FAKE_OVERRIDES:
+                    raise ValueError(f"{step}: 偽モデルはリクエストでは指定できません")
+                if not fake and target not in ALLOWED_OVERRIDES:
+                    raise ValueError(f"{step}: 指定できないモデルです: {target}（指定できるもの: {', '.join(sorted(ALLOWED_OVERRIDES))}）")
+        return self.with_overrides(overrides)
+
+    def routing(self):
+        """全ステップの割り当て（{ステップ名: モデルID}）"""
+        return {step: self.model_id(step) for step in STEPS}
+
+default_registry = ModelRegistry.from_env()
+
+def model_for(step, overrides=None):
+    """既定の割り当て表（リクエストの models で上書き可）からステップのモデルを返す"""
+    return default_registry.with_request_overrides(overrides).model_for(step)
@@ -0,0 +1,36 @@
+import asyncio
+import threading
+
+class AsyncLoopThread:
+    """バックグラウンドスレッドで動き続ける1本のイベントループ
+
+    WSGI（Flask）のリクエストスレッドからパイプラインのコルーチンを実行するための橋渡しをする。
+    リクエストごとにイベントループを作らず、全実行をこのループ上で並行に実行する。
+    """
+    def __init__(self, name="async-bridge"):
+        self._name = name
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """イベントループ（初回アクセス時にスレッドを起動）"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name=self._name, daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        """コルーチンをループ上で実行し、concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        """ループを停止（テストやシャットダウン時用）"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+bridge = AsyncLoopThread()
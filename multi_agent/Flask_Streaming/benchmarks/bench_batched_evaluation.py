@@ -0,0 +1,123 @@
+"""市民評価のモード比較ベンチマーク（1名ずつ vs まとめて評価）
+
+同じ政策概要と市民ペルソナを per_persona / batched（複数のKで）評価し、
+所要時間・リクエスト数・入出力トークン数・プロンプトキャッシュの読み込み量・最初のトークンまでの時間・
+概算コスト・有効な評価件数を比較する。プロンプトキャッシュの有無は PROMPT_CACHE_ENABLED=0 で切り替えて比較する。
+実際のBedrockを呼び出すため、AWS認証情報が必要。
+
+    python benchmarks/bench_batched_evaluation.py --personas 10 --batch-sizes 3 5 10 --repeat 2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# キャッシュが効くと2回目以降の計測がゼロになるため無効化する
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persona_evaluation import evaluate_personas, CITIZEN  # noqa: E402
+
+# 1Mトークンあたりの価格（USD、既定は Claude Sonnet 4 のオンデマンド料金）
+INPUT_PRICE = float(os.environ.get("INPUT_PRICE_PER_MTOK", "3.0"))
+OUTPUT_PRICE = float(os.environ.get("OUTPUT_PRICE_PER_MTOK", "15.0"))
+# プロンプトキャッシュの読み込み・書き込みの価格（既定は入力の0.1倍・1.25倍）
+CACHE_READ_PRICE = float(os.environ.get("CACHE_READ_PRICE_PER_MTOK", str(INPUT_PRICE * 0.1)))
+CACHE_WRITE_PRICE = float(os.environ.get("CACHE_WRITE_PRICE_PER_MTOK", str(INPUT_PRICE * 1.25)))
+
+POLICY_SUMMARY = """
+政策名: 子育て世帯向け保育・学童の受け皿拡充と所得制限の撤廃
+概要: 保育所・学童保育の定員を3年間で20%拡充し、児童手当等の所得制限を撤廃する。
+推奨政策: 公有地・空き店舗を活用した小規模保育の新設、学童の民間委託枠拡大、オンライン申請の一本化
+参考事例: 明石市 所得制限なしの子育て支援5つの無料化, 大阪市 塾代助成事業
+"""
+
+PERSONA_SEEDS = [
+    ("田中恵美", 35, "女性", "夫・未就学児2人", "共働きの会社員。保育園の送迎と仕事の両立に苦労している。", True),
+    ("佐藤隆", 50, "男性", "妻・大学生の子1人", "飲食店を経営する自営業者。税負担と地域経済を重視。", False),
+    ("鈴木良子", 68, "女性", "夫と二人暮らし", "年金生活の元公務員。財政の健全性を気にしている。", False),
+    ("高橋健太", 28, "男性", "単身", "IT企業勤務。将来の結婚・子育てを考えている。", False),
+    ("伊藤由美", 41, "女性", "ひとり親・小学生1人", "パート勤務。学童の定員不足で勤務時間を減らしている。", True),
+    ("渡辺誠", 45, "男性", "妻・中学生と小学生", "高所得の会社員。所得制限で手当を受け取れていない。", True),
+    ("山本花子", 75, "女性", "単身", "一人暮らしの高齢者。地域の見守りや医療を重視。", False),
+    ("中村翔", 22, "男性", "単身", "大学生。アルバイトをしながら一人暮らし。", False),
+    ("小林真理", 33, "女性", "夫・乳児1人", "育休中の看護師。保育園の入園を心配している。", True),
+    ("加藤博", 60, "男性", "妻・同居の孫", "定年間近の会社員。孫の保育を手伝っている。", True),
+]
+
+def build_personas(count):
+    personas = []
+    for i in range(count):
+        name, age, gender, family, profile, affected = PERSONA_SEEDS[i % len(PERSONA_SEEDS)]
+        if i >= len(PERSONA_SEEDS):
+            name = f"{name}{i // len(PERSONA_SEEDS) + 1}"
+        personas.append({
+            "name": name, "age": age, "gender": gender, "family": family, "profile": profile,
+            "is_directly_affected": affected,
+            "system_prompt": f"あなたは{name}です。{age}歳、{family}。{profile}自分の生活に基づいて率直に政策を評価してください。",
+        })
+    return personas
+
+async def run_once(mode, batch_size, personas, max_concurrency):
+    results = [None] * len(personas)
+    usage = {}
+    steps = set()
+    metrics = {}
+    started = time.perf_counter()
+    async for event in evaluate_personas(CITIZEN, POLICY_SUMMARY, personas, results, mode, batch_size, max_concurrency, usage):
+        if event["type"] == "stream":
+            steps.add(event["step"])
+        elif event["type"] == "cache_metrics":
+            metrics = event["data"]
+    elapsed = time.perf_counter() - started
+    valid = sum(1 for r in results if r is not None and "error" not in r)
+    return {
+        "seconds": elapsed,
+        "requests": len(steps),
+        "input_tokens": usage.get("inputTokens", 0),
+        "output_tokens": usage.get("outputTokens", 0),
+        "cache_read": usage.get("cacheReadInputTokens", 0),
+        "cache_write": usage.get("cacheWriteInputTokens", 0),
+        "ttft_ms": (metrics.get("ttft_ms") or {}).get("median") or 0,
+        "valid": valid,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--personas", type=int, default=10)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[5])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--max-concurrency", type=int, default=5)
+    args = parser.parse_args()
+
+    personas = build_personas(args.personas)
+    configs = [("per_persona", 1)] + [("batched", k) for k in args.batch_sizes]
+
+    print(f"市民 {len(personas)}名 / 同時実行数 {args.max_concurrency} / 各 {args.repeat}回")
+    print(
+        f"{'mode':<12}{'K':>4}{'秒(中央値)':>12}{'リクエスト':>10}{'入力tok':>10}{'キャッシュ読込':>14}{'キャッシュ書込':>14}"
+        f"{'出力tok':>10}{'TTFTms':>8}{'概算USD':>10}{'有効件数':>8}"
+    )
+    for mode, k in configs:
+        runs = [await run_once(mode, k, personas, args.max_concurrency) for _ in range(args.repeat)]
+        input_tokens = statistics.mean(r["input_tokens"] for r in runs)
+        cache_read = statistics.mean(r["cache_read"] for r in runs)
+        cache_write = statistics.mean(r["cache_write"] for r in runs)
+        output_tokens = statistics.mean(r["output_tokens"] for r in runs)
+        cost = (
+            input_tokens * INPUT_PRICE + cache_read * CACHE_READ_PRICE + cache_write * CACHE_WRITE_PRICE
+            + output_tokens * OUTPUT_PRICE
+        ) / 1_000_000
+        print(
+            f"{mode:<12}{k:>4}"
+            f"{statistics.median(r['seconds'] for r in runs):>12.1f}"
+            f"{statistics.mean(r['requests'] for r in runs):>10.1f}"
+            f"{input_tokens:>10.0f}{cache_read:>14.0f}{cache_write:>14.0f}{output_tokens:>10.0f}"
+            f"{statistics.median(r['ttft_ms'] for r in runs):>8.0f}{cost:>10.4f}"
+            f"{statistics.mean(r['valid'] for r in runs):>8.1f}"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,326 @@
+"""人口統計のローカル索引（ステップ1aの人口動態をモデルに推定させず統計データから引く）
+
+e-Stat 形式のCSV（国勢調査の男女・年齢別人口、世帯の家族類型など）を取り込み、
+地域ごとの集計値を列指向のバイナリファイルに保存する。検索時はファイルをメモリマップし、
+地域名・別名から行番号を引いて必要な列だけを読み出す。
+
+索引の作成:
+    python census_index.py build 人口.csv 世帯.csv --aliases aliases.csv --source "総務省 国勢調査（令和2年）"
+
+保存先は CENSUS_INDEX_DIR（既定: このファイルと同じ階層の census_data/）。
+"""
+import csv
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import unicodedata
+
+INDEX_DIR = os.environ.get("CENSUS_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "census_data"))
+INDEX_FILE = "index.json"
+COLUMNS_FILE = "columns.bin"
+
+# 保存する列（地域ごとの実数）
+COLUMNS = [
+    "population", "male", "female",
+    "age_20s", "age_30s", "age_40s", "age_50s", "age_60_plus",
+    "households", "single", "couple_only", "couple_with_children", "single_parent",
+    "three_generation", "elderly_only",
+]
+
+AGE_LABELS = [("20代", "age_20s"), ("30代", "age_30s"), ("40代", "age_40s"), ("50代", "age_50s"), ("60代以上", "age_60_plus")]
+
+# family_types の種別と対応する列
+FAMILY_TYPES = [
+    ("単身世帯", ("single",)),
+    ("夫婦のみ", ("couple_only",)),
+    ("子育て世帯", ("couple_with_children", "single_parent")),
+    ("三世代同居", ("three_generation",)),
+    ("高齢者のみ", ("elderly_only",)),
+]
+
+# e-Stat の表頭と列の対応（表記ゆれは NFKC 正規化後に部分一致で判定）
+HOUSEHOLD_HEADERS = [
+    ("households", ("一般世帯総数", "世帯総数", "総世帯数")),
+    ("single", ("単独世帯",)),
+    ("couple_only", ("夫婦のみの世帯",)),
+    ("couple_with_children", ("夫婦と子供から成る世帯",)),
+    ("single_parent", ("ひとり親と子供から成る世帯", "男親と子供から成る世帯", "女親と子供から成る世帯")),
+    ("three_generation", ("3世代世帯", "三世代世帯")),
+    ("elderly_only", ("高齢夫婦世帯", "高齢単身世帯", "65歳以上の世帯員のみ")),
+]
+POPULATION_HEADERS = ("総人口", "人口総数", "総数")
+AREA_HEADERS = ("地域名", "地域", "市区町村名", "市区町村", "全国、都道府県、市区町村")
+MISSING_VALUES = {"", "-", "－", "…", "...", "x", "X", "***", "*"}
+
+_AGE_RANGE = re.compile(r"(\d+)[～〜~\-－](\d+)歳")
+_AGE_OVER = re.compile(r"(\d+)歳以上")
+_LEADING_CODE = re.compile(r"^\d+[_\s]*")
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", str(text)).strip()
+
+def _number(text):
+    text = _normalize(text).replace(",", "")
+    if text in MISSING_VALUES:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def _age_column(header):
+    """年齢階級の表頭を列名に変換（20歳未満は対象外）"""
+    match = _AGE_RANGE.search(header)
+    if match:
+        lower = int(match.group(1))
+    else:
+        match = _AGE_OVER.search(header)
+        if not match:
+            return None
+        lower = int(match.group(1))
+    if lower < 20:
+        return None
+    if lower >= 60:
+        return "age_60_plus"
+    return f"age_{lower // 10 * 10}s"
+
+def _classify_header(header):
+    """表頭を (列名, 男女の別) に変換。対象外の列は None"""
+    header = _normalize(header)
+    sex = "male" if "男" in header and "男親" not in header else "female" if "女" in header and "女親" not in header else None
+
+    for column, names in HOUSEHOLD_HEADERS:
+        if any(name in header for name in names):
+            return column, None
+
+    age = _age_column(header)
+    if age:
+        return age, sex
+
+    if "世帯" in header:
+        return None
+    if header in ("男", "男性", "人口(男)", "男_総数", "総数_男"):
+        return "male", None
+    if header in ("女", "女性", "人口(女)", "女_総数", "総数_女"):
+        return "female", None
+    if any(header == name or header.startswith(name + "_") for name in POPULATION_HEADERS) and sex is None:
+        return "population", None
+    return None
+
+def _read_rows(path):
+    """文字コード（UTF-8 / Shift_JIS）を判定してCSVの行を返す"""
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            with open(path, encoding=encoding, newline="") as f:
+                return list(csv.reader(f))
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"CSVの文字コードを判定できません: {path}")
+
+def _parse_csv(path):
+    """e-Stat 形式のCSVを {地域キー: {"name", "code", 列名: 値}} に変換
+
+    先頭のメタデータ行は読み飛ばし、地域名の列を含む行を表頭とみなす。
+    """
+    rows = _read_rows(path)
+    header_index = None
+    for i, row in enumerate(rows):
+        cells = [_normalize(c) for c in row]
+        if any(c in AREA_HEADERS for c in cells):
+            header_index = i
+            break
+    if header_index is None:
+        raise ValueError(f"地域名の列が見つかりません: {path}")
+
+    header = [_normalize(c) for c in rows[header_index]]
+    area_col = next(i for i, c in enumerate(header) if c in AREA_HEADERS)
+    code_col = next((i for i, c in enumerate(header) if "コード" in c), None)
+
+    mapping = {}
+    for i, cell in enumerate(header):
+        classified = _classify_header(cell)
+        if classified:
+            mapping[i] = classified
+    # 男女別の年齢列しかない場合は男女を合算、男女計の列があればそちらを使う
+    unsexed_ages = {column for column, sex in mapping.values() if column.startswith("age_") and sex is None}
+
+    areas = {}
+    for row in rows[header_index + 1:]:
+        if len(row) <= area_col or not _normalize(row[area_col]):
+            continue
+        name = _LEADING_CODE.sub("", _normalize(row[area_col]))
+        code = _normalize(row[code_col]) if code_col is not None and code_col < len(row) else ""
+        area = areas.setdefault(code or name, {"name": name, "code": code})
+        for i, (column, sex) in mapping.items():
+            if i >= len(row):
+                continue
+            if column.startswith("age_") and sex is not None and column in unsexed_ages:
+                continue
+            value = _number(row[i])
+            if value is None:
+                continue
+            accumulate = column.startswith("age_") or column in ("single_parent", "elderly_only")
+            area[column] = area.get(column, 0.0) + value if accumulate else value
+    return areas
+
+def _auto_aliases(names):
+    """正式名称から別名を作成（都道府県名の省略、政令市の区名のみ。重複する別名は除外）"""
+    candidates = {}
+    for name in names:
+        aliases = {name}
+        short = re.sub(r"^.+?[都道府県](?=.+[市区町村]$)", "", name)
+        aliases.add(short)
+        ward = re.match(r"^.+?市(.+区)$", short)
+        if ward:
+            aliases.add(ward.group(1))
+        for alias in aliases:
+            candidates.setdefault(alias, set()).add(name)
+    return {alias: owners.pop() for alias, owners in candidates.items() if len(owners) == 1}
+
+def build_index(csv_paths, out_dir=INDEX_DIR, alias_path=None, source=None):
+    """CSVを取り込んで索引を作成"""
+    merged = {}
+    for path in csv_paths:
+        for key, area in _parse_csv(path).items():
+            merged.setdefault(key, {}).update(area)
+
+    areas = sorted(merged.values(), key=lambda a: (a.get("code", ""), a["name"]))
+    names = [a["name"] for a in areas]
+    row_of = {name: row for row, name in enumerate(names)}
+
+    aliases = {alias: row_of[name] for alias, name in _auto_aliases(names).items()}
+    if alias_path:
+        for alias, name in _read_rows(alias_path):
+            name = _normalize(name)
+            if name in row_of:
+                aliases[_normalize(alias)] = row_of[name]
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, COLUMNS_FILE), "wb") as f:
+        for column in COLUMNS:
+            values = [area.get(column, math.nan) for area in areas]
+            f.write(struct.pack(f"<{len(values)}d", *values))
+
+    with open(os.path.join(out_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "rows": len(areas),
+            "columns": COLUMNS,
+            "areas": [{"name": a["name"], "code": a.get("code", "")} for a in areas],
+            "aliases": aliases,
+            "source": source or ", ".join(os.path.basename(p) for p in csv_paths),
+        }, f, ensure_ascii=False)
+    return len(areas)
+
+class CensusIndex:
+    """メモリマップした列ファイルから地域の人口動態を読み出す索引"""
+    def __init__(self, index_dir=INDEX_DIR):
+        with open(os.path.join(index_dir, INDEX_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.source = meta.get("source", "")
+        self.areas = meta["areas"]
+        self._column_offsets = {column: i * self.rows * 8 for i, column in enumerate(meta["columns"])}
+        self._aliases = {_normalize(alias): row for alias, row in meta["aliases"].items()}
+        # 文章中の地域名検索は長い別名から優先して照合する
+        self._aliases_by_length = sorted(self._aliases, key=len, reverse=True)
+        self._file = open(os.path.join(index_dir, COLUMNS_FILE), "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find_area(self, text):
+        """地域名・別名、または地域名を含む文章から行番号を返す（見つからなければ None）"""
+        if not text:
+            return None
+        text = _normalize(text)
+        if text in self._aliases:
+            return self._aliases[text]
+        for alias in self._aliases_by_length:
+            if alias in text:
+                return self._aliases[alias]
+        return None
+
+    def value(self, row, column):
+        offset = self._column_offsets.get(column)
+        if offset is None:
+            return None
+        value = struct.unpack_from("<d", self._map, offset + row * 8)[0]
+        return None if math.isnan(value) else value
+
+    def demographics(self, row):
+        """ステップ1aと同じ demographics_data 形式で返す"""
+        name = self.areas[row]["name"]
+
+        ages = {label: self.value(row, column) for label, column in AGE_LABELS}
+        age_total = sum(v for v in ages.values() if v)
+        age_distribution = {label: _percent(v, age_total) for label, v in ages.items() if v is not None}
+
+        male, female = self.value(row, "male"), self.value(row, "female")
+        gender_ratio = {}
+        if male is not None and female is not None and male + female > 0:
+            gender_ratio = {"male": _percent(male, male + female), "female": _percent(female, male + female)}
+
+        households = self.value(row, "households")
+        family_counts = []
+        for label, columns in FAMILY_TYPES:
+            values = [self.value(row, c) for c in columns]
+            if any(v is not None for v in values):
+                family_counts.append((label, sum(v for v in values if v is not None)))
+        family_total = households or sum(count for _, count in family_counts)
+        family_types = [{"type": label, "percentage": _percent(count, family_total)} for label, count in family_counts]
+
+        return {
+            "target_area": name,
+            "age_distribution": age_distribution,
+            "gender_ratio": gender_ratio,
+            "family_types": family_types,
+            "data_source": self.source,
+            "data_scope": "大阪市" if name.startswith(("大阪市", "大阪府大阪市")) else "他の市区町村",
+        }
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+def _percent(value, total):
+    return round(value * 100 / total, 1) if value and total else 0
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_census_index():
+    """索引を一度だけ読み込んで返す（索引が作成されていなければ None）"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None and os.path.exists(os.path.join(INDEX_DIR, INDEX_FILE)):
+                _index = CensusIndex(INDEX_DIR)
+    return _index
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="e-Stat 形式のCSVから人口統計の索引を作成")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build")
+    build.add_argument("csv", nargs="+")
+    build.add_argument("--out", default=INDEX_DIR)
+    build.add_argument("--aliases", help="別名,正式な地域名 の2列からなるCSV")
+    build.add_argument("--source", help="data_source に表示する出典")
+    lookup = subparsers.add_parser("lookup")
+    lookup.add_argument("area")
+    lookup.add_argument("--dir", default=INDEX_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_index(args.csv, args.out, args.aliases, args.source)
+        print(f"{count}地域の索引を作成しました: {args.out}")
+    else:
+        index = CensusIndex(args.dir)
+        row = index.find_area(args.area)
+        if row is None:
+            sys.exit(f"地域が見つかりません: {args.area}")
+        print(json.dumps(index.demographics(row), ensure_ascii=False, indent=2))
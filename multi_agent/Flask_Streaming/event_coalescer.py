@@ -0,0 +1,128 @@
+import asyncio
+import os
+import zlib
+
+# SSE出力の間引き設定
+#   SSE_FLUSH_INTERVAL_MS  stream イベントをまとめて送る間隔（ミリ秒、既定: 50）
+#   SSE_FLUSH_BYTES        1ステップ分のバッファがこのバイト数を超えたら間隔を待たずに送る（既定: 4096）
+#   SSE_GZIP               "1" でクライアントが対応していればgzip圧縮して送る（既定: 無効）
+DEFAULT_FLUSH_INTERVAL_MS = int(os.environ.get("SSE_FLUSH_INTERVAL_MS", "50"))
+DEFAULT_FLUSH_BYTES = int(os.environ.get("SSE_FLUSH_BYTES", "4096"))
+GZIP_ENABLED = os.environ.get("SSE_GZIP", "0") == "1"
+
+_DONE = object()
+
+class _Failure:
+    """ソース側で発生した例外を受け渡すためのラッパー"""
+    def __init__(self, error):
+        self.error = error
+
+def _is_stream_chunk(event):
+    return event.get("type") == "stream" and set(event) == {"type", "step", "data"}
+
+async def coalesce_stream_events(stream, interval_ms=None, max_bytes=None):
+    """モデル出力の細かい stream イベントをステップごとにまとめて返す
+
+    同じ step の stream イベントは interval_ms ごと（または max_bytes に達した時点）に
+    1件へ連結する。ステップ内の順序は保ち、stream 以外のイベント（policy, evaluation, complete など）は
+    それまでのバッファをすべて送ってからすぐに返す。
+    """
+    interval = (DEFAULT_FLUSH_INTERVAL_MS if interval_ms is None else interval_ms) / 1000
+    max_bytes = DEFAULT_FLUSH_BYTES if max_bytes is None else max_bytes
+    loop = asyncio.get_running_loop()
+    # 終了・失敗の通知は満杯でも待たずに入れられるよう、通常のイベントだけを slots で制限する
+    queue = asyncio.Queue()
+    slots = asyncio.Semaphore(256)
+
+    async def pump():
+        async for event in stream:
+            await slots.acquire()
+            queue.put_nowait(event)
+
+    def finished(task):
+        # 取り消されたタスクの中ではキューを待たない（完了の通知はコールバックから put_nowait で入れる）
+        if not task.cancelled() and task.exception() is not None:
+            queue.put_nowait(_Failure(task.exception()))
+        queue.put_nowait(_DONE)
+
+    pending = {}  # step -> [チャンク, ...]
+    sizes = {}
+    deadline = None
+
+    def flush(step=None):
+        steps = [step] if step is not None else list(pending)
+        events = [{"type": "stream", "step": s, "data": "".join(pending.pop(s))} for s in steps]
+        for s in steps:
+            sizes.pop(s, None)
+        return events
+
+    task = asyncio.create_task(pump())
+    task.add_done_callback(finished)
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            timeout = None if deadline is None else max(0, deadline - loop.time())
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                # 間隔が経過したのでバッファ中の全ステップを送る
+                for event in flush():
+                    yield event
+                deadline = None
+                continue
+
+            item = getter.result()
+            getter = None
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                for event in flush():
+                    yield event
+                raise item.error
+            slots.release()
+
+            if _is_stream_chunk(item):
+                step = item["step"]
+                pending.setdefault(step, []).append(item["data"])
+                sizes[step] = sizes.get(step, 0) + len(item["data"].encode("utf-8"))
+                if deadline is None:
+                    deadline = loop.time() + interval
+                if sizes[step] >= max_bytes:
+                    for event in flush(step):
+                        yield event
+                if not pending:
+                    deadline = None
+                continue
+
+            for event in flush():
+                yield event
+            deadline = None
+            yield item
+
+        for event in flush():
+            yield event
+    finally:
+        if getter is not None:
+            getter.cancel()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+class GzipFrames:
+    """SSEフレームをgzipストリームとして圧縮する（フレームごとにフラッシュして即時に届ける）"""
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, text):
+        return self._compressor.compress(text.encode("utf-8")) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+def accepts_gzip(accept_encoding):
+    """Accept-Encoding ヘッダーが gzip を許可しているか"""
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() == "gzip":
+            return params.replace(" ", "") != "q=0"
+    return False
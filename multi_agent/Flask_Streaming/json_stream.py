@@ -0,0 +1,368 @@
+import json
+from llm_cache import cached_stream_async
+from telemetry import CallTimer, measure, metrics_event
+
+_FENCE = "```json"
+_WHITESPACE = " \t\r\n"
+
+class _Frame:
+    """解析中のオブジェクト／配列1階層分の状態"""
+    def __init__(self, kind, key=None):
+        self.kind = kind          # "{" または "["
+        self.key = key            # オブジェクト: 現在のキー / 配列: 親オブジェクトでのキー
+        self.index = -1           # 配列: 現在の要素番号
+        self.expect_key = kind == "{"
+        self.awaiting_value = kind == "["
+
+class _Capture:
+    """部分オブジェクトとして取り出す値の文字列を蓄積する"""
+    def __init__(self, key, index, depth, scalar):
+        self.key = key
+        self.index = index
+        self.depth = depth
+        self.scalar = scalar
+        self.chars = []
+
+class StreamingJSONParser:
+    """モデルの出力チャンクを逐次解析し、```json ブロック内の値が閉じた時点で取り出すパーサー
+
+    items: 要素が閉じるたびに通知するトップレベルの配列キー（例: "citizen_agents"）
+    keys: 値全体が閉じた時点で通知するトップレベルのキー（例: "policy_agents"）
+
+    feed() は新たに確定した部分オブジェクトのリストを返す。
+    配列要素は {"key": キー, "index": 番号, "data": 値}、キー全体は {"key": キー, "data": 値}。
+    """
+    def __init__(self, items=(), keys=()):
+        self.items = set(items)
+        self.keys = set(keys)
+        self._chunks = []
+        self._text = None
+        self._tail = ""
+        self._leading = True
+        self._state = "search"    # search -> open -> json -> done
+        self._json_chars = []
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._key_chars = None
+        self._captures = []
+        self._events = []
+
+    @property
+    def text(self):
+        """これまでに受け取った全テキスト"""
+        if self._text is None:
+            self._text = "".join(self._chunks)
+        return self._text
+
+    def feed(self, chunk):
+        """チャンクを1つ解析し、新たに確定した部分オブジェクトを返す"""
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        self._text = None
+        self._events = []
+
+        pending = chunk
+        while pending and self._state != "done":
+            if self._state == "search":
+                if self._leading:
+                    stripped = pending.lstrip(_WHITESPACE)
+                    if stripped:
+                        self._leading = False
+                        if stripped[0] == "{":
+                            # コードブロックなしで純粋なJSONが返ってくる場合
+                            self._state = "open"
+                            pending = stripped
+                            continue
+                pending = self._search_fence(pending)
+                continue
+
+            if self._state == "open":
+                stripped = pending.lstrip(_WHITESPACE)
+                if not stripped:
+                    break
+                if stripped[0] != "{":
+                    # ```json の直後がJSONでなければ次のコードブロックを探す
+                    self._state = "search"
+                    pending = stripped
+                    continue
+                self._state = "json"
+                pending = stripped
+
+            for ch in pending:
+                self._scan(ch)
+                if self._state == "done":
+                    break
+            break
+        return self._events
+
+    def result(self):
+        """完成したJSONを返す（コードブロックが無ければ全文をJSONとして解釈し、解釈できなければ repair_json で修復、失敗時は None）"""
+        if self._state == "done":
+            try:
+                return json.loads("".join(self._json_chars))
+            except ValueError:
+                pass
+        try:
+            return json.loads(self.text)
+        except ValueError:
+            pass
+        # ```json ブロックがあればブロック内（閉じていない場合は末尾まで）を修復する
+        text = self.text
+        position = text.find(_FENCE)
+        return repair_json(text[position + len(_FENCE):] if position >= 0 else text)
+
+    def _search_fence(self, chunk):
+        """```json の開始位置を探し、それ以降の文字列を返す（チャンク境界をまたぐ場合にも対応）"""
+        buffer = self._tail + chunk
+        position = buffer.find(_FENCE)
+        if position < 0:
+            self._tail = buffer[-(len(_FENCE) - 1):]
+            return ""
+        self._tail = ""
+        self._state = "open"
+        return buffer[position + len(_FENCE):]
+
+    def _scan(self, ch):
+        self._json_chars.append(ch)
+        stack = self._stack
+
+        if self._in_string:
+            self._append(ch)
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if self._key_chars is not None:
+                    raw_key = "".join(self._key_chars)
+                    try:
+                        stack[-1].key = json.loads('"' + raw_key + '"')
+                    except ValueError:
+                        stack[-1].key = raw_key
+                    stack[-1].expect_key = False
+                    self._key_chars = None
+                return
+            if self._key_chars is not None:
+                self._key_chars.append(ch)
+            return
+
+        if ch in _WHITESPACE:
+            self._append(ch)
+            return
+
+        if ch in ",}]":
+            self._finish_scalars()
+            if ch == ",":
+                self._append(ch)
+                if stack[-1].kind == "{":
+                    stack[-1].expect_key = True
+                else:
+                    stack[-1].awaiting_value = True
+                return
+            self._append(ch)
+            stack.pop()
+            self._finish_containers()
+            if not stack:
+                self._state = "done"
+            return
+
+        if ch == ":":
+            self._append(ch)
+            stack[-1].awaiting_value = True
+            return
+
+        if stack and stack[-1].kind == "{" and stack[-1].expect_key:
+            if ch == '"':
+                self._in_string = True
+                self._key_chars = []
+            self._append(ch)
+            return
+
+        if stack and stack[-1].awaiting_value:
+            self._start_value(ch)
+
+        self._append(ch)
+        if ch == '"':
+            self._in_string = True
+        elif ch in "{[":
+            parent_key = stack[-1].key if stack and stack[-1].kind == "{" else None
+            stack.append(_Frame(ch, parent_key))
+
+    def _start_value(self, ch):
+        """値の開始位置で、監視対象のキー／配列要素であれば取り出しを開始"""
+        stack = self._stack
+        frame = stack[-1]
+        frame.awaiting_value = False
+        if frame.kind == "[":
+            frame.index += 1
+        depth = len(stack)
+        scalar = ch not in "{["
+        if depth == 1 and frame.key in self.keys:
+            self._captures.append(_Capture(frame.key, None, depth, scalar))
+        if depth == 2 and frame.kind == "[" and stack[0].kind == "{" and frame.key in self.items:
+            self._captures.append(_Capture(frame.key, frame.index, depth, scalar))
+
+    def _append(self, ch):
+        for capture in self._captures:
+            capture.chars.append(ch)
+
+    def _finish_scalars(self):
+        depth = len(self._stack)
+        self._finish(lambda c: c.scalar and c.depth == depth)
+
+    def _finish_containers(self):
+        depth = len(self._stack)
+        self._finish(lambda c: not c.scalar and c.depth == depth)
+
+    def _finish(self, predicate):
+        remaining = []
+        for capture in self._captures:
+            if not predicate(capture):
+                remaining.append(capture)
+                continue
+            try:
+                value = json.loads("".join(capture.chars))
+            except ValueError:
+                continue
+            event = {"key": capture.key, "data": value}
+            if capture.index is not None:
+                event["index"] = capture.index
+            self._events.append(event)
+        self._captures = remaining
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+def _close(chars, stack):
+    """末尾の空白・カンマを除き、開いている括弧を閉じた文字列"""
+    text = "".join(chars).rstrip(_WHITESPACE)
+    if text.endswith(","):
+        text = text[:-1]
+    return text + "".join(_CLOSERS[kind] for kind in reversed(stack))
+
+def repair_json(text):
+    """モデルの出力によくある崩れを修復してJSONとして解釈する（最初の { 以降が対象、修復できない場合は None）
+
+    - 末尾のカンマ（{"a": 1,} / [1, 2,]）を取り除く
+    - 文字列中のエスケープされていない引用符・改行をエスケープする
+      （引用符の後に続く文字が , } ] :（キーの場合）でなければ文字列の一部とみなす）
+    - 途中で切れた出力は開いている文字列・配列・オブジェクトを閉じる（書きかけの要素は捨てる）
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    end = text.find("\n```", start)
+    if end >= 0:
+        text = text[:end]
+    length = len(text)
+    chars = []
+    stack = []
+    # 書きかけの要素を捨てて閉じられる位置（その時点の chars の長さ, 開いている括弧）
+    safe = []
+    in_string = False
+    escape = False
+    is_key = False
+    last = ""
+
+    for i in range(start, length):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+                chars.append(ch)
+            elif ch == "\\":
+                escape = True
+                chars.append(ch)
+            elif ch == '"':
+                j = i + 1
+                while j < length and text[j] in _WHITESPACE:
+                    j += 1
+                following = text[j] if j < length else ""
+                if (following == ":") if is_key else (following in ("", ",", "}", "]")):
+                    in_string = False
+                    chars.append(ch)
+                    if not is_key:
+                        safe.append((len(chars), tuple(stack)))
+                else:
+                    chars.append('\\"')
+            elif ch == "\n":
+                chars.append("\\n")
+            elif ch == "\r":
+                chars.append("\\r")
+            elif ch == "\t":
+                chars.append("\\t")
+            else:
+                chars.append(ch)
+            continue
+
+        if ch in _WHITESPACE:
+            chars.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+            is_key = bool(stack) and stack[-1] == "{" and last in ("{", ",")
+            chars.append(ch)
+        elif ch in "{[":
+            stack.append(ch)
+            chars.append(ch)
+            safe.append((len(chars), tuple(stack)))
+        elif ch in "}]":
+            if not stack:
+                break
+            chars[:] = _close(chars, ())
+            chars.append(_CLOSERS[stack.pop()])
+            if not stack:
+                break
+            safe.append((len(chars), tuple(stack)))
+        elif ch == ",":
+            safe.append((len(chars), tuple(stack)))
+            chars.append(ch)
+        else:
+            chars.append(ch)
+        last = ch
+
+    if in_string:
+        # 途中で切れた文字列は閉じる（末尾の書きかけのエスケープは捨てる）
+        if escape:
+            chars.pop()
+        chars.append('"')
+    # 末尾でそのまま閉じられなければ、直前の要素までで閉じる
+    # （途中で切れた数値・true/false は 4 が 45 の書きかけの場合などがあるため、末尾では閉じない）
+    candidates = safe[::-1]
+    if in_string or "".join(chars).rstrip(_WHITESPACE)[-1:] in ('"', "}", "]"):
+        candidates.insert(0, (len(chars), tuple(stack)))
+    for candidate in candidates:
+        try:
+            return json.loads(_close(chars[:candidate[0]], candidate[1]))
+        except ValueError:
+            continue
+    return None
+
+def add_usage(usage, result):
+    """エージェントの実行結果のトークン使用量を usage に加算"""
+    metrics = getattr(result, "metrics", None)
+    accumulated = getattr(metrics, "accumulated_usage", None) or {}
+    for key, value in accumulated.items():
+        if isinstance(value, (int, float)):
+            usage[key] = usage.get(key, 0) + value
+
+async def stream_agent_json(agent, prompt, step, parser, usage=None):
+    """エージェントの応答をストリーミングしながらJSONを逐次解析する
+
+    テキストは stream イベント、parser で監視しているキーや配列要素が閉じるたびに partial イベントを返す。
+    応答全文と解析結果は parser.text / parser.result() で取得する。
+    usage を渡した場合はトークン使用量を加算する（キャッシュヒット時は加算されない）。
+    最後に所要時間・最初のトークンまでの時間・トークン数・リトライ回数を metrics イベントで返す。
+    """
+    timer = CallTimer(step)
+    async for event in measure(cached_stream_async(agent, prompt, step), timer):
+        if "data" in event:
+            chunk = event["data"]
+            yield {"type": "stream", "step": step, "data": chunk}
+            for partial in parser.feed(chunk):
+                yield {"type": "partial", "step": step, **partial}
+        elif "result" in event and usage is not None:
+            add_usage(usage, event["result"])
+    yield metrics_event(timer.record)
@@ -4,6 +4,10 @@ from strands_tools import swarm
 import json
 import re
 import asyncio
+from json_stream import repair_json
+from llm_cache import cached_stream_async
+from model_registry import default_registry
+from telemetry import CallTimer, measure, metrics_event
 
 app = BedrockAgentCoreApp()
 
@@ -19,12 +23,16 @@ def extract_json(message):
     
     json_match = re.search(r'```json\s*({.*?})\s*```', text, re.DOTALL)
     if json_match:
-        return json.loads(json_match.group(1))
+        try:
+            return json.loads(json_match.group(1))
+        except ValueError:
+            pass
     
     try:
         return json.loads(text)
-    except:
-        return None
+    except ValueError:
+        # 末尾のカンマ・途中で切れた出力・エスケープされていない引用符などは修復して解釈する
+        return repair_json(text[text.find("```json") + len("```json"):] if "```json" in text else text)
 
 async def invoke_async_streaming(payload):
     """マルチエージェント政策システム（ストリーミング対応）"""
@@ -35,10 +43,13 @@ async def invoke_async_streaming(payload):
             yield {"type": "error", "data": "プロンプトが必要です"}
             return
         
+        # ステップごとのモデル割り当ての上書き（例: {"citizen": "fast"}）
+        models = default_registry.with_request_overrides(payload.get("models"))
+        
         yield {"type": "status", "data": "[ステップ1] SVエージェントがエージェント定義を生成中..."}
         
         sv_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("sv_agent"),
             callback_handler=None,
             system_prompt="""市民意見を分析し、政策検討に必要なエージェントを設計してください。
 
@@ -70,11 +81,13 @@ async def invoke_async_streaming(payload):
         )
         
         sv_response = ""
-        async for event in sv_agent.stream_async(f"市民意見: {user_message}"):
+        timer = CallTimer("sv_agent")
+        async for event in measure(cached_stream_async(sv_agent, f"市民意見: {user_message}", timer.step), timer):
             if "data" in event:
                 chunk = event["data"]
                 yield {"type": "stream", "step": "sv_agent", "data": chunk}
                 sv_response += chunk
+        yield metrics_event(timer.record)
         
         agent_defs = extract_json(sv_response)
         
@@ -86,7 +99,7 @@ async def invoke_async_streaming(payload):
         yield {"type": "status", "data": "[ステップ2] Swarmで政策立案エージェントを協調実行中..."}
         
         swarm_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("swarm"),
             tools=[swarm],
             callback_handler=None
         )
@@ -119,11 +132,13 @@ async def invoke_async_streaming(payload):
 """
         
         policy_response = ""
-        async for event in swarm_agent.stream_async(swarm_prompt):
+        timer = CallTimer("swarm")
+        async for event in measure(cached_stream_async(swarm_agent, swarm_prompt, timer.step), timer):
             if "data" in event:
                 chunk = event["data"]
                 yield {"type": "stream", "step": "swarm", "data": chunk}
                 policy_response += chunk
+        yield metrics_event(timer.record)
         
         policy_json = extract_json(policy_response)
         if not policy_json:
@@ -144,7 +159,7 @@ async def invoke_async_streaming(payload):
             yield {"type": "status", "data": f"市民{i+1}/{len(agent_defs['citizen_agents'])}: {agent_def['name']}"}
             
             citizen_agent = Agent(
-                model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+                model=models.model_for("citizen"),
                 system_prompt=agent_def["system_prompt"],
                 callback_handler=None
             )
@@ -171,11 +186,13 @@ async def invoke_async_streaming(payload):
             
             try:
                 eval_response = ""
-                async for event in citizen_agent.stream_async(eval_prompt):
+                timer = CallTimer(f"citizen_{i}")
+                async for event in measure(cached_stream_async(citizen_agent, eval_prompt, timer.step), timer):
                     if "data" in event:
                         chunk = event["data"]
                         yield {"type": "stream", "step": f"citizen_{i}", "data": chunk}
                         eval_response += chunk
+                yield metrics_event(timer.record)
                 
                 evaluation = extract_json(eval_response)
                 if evaluation:
@@ -2,8 +2,15 @@ from bedrock_agentcore import BedrockAgentCoreApp
 from strands import Agent
 from strands_tools import swarm
 import json
-import re
 import asyncio
+from json_stream import StreamingJSONParser, stream_agent_json
+from census_index import get_census_index
+from stream_fanout import DEFAULT_MAX_CONCURRENCY
+from persona_evaluation import evaluate_personas, CITIZEN, FUTURE, DEFAULT_EVALUATION_MODE, DEFAULT_BATCH_SIZE
+from pipeline_dag import Step, StepResult, PipelineAbort, run_dag
+from model_registry import default_registry
+from step_schemas import RESEARCH, DEMOGRAPHICS, AGENT_DEFS, POLICY, REVIEW, MIN_CITIZEN_AGENTS, reask_invalid_fields
+from telemetry import CallTimer, metrics_event
 
 app = BedrockAgentCoreApp()
 
@@ -17,29 +24,48 @@ def extract_json(message):
     else:
         text = str(message)
     
-    json_match = re.search(r'```json\s*({.*?})\s*```', text, re.DOTALL)
-    if json_match:
-        return json.loads(json_match.group(1))
-    
-    try:
-        return json.loads(text)
-    except:
-        return None
+    parser = StreamingJSONParser()
+    parser.feed(text)
+    return parser.result()
+
+def build_policy_summary(policy_json):
+    """市民評価・10年後評価で共通に使う政策概要テキスト"""
+    return f"""
+政策名: {policy_json.get('policy_title', 'N/A')}
+概要: {policy_json.get('summary', 'N/A')}
+推奨政策: {policy_json.get('recommended_policy', 'N/A')}
+参考事例: {', '.join(policy_json.get('referenced_policies', []))}
+"""
+
+def demographics_complete_text(demographics_data):
+    """人口動態調査の完了時に表示するテキスト"""
+    return f"\n\n【調査完了】対象地域: {demographics_data.get('target_area', '不明')}\n年齢分布: {json.dumps(demographics_data.get('age_distribution', {}), ensure_ascii=False)}\n性別比率: {json.dumps(demographics_data.get('gender_ratio', {}), ensure_ascii=False)}"
 
 async def invoke_async_streaming(payload):
     """マルチエージェント政策システム（拡張版・ストリーミング対応）"""
+    user_message = payload.get("prompt", "")
+    
+    if not user_message:
+        yield {"type": "error", "data": "プロンプトが必要です"}
+        return
+    
+    max_concurrency = payload.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+    # 市民評価のモード（per_persona: 1名ずつ / batched: batch_size 名ずつまとめて評価）
+    evaluation_mode = payload.get("evaluation_mode", DEFAULT_EVALUATION_MODE)
+    batch_size = payload.get("batch_size", DEFAULT_BATCH_SIZE)
+    # ステップごとのモデル割り当ての上書き（例: {"citizen": "fast", "future": "fast"}）
     try:
-        user_message = payload.get("prompt", "")
-        
-        if not user_message:
-            yield {"type": "error", "data": "プロンプトが必要です"}
-            return
-        
-        # ステップ0: 類似政策の調査
+        models = default_registry.with_request_overrides(payload.get("models"))
+    except ValueError as e:
+        yield {"type": "error", "data": str(e)}
+        return
+    
+    async def research_step():
+        """ステップ0: 類似政策の調査"""
         yield {"type": "status", "data": "[ステップ0] 他自治体の類似政策を調査中..."}
         
         research_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("research"),
             callback_handler=None,
             system_prompt="""あなたは自治体政策の調査専門家です。
 市民意見に関連する既存の政策事例を調査し、参考になる事例を提示してください。
@@ -61,22 +87,45 @@ async def invoke_async_streaming(payload):
 ```"""
         )
         
-        research_response = ""
-        async for event in research_agent.stream_async(f"市民意見: {user_message}\n\nまず大阪市の類似政策事例を調査してください。大阪市に事例がなければ他の市区町村や日本全国の事例を3つ程度調査してください。"):
-            if "data" in event:
-                chunk = event["data"]
-                yield {"type": "stream", "step": "research", "data": chunk}
-                research_response += chunk
+        research_parser = StreamingJSONParser(items=("similar_policies",))
+        async for event in stream_agent_json(research_agent, f"市民意見: {user_message}\n\nまず大阪市の類似政策事例を調査してください。大阪市に事例がなければ他の市区町村や日本全国の事例を3つ程度調査してください。", "research", research_parser):
+            yield event
         
-        research_result = extract_json(research_response) or {"similar_policies": [], "has_references": False}
+        research_result = RESEARCH.normalize(research_parser.result())
+        async for event in reask_invalid_fields(research_agent, RESEARCH, research_result, "research"):
+            yield event
         yield {"type": "research", "data": research_result}
         yield {"type": "stream", "step": "research_complete", "data": f"\n\n【調査完了】類似政策: {len(research_result.get('similar_policies', []))}件"}
+        yield StepResult(research_result)
+    
+    async def demographics_step():
+        """ステップ1a: 人口動態調査（統計データの索引があれば索引から取得し、モデルには推定させない）"""
+        census = get_census_index()
+        if census is not None:
+            yield {"type": "status", "data": "[ステップ1a] 対象地域の人口動態を統計データから取得中..."}
+            row = census.find_area(user_message)
+            if row is None:
+                # 市民意見から地域名を特定できない場合のみ、モデルに地域名だけを答えさせる
+                area_agent = Agent(
+                    model=models.model_for("demographics"),
+                    callback_handler=None,
+                    system_prompt="市民意見が対象としている地域名（市区町村名。政令指定都市の場合は区名まで）だけを出力してください。特定できない場合は「大阪市」と出力してください。"
+                )
+                area_parser = StreamingJSONParser()
+                async for event in stream_agent_json(area_agent, f"市民意見: {user_message}", "demographics", area_parser):
+                    yield event
+                row = census.find_area(area_parser.text.strip()) or census.find_area("大阪市")
+            if row is not None:
+                demographics_data = census.demographics(row)
+                yield {"type": "demographics", "data": demographics_data}
+                yield {"type": "stream", "step": "demographics_complete", "data": demographics_complete_text(demographics_data)}
+                yield StepResult(demographics_data)
+                return
         
-        # ステップ1a: 人口動態調査
         yield {"type": "status", "data": "[ステップ1a] 対象地域の人口動態を調査中..."}
         
         demographics_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("demographics"),
             callback_handler=None,
             system_prompt="""あなたは人口統計の専門家です。
 市民意見から対象地域を特定し、その地域の人口動態を調査してください。
@@ -111,21 +160,26 @@ async def invoke_async_streaming(payload):
 ```"""
         )
         
-        demographics_response = ""
-        async for event in demographics_agent.stream_async(f"市民意見: {user_message}\n\nまず大阪市の人口動態を調査してください。大阪市のデータが不明な場合は他の市区町村や日本全体の統計を使用してください。"):
-            if "data" in event:
-                chunk = event["data"]
-                yield {"type": "stream", "step": "demographics", "data": chunk}
-                demographics_response += chunk
-        
-        demographics_data = extract_json(demographics_response)
-        if not demographics_data:
-            yield {"type": "error", "data": "人口動態データの取得に失敗しました"}
-            return
+        demographics_parser = StreamingJSONParser()
+        async for event in stream_agent_json(demographics_agent, f"市民意見: {user_message}\n\nまず大阪市の人口動態を調査してください。大阪市のデータが不明な場合は他の市区町村や日本全体の統計を使用してください。", "demographics", demographics_parser):
+            yield event
+        
+        # 形式を満たさない項目だけを聞き直し、それでも一部が欠ける場合は得られた項目だけで続行する
+        demographics_data = DEMOGRAPHICS.normalize(demographics_parser.result())
+        async for event in reask_invalid_fields(demographics_agent, DEMOGRAPHICS, demographics_data, "demographics"):
+            yield event
+        missing = DEMOGRAPHICS.invalid(demographics_data, required_only=True)
+        if len(missing) == len([field for field in DEMOGRAPHICS.fields if field.required]):
+            raise PipelineAbort("人口動態データの取得に失敗しました")
+        if missing:
+            yield {"type": "status", "data": f"[ステップ1a] {'、'.join(field.name for field in missing)} を取得できなかったため、取得できた項目で続行します"}
         yield {"type": "demographics", "data": demographics_data}
-        yield {"type": "stream", "step": "demographics_complete", "data": f"\n\n【調査完了】対象地域: {demographics_data.get('target_area', '不明')}\n年齢分布: {json.dumps(demographics_data.get('age_distribution', {}), ensure_ascii=False)}\n性別比率: {json.dumps(demographics_data.get('gender_ratio', {}), ensure_ascii=False)}"}
-        
-        # ステップ1b: SVエージェントがエージェント定義を生成（調査した人口動態に基づく）
+        yield {"type": "stream", "step": "demographics_complete", "data": demographics_complete_text(demographics_data)}
+        yield StepResult(demographics_data)
+    
+    async def agent_defs_step(demographics):
+        """ステップ1b: SVエージェントがエージェント定義を生成（調査した人口動態に基づく）"""
+        demographics_data = demographics
         yield {"type": "status", "data": "[ステップ1b] エージェント定義を生成中（調査した人口動態に基づく、最低10名）..."}
         
         demographics_text = f"""
@@ -136,7 +190,7 @@ async def invoke_async_streaming(payload):
 """
         
         sv_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("sv_agent"),
             callback_handler=None,
             system_prompt="""市民意見を分析し、政策検討に必要なエージェントを設計してください。
 
@@ -171,26 +225,38 @@ async def invoke_async_streaming(payload):
 注意: is_directly_affected は政策の直接的な恩恵を受けるかどうかを示します（true=恩恵を受ける、false=恩恵を受けない/関係ない層）"""
         )
         
-        sv_response = ""
-        async for event in sv_agent.stream_async(f"市民意見: {user_message}\n\n人口動態データ:\n{demographics_text}"):
-            if "data" in event:
-                chunk = event["data"]
-                yield {"type": "stream", "step": "sv_agent", "data": chunk}
-                sv_response += chunk
+        sv_parser = StreamingJSONParser(items=("citizen_agents",), keys=("policy_agents",))
+        policy_agents_published = False
+        async for event in stream_agent_json(sv_agent, f"市民意見: {user_message}\n\n人口動態データ:\n{demographics_text}", "sv_agent", sv_parser):
+            yield event
+            if event["type"] == "partial" and event["key"] == "policy_agents" and not policy_agents_published:
+                # 政策立案エージェントの定義が閉じた時点で、市民エージェントの生成を待たずにSwarmを開始する
+                policy_agents_published = True
+                yield StepResult(event["data"], "policy_agents")
         
-        agent_defs = extract_json(sv_response)
+        # 形式を満たさない定義は取り除き、欠けた項目や不足した市民エージェントの分だけを聞き直す
+        agent_defs = AGENT_DEFS.normalize(sv_parser.result())
+        async for event in reask_invalid_fields(sv_agent, AGENT_DEFS, agent_defs, "sv_agent"):
+            yield event
         
-        if not agent_defs or len(agent_defs.get("citizen_agents", [])) < 10:
-            yield {"type": "error", "data": "エージェント定義の生成に失敗しました（市民エージェントが10名未満）"}
-            return
+        if not agent_defs.get("policy_agents") or not agent_defs.get("citizen_agents"):
+            raise PipelineAbort("エージェント定義の生成に失敗しました（政策立案エージェントまたは市民エージェントがいません）")
+        if len(agent_defs["citizen_agents"]) < MIN_CITIZEN_AGENTS:
+            yield {"type": "status", "data": f"[ステップ1b] 市民エージェントが{MIN_CITIZEN_AGENTS}名に満たないため、生成できた{len(agent_defs['citizen_agents'])}名で続行します"}
+        
+        if not policy_agents_published:
+            yield StepResult(agent_defs.get("policy_agents", []), "policy_agents")
         
         # is_directly_affectedフィールドの確認と警告
         unaffected_count = sum(1 for a in agent_defs.get("citizen_agents", []) if a.get("is_directly_affected") == False)
         yield {"type": "status", "data": f"[ステップ1b] 生成完了: 市民エージェント{len(agent_defs.get('citizen_agents', []))}名（うち政策対象外{unaffected_count}名）"}
         
         yield {"type": "agent_defs", "data": agent_defs}
-        
-        # ステップ2: Swarmで政策立案（類似政策を参考に）
+        yield StepResult(agent_defs)
+    
+    async def policy_step(policy_agents, research):
+        """ステップ2: Swarmで政策立案（類似政策を参考に）"""
+        research_result = research
         yield {"type": "status", "data": "[ステップ2] 政策立案エージェントが協調実行中..."}
         
         reference_text = ""
@@ -198,7 +264,7 @@ async def invoke_async_streaming(payload):
             reference_text = f"\n\n参考事例:\n{json.dumps(research_result['similar_policies'], ensure_ascii=False, indent=2)}\n上記事例を参考にしてください。"
         
         swarm_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("swarm"),
             tools=[swarm],
             callback_handler=None
         )
@@ -206,7 +272,7 @@ async def invoke_async_streaming(payload):
         swarm_prompt = f"""以下のエージェント定義に基づいてswarmを作成し、市民意見「{user_message}」に対する政策案をJSON形式で作成してください。
 
 エージェント定義:
-{json.dumps(agent_defs['policy_agents'], ensure_ascii=False, indent=2)}
+{json.dumps(policy_agents, ensure_ascii=False, indent=2)}
 {reference_text}
 
 出力形式:
@@ -223,24 +289,28 @@ async def invoke_async_streaming(payload):
 }}
 ```"""
         
-        policy_response = ""
-        async for event in swarm_agent.stream_async(swarm_prompt):
-            if "data" in event:
-                chunk = event["data"]
-                yield {"type": "stream", "step": "swarm", "data": chunk}
-                policy_response += chunk
+        policy_parser = StreamingJSONParser()
+        async for event in stream_agent_json(swarm_agent, swarm_prompt, "swarm", policy_parser):
+            yield event
         
-        policy_json = extract_json(policy_response)
-        if not policy_json:
-            policy_json = {"raw_text": policy_response}
+        policy_json = POLICY.normalize(policy_parser.result())
+        async for event in reask_invalid_fields(swarm_agent, POLICY, policy_json, "swarm"):
+            yield event
+        if POLICY.invalid(policy_json, required_only=True):
+            policy_json["raw_text"] = policy_parser.text
         
         yield {"type": "policy", "data": policy_json}
-        
-        # ステップ3: レビュアーによる法律・実現性チェック（最大3回再試行）
+        # 改善時は同じ会話履歴を持つswarmエージェントを使い続ける
+        yield StepResult(swarm_agent, "swarm_agent")
+        yield StepResult(policy_json, "policy")
+    
+    async def review_step(policy, swarm_agent, agent_defs):
+        """ステップ3: レビュアーによる法律・実現性チェック（最大3回再試行）"""
+        policy_json = policy
         yield {"type": "status", "data": "[ステップ3] レビュアーが法律・実現性をチェック中..."}
         
         reviewer_agent = Agent(
-            model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+            model=models.model_for("reviewer"),
             system_prompt=agent_defs.get("reviewer_agent", {}).get("system_prompt", "法律と実現性の観点でレビューしてください"),
             callback_handler=None
         )
@@ -265,14 +335,13 @@ async def invoke_async_streaming(payload):
 }}
 ```"""
             
-            review_response = ""
-            async for event in reviewer_agent.stream_async(review_prompt):
-                if "data" in event:
-                    chunk = event["data"]
-                    yield {"type": "stream", "step": f"reviewer_attempt_{attempt}", "data": chunk}
-                    review_response += chunk
+            review_parser = StreamingJSONParser()
+            async for event in stream_agent_json(reviewer_agent, review_prompt, f"reviewer_attempt_{attempt}", review_parser):
+                yield event
             
-            review_result = extract_json(review_response) or {"approved": False}
+            review_result = REVIEW.normalize(review_parser.result())
+            async for event in reask_invalid_fields(reviewer_agent, REVIEW, review_result, f"reviewer_attempt_{attempt}"):
+                yield event
             yield {"type": "review", "data": {**review_result, "attempt": attempt}}
             
             if review_result.get("approved", False):
@@ -293,133 +362,85 @@ async def invoke_async_streaming(payload):
 
 改善提案に基づいて政策案を修正してください。出力形式は元の政策案と同じJSON形式です。"""
                 
-                policy_response = ""
-                async for event in swarm_agent.stream_async(improvement_prompt):
-                    if "data" in event:
-                        chunk = event["data"]
-                        yield {"type": "stream", "step": f"improvement_{attempt}", "data": chunk}
-                        policy_response += chunk
+                policy_parser = StreamingJSONParser()
+                async for event in stream_agent_json(swarm_agent, improvement_prompt, f"improvement_{attempt}", policy_parser):
+                    yield event
                 
-                improved_policy = extract_json(policy_response)
+                improved_policy = POLICY.normalize(policy_parser.result())
                 if improved_policy:
+                    async for event in reask_invalid_fields(swarm_agent, POLICY, improved_policy, f"improvement_{attempt}"):
+                        yield event
+                if improved_policy and not POLICY.invalid(improved_policy, required_only=True):
                     policy_json = improved_policy
                     yield {"type": "policy", "data": {**policy_json, "improved": True, "attempt": attempt}}
             else:
                 yield {"type": "status", "data": "[ステップ3] 3回目も承認されませんでしたが、処理を続行します"}
         
         yield {"type": "review_final", "data": review_result}
-        
-        # ステップ4: 市民評価（濃い評価）
+        yield StepResult(policy_json, "reviewed_policy")
+        yield StepResult(review_result, "review_result")
+    
+    async def citizen_step(reviewed_policy, agent_defs):
+        """ステップ4: 市民評価（濃い評価）"""
         yield {"type": "status", "data": "[ステップ4] 市民エージェントが評価中..."}
         
-        policy_summary = f"""
-政策名: {policy_json.get('policy_title', 'N/A')}
-概要: {policy_json.get('summary', 'N/A')}
-推奨政策: {policy_json.get('recommended_policy', 'N/A')}
-参考事例: {', '.join(policy_json.get('referenced_policies', []))}
-"""
+        citizen_defs = agent_defs["citizen_agents"]
+        citizen_results = [None] * len(citizen_defs)
+        # 全市民の評価を同時実行数の上限付きで並列実行し、トークンストリームを1本にまとめて返す
+        async for event in evaluate_personas(CITIZEN, build_policy_summary(reviewed_policy), citizen_defs, citizen_results,
+                                             evaluation_mode, batch_size, max_concurrency,
+                                             model=models.model_for("citizen")):
+            yield event
         
-        citizen_evaluations = []
+        # 完了順ではなく市民の並び順で結果をまとめる
+        yield StepResult([r for r in citizen_results if r is not None])
+    
+    async def future_step(reviewed_policy, agent_defs):
+        """ステップ5: 10年後評価（一時的政策でない場合、ステップ4の結果には依存しない）"""
+        if reviewed_policy.get("is_temporary", False):
+            yield StepResult([])
+            return
         
-        for i, agent_def in enumerate(agent_defs["citizen_agents"]):
-            yield {"type": "status", "data": f"市民{i+1}/{len(agent_defs['citizen_agents'])}: {agent_def['name']}"}
-            
-            citizen_agent = Agent(
-                model="us.anthropic.claude-sonnet-4-20250514-v1:0",
-                system_prompt=agent_def["system_prompt"],
-                callback_handler=None
-            )
-            
-            eval_prompt = f"""{policy_summary}
-
-あなたの立場: {agent_def['profile']}
-年齢: {agent_def['age']}歳、性別: {agent_def.get('gender', '不明')}、家族: {agent_def.get('family', '不明')}
-
-上記の政策案を詳細に評価してください。
-
-出力形式:
-```json
-{{
-  "evaluator_name": "{agent_def['name']}",
-  "overall_rating": 3,
-  "detailed_evaluation": {{
-    "personal_impact": {{"score": 3, "reason": "自分への影響"}},
-    "family_impact": {{"score": 3, "reason": "家族への影響"}},
-    "community_impact": {{"score": 3, "reason": "地域への影響"}},
-    "fairness": {{"score": 3, "reason": "公平性"}},
-    "sustainability": {{"score": 3, "reason": "持続可能性"}}
-  }},
-  "expectations": "期待すること（具体的に200文字程度）",
-  "concerns": "懸念すること（具体的に200文字程度）",
-  "recommendations": "提言（具体的に200文字程度）",
-  "personal_story": "この政策が自分の生活にどう影響するか（具体的なエピソード）"
-}}
-```"""
-            
-            try:
-                eval_response = ""
-                async for event in citizen_agent.stream_async(eval_prompt):
-                    if "data" in event:
-                        chunk = event["data"]
-                        yield {"type": "stream", "step": f"citizen_{i}", "data": chunk}
-                        eval_response += chunk
-                
-                evaluation = extract_json(eval_response)
-                if evaluation:
-                    evaluation["is_directly_affected"] = agent_def.get("is_directly_affected", True)
-                    citizen_evaluations.append(evaluation)
-                    yield {"type": "evaluation", "data": evaluation}
-            except Exception as e:
-                citizen_evaluations.append({"evaluator_name": agent_def['name'], "error": str(e), "is_directly_affected": agent_def.get("is_directly_affected", True)})
-        
-        # ステップ5: 10年後評価（一時的政策でない場合）
-        future_evaluations = []
-        if not policy_json.get("is_temporary", False):
-            yield {"type": "status", "data": "[ステップ5] 10年後の評価をシミュレーション中..."}
-            
-            for i, agent_def in enumerate(agent_defs["citizen_agents"][:5]):  # 代表5名
-                yield {"type": "status", "data": f"10年後評価 {i+1}/5: {agent_def['name']}"}
-                
-                citizen_agent = Agent(
-                    model="us.anthropic.claude-sonnet-4-20250514-v1:0",
-                    system_prompt=agent_def["system_prompt"],
-                    callback_handler=None
-                )
-                
-                future_prompt = f"""{policy_summary}
-
-あなたは10年後の{agent_def['age']+10}歳になっています。
-この政策が実施されて10年が経過しました。
-
-10年間の変化と現在の評価を述べてください。
-
-出力形式:
-```json
-{{
-  "evaluator_name": "{agent_def['name']} (10年後)",
-  "age_now": {agent_def['age']+10},
-  "ten_year_rating": 3,
-  "changes_observed": "10年間で観察された変化",
-  "long_term_impact": "長期的な影響の評価",
-  "unexpected_outcomes": "予想外の結果",
-  "current_opinion": "現在の意見"
-}}
-```"""
-                
-                try:
-                    future_response = ""
-                    async for event in citizen_agent.stream_async(future_prompt):
-                        if "data" in event:
-                            chunk = event["data"]
-                            yield {"type": "stream", "step": f"future_{i}", "data": chunk}
-                            future_response += chunk
-                    
-                    future_eval = extract_json(future_response)
-                    if future_eval:
-                        future_evaluations.append(future_eval)
-                        yield {"type": "future_evaluation", "data": future_eval}
-                except Exception as e:
-                    pass
+        yield {"type": "status", "data": "[ステップ5] 10年後の評価をシミュレーション中..."}
+        
+        future_defs = agent_defs["citizen_agents"][:5]  # 代表5名
+        future_results = [None] * len(future_defs)
+        async for event in evaluate_personas(FUTURE, build_policy_summary(reviewed_policy), future_defs, future_results,
+                                             evaluation_mode, batch_size, max_concurrency,
+                                             model=models.model_for("future")):
+            yield event
+        
+        yield StepResult([r for r in future_results if r is not None])
+    
+    # 各ステップは必要な入力だけを宣言し、依存関係のないステップは並列に実行される
+    #   research ──────────────────────────┐
+    #   demographics → agent_defs(policy_agents) → policy → review → citizen_evaluations
+    #                                                             └→ future_evaluations
+    # policy は SVエージェントの出力のうち policy_agents が閉じた時点で開始する
+    steps = [
+        Step("research", research_step),
+        Step("demographics", demographics_step),
+        Step("agent_defs", agent_defs_step, inputs=("demographics",), outputs=("agent_defs", "policy_agents")),
+        Step("policy", policy_step, inputs=("policy_agents", "research"), outputs=("policy", "swarm_agent")),
+        Step("review", review_step, inputs=("policy", "swarm_agent", "agent_defs"), outputs=("reviewed_policy", "review_result")),
+        Step("citizen_evaluations", citizen_step, inputs=("reviewed_policy", "agent_defs")),
+        Step("future_evaluations", future_step, inputs=("reviewed_policy", "agent_defs")),
+    ]
+    
+    # 実行全体の所要時間（各ステップ・各モデル呼び出しの計測値は metrics イベントとして流れる）
+    timer = CallTimer("pipeline", kind="entrypoint")
+    try:
+        results = {}
+        async for event in run_dag(steps, results):
+            yield event
+        
+        research_result = results["research"]
+        demographics_data = results["demographics"]
+        agent_defs = results["agent_defs"]
+        policy_json = results["reviewed_policy"]
+        review_result = results["review_result"]
+        citizen_evaluations = results["citizen_evaluations"]
+        future_evaluations = results["future_evaluations"]
         
         result_json = {
             "status": "success",
@@ -443,9 +464,14 @@ async def invoke_async_streaming(payload):
             }
         }
         
+        yield metrics_event(timer.finish())
         yield {"type": "complete", "data": result_json}
     
+    except PipelineAbort as e:
+        yield metrics_event(timer.finish(error=e))
+        yield {"type": "error", "data": str(e)}
     except Exception as e:
+        yield metrics_event(timer.finish(error=e))
         import traceback
         error_msg = f"{str(e)}\n{traceback.format_exc()}"
         yield {"type": "error", "data": f"エラーが発生しました: {str(e)}"}
@@ -0,0 +1,405 @@
+import asyncio
+import os
+import time
+from strands import Agent
+from json_stream import StreamingJSONParser, stream_agent_json
+from stream_fanout import merge_streams, DEFAULT_MAX_CONCURRENCY
+from model_registry import model_for
+from telemetry import cache_metrics_event
+from step_schemas import CITIZEN_EVALUATION, FUTURE_EVALUATION, reask_invalid_fields
+
+# 評価モード
+#   per_persona: 市民1名ごとに1回モデルを呼び出す（既定）
+#   batched: K名分をまとめて1回で評価し、政策概要などの共通部分の送信を1回にする
+EVALUATION_MODES = ("per_persona", "batched")
+DEFAULT_EVALUATION_MODE = os.environ.get("EVALUATION_MODE", "per_persona")
+DEFAULT_BATCH_SIZE = int(os.environ.get("EVALUATION_BATCH_SIZE", "5"))
+
+# 共通部分（政策概要・出力形式）をプロンプトの先頭にまとめ、Bedrockのプロンプトキャッシュの対象にする
+#   "0" で無効化（キャッシュ非対応のモデルを使う場合など）
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE_ENABLED", "1") != "0"
+
+SINGLE_SYSTEM_PROMPT = """あなたは市民の立場になりきって政策を評価するシミュレーターです。
+メッセージで指定された市民の立場・価値観・生活状況だけに基づいて、率直な評価を行ってください。"""
+
+BATCH_SYSTEM_PROMPT = """あなたは複数の市民の立場になりきって政策を評価するシミュレーターです。
+指定された各市民について、その市民の立場・価値観・生活状況だけに基づいて、互いに独立した率直な評価を行ってください。"""
+
+CITIZEN_EVALUATION_FORMAT = """{
+  "evaluator_name": "市民の名前",
+  "overall_rating": 3,
+  "detailed_evaluation": {
+    "personal_impact": {"score": 3, "reason": "自分への影響"},
+    "family_impact": {"score": 3, "reason": "家族への影響"},
+    "community_impact": {"score": 3, "reason": "地域への影響"},
+    "fairness": {"score": 3, "reason": "公平性"},
+    "sustainability": {"score": 3, "reason": "持続可能性"}
+  },
+  "expectations": "期待すること（具体的に200文字程度）",
+  "concerns": "懸念すること（具体的に200文字程度）",
+  "recommendations": "提言（具体的に200文字程度）",
+  "personal_story": "この政策が自分の生活にどう影響するか（具体的なエピソード）"
+}"""
+
+FUTURE_EVALUATION_FORMAT = """{
+  "evaluator_name": "市民の名前 (10年後)",
+  "age_now": 10年後の年齢,
+  "ten_year_rating": 3,
+  "changes_observed": "10年間で観察された変化",
+  "long_term_impact": "長期的な影響の評価",
+  "unexpected_outcomes": "予想外の結果",
+  "current_opinion": "現在の意見"
+}"""
+
+def shared_system_prompt(text):
+    """全市民で共通のシステムプロンプト（末尾にキャッシュポイントを置き、2件目以降はキャッシュから読み込ませる）"""
+    if not PROMPT_CACHE_ENABLED:
+        return text
+    return [{"text": text}, {"cachePoint": {"type": "default"}}]
+
+def _indent(text, prefix="      "):
+    return "\n".join(prefix + line if line else line for line in text.split("\n"))
+
+def citizen_shared_prompt(policy_summary):
+    """ステップ4: 市民1名ずつの評価で共通の部分（政策概要・出力形式）"""
+    return f"""{SINGLE_SYSTEM_PROMPT}
+
+{policy_summary}
+
+メッセージで指定された市民の立場から、上記の政策案を詳細に評価してください。
+
+出力形式（evaluator_name は指定された市民の名前と完全に一致させる）:
+```json
+{CITIZEN_EVALUATION_FORMAT}
+```"""
+
+def future_shared_prompt(policy_summary):
+    """ステップ5: 市民1名ずつの10年後評価で共通の部分（政策概要・出力形式）"""
+    return f"""{SINGLE_SYSTEM_PROMPT}
+
+{policy_summary}
+
+この政策が実施されて10年が経過しました。メッセージで指定された市民（年齢は10年後のもの）の立場から、10年間の変化と現在の評価を述べてください。
+
+出力形式（evaluator_name は「名前 (10年後)」とする）:
+```json
+{FUTURE_EVALUATION_FORMAT}
+```"""
+
+def citizen_batch_shared_prompt(policy_summary):
+    """ステップ4: 複数の市民をまとめて評価する場合の共通部分"""
+    return f"""{BATCH_SYSTEM_PROMPT}
+
+{policy_summary}
+
+メッセージで指定された市民それぞれの立場から、上記の政策案を個別に詳細に評価してください。
+
+出力形式（evaluations には指定された市民全員分を市民1から順に含め、evaluator_name は各市民の名前と完全に一致させる）:
+```json
+{{
+  "evaluations": [
+{_indent(CITIZEN_EVALUATION_FORMAT, "    ")}
+  ]
+}}
+```"""
+
+def future_batch_shared_prompt(policy_summary):
+    """ステップ5: 複数の市民の10年後評価をまとめて行う場合の共通部分"""
+    return f"""{BATCH_SYSTEM_PROMPT}
+
+{policy_summary}
+
+この政策が実施されて10年が経過しました。メッセージで指定された市民（年齢は10年後のもの）それぞれの立場から、10年間の変化と現在の評価を個別に述べてください。
+
+出力形式（evaluations には指定された市民全員分を市民1から順に含め、evaluator_name は「名前 (10年後)」とする）:
+```json
+{{
+  "evaluations": [
+{_indent(FUTURE_EVALUATION_FORMAT, "    ")}
+  ]
+}}
+```"""
+
+def _persona_profile(agent_def, age_offset=0):
+    return f"""名前: {agent_def['name']}
+立場: {agent_def['profile']}
+年齢: {agent_def['age'] + age_offset}歳、性別: {agent_def.get('gender', '不明')}、家族: {agent_def.get('family', '不明')}
+評価の視点: {agent_def.get('system_prompt', '')}"""
+
+def _persona_block(number, agent_def, age_offset=0):
+    return f"市民{number}:\n{_persona_profile(agent_def, age_offset)}"
+
+def citizen_persona_prompt(agent_def):
+    """ステップ4: 市民1名分の評価で市民ごとに異なる部分"""
+    return f"""あなたの立場:
+{_persona_profile(agent_def)}"""
+
+def future_persona_prompt(agent_def):
+    """ステップ5: 市民1名分の10年後評価で市民ごとに異なる部分"""
+    return f"""あなたの立場（10年後の{agent_def['age'] + 10}歳）:
+{_persona_profile(agent_def, age_offset=10)}"""
+
+def citizen_batch_prompt(agent_defs):
+    """ステップ4: まとめて評価する市民の一覧"""
+    personas = "\n\n".join(_persona_block(n, a) for n, a in enumerate(agent_defs, 1))
+    return f"""評価する市民（{len(agent_defs)}名）:
+
+{personas}"""
+
+def future_batch_prompt(agent_defs):
+    """ステップ5: まとめて10年後評価を行う市民の一覧"""
+    personas = "\n\n".join(_persona_block(n, a, age_offset=10) for n, a in enumerate(agent_defs, 1))
+    return f"""評価する市民（{len(agent_defs)}名、年齢は10年後のもの）:
+
+{personas}"""
+
+def valid_citizen_evaluation(evaluation, agent_def):
+    """まとめて評価した結果の1件が評価形式（step_schemas.CITIZEN_EVALUATION）を満たし、その市民のものか"""
+    return (
+        isinstance(evaluation, dict)
+        and agent_def['name'] in str(evaluation.get("evaluator_name", ""))
+        and not CITIZEN_EVALUATION.invalid(evaluation, required_only=True)
+    )
+
+def valid_future_evaluation(evaluation, agent_def):
+    """まとめて評価した10年後評価の1件が形式（step_schemas.FUTURE_EVALUATION）を満たし、その市民のものか"""
+    return (
+        isinstance(evaluation, dict)
+        and agent_def['name'] in str(evaluation.get("evaluator_name", ""))
+        and not FUTURE_EVALUATION.invalid(evaluation, required_only=True)
+    )
+
+class EvaluationKind:
+    """評価の種類（ステップ4の市民評価 / ステップ5の10年後評価）ごとの設定"""
+    def __init__(self, step, label, status_format, event_type, shared_prompt, persona_prompt, batch_shared_prompt, batch_prompt,
+                 schema, validate, annotate=None, keep_errors=False):
+        self.step = step
+        self.label = label
+        self.status_format = status_format
+        self.event_type = event_type
+        # shared_prompt / batch_shared_prompt: 全員で共通の部分（システムプロンプト、キャッシュ対象）
+        # persona_prompt / batch_prompt: 市民ごとに異なる部分（メッセージ）
+        self.shared_prompt = shared_prompt
+        self.persona_prompt = persona_prompt
+        self.batch_shared_prompt = batch_shared_prompt
+        self.batch_prompt = batch_prompt
+        # schema: 1名分の評価の形式（形式を満たさない項目だけを聞き直す） / validate: まとめて評価した要素の検証
+        self.schema = schema
+        self.validate = validate
+        self.annotate = annotate or (lambda evaluation, agent_def: evaluation)
+        self.keep_errors = keep_errors
+
+def _annotate_citizen(evaluation, agent_def):
+    evaluation["is_directly_affected"] = agent_def.get("is_directly_affected", True)
+    return evaluation
+
+CITIZEN = EvaluationKind(
+    "citizen", "市民", "市民{number}/{total}: {name}", "evaluation",
+    citizen_shared_prompt, citizen_persona_prompt, citizen_batch_shared_prompt, citizen_batch_prompt,
+    CITIZEN_EVALUATION, valid_citizen_evaluation, _annotate_citizen, keep_errors=True
+)
+FUTURE = EvaluationKind(
+    "future", "10年後評価", "10年後評価 {number}/{total}: {name}", "future_evaluation",
+    future_shared_prompt, future_persona_prompt, future_batch_shared_prompt, future_batch_prompt,
+    FUTURE_EVALUATION, valid_future_evaluation
+)
+
+class StepMetrics:
+    """評価ステップのモデル呼び出しの集計（トークン数・プロンプトキャッシュの読み書き・最初のトークンまでの時間）"""
+    def __init__(self):
+        self.requests = 0
+        self.usage = {}
+        self.ttft = []
+
+    def record(self, usage, ttft):
+        if usage:
+            self.requests += 1
+            for key, value in usage.items():
+                self.usage[key] = self.usage.get(key, 0) + value
+        if ttft is not None:
+            self.ttft.append(ttft)
+
+    def summary(self):
+        input_tokens = self.usage.get("inputTokens", 0)
+        cache_read = self.usage.get("cacheReadInputTokens", 0)
+        cache_write = self.usage.get("cacheWriteInputTokens", 0)
+        prompt_tokens = input_tokens + cache_read + cache_write
+        ttft = sorted(self.ttft)
+        return {
+            "requests": self.requests,
+            "inputTokens": input_tokens,
+            "outputTokens": self.usage.get("outputTokens", 0),
+            "cacheReadInputTokens": cache_read,
+            "cacheWriteInputTokens": cache_write,
+            # プロンプトのうちキャッシュから読み込んだ割合
+            "cache_hit_ratio": round(cache_read / prompt_tokens, 3) if prompt_tokens else 0.0,
+            "ttft_ms": {
+                "median": round(ttft[len(ttft) // 2] * 1000) if ttft else None,
+                "max": round(ttft[-1] * 1000) if ttft else None,
+            },
+        }
+
+async def evaluate_personas(kind, policy_summary, agent_defs, results, mode=None, batch_size=None,
+                            max_concurrency=DEFAULT_MAX_CONCURRENCY, usage=None, model=None):
+    """市民エージェント群による評価を実行し、イベントを1本のストリームとして返す
+
+    結果は results[i]（agent_defs と同じ並び、評価できなかった場合は None）に格納する。
+    per_persona モードでは評価が形式（kind.schema）を満たさない場合、形式を満たさない項目だけを聞き直す。
+    batched モードでは batch_size 名ずつまとめて評価し、形式を満たさない要素があった場合は
+    その市民だけを半分ずつに分割して再評価する（1名になっても失敗した場合は形式を満たさない項目だけを聞き直す）。
+    評価できなかった市民は kind.keep_errors の場合は error 付きの結果、それ以外は None のまま残す。
+    usage を渡した場合はモデル呼び出しのトークン使用量を加算する。
+    model を省略した場合は割り当て表（model_registry）で kind.step に割り当てたモデルを使う。
+
+    政策概要と出力形式は全員で共通のシステムプロンプトにまとめてキャッシュポイントを置き、
+    最初の1件が応答を返し始める（キャッシュが書き込まれる）まで残りの呼び出しを待たせる。
+    最後にステップのトークン数・キャッシュの読み書き・最初のトークンまでの時間を metrics イベントで返す。
+    """
+    mode = mode or DEFAULT_EVALUATION_MODE
+    model = model or model_for(kind.step)
+    batch_size = max(1, int(batch_size or DEFAULT_BATCH_SIZE))
+    total = len(agent_defs)
+    metrics = StepMetrics()
+    primed = asyncio.Event()
+    if not PROMPT_CACHE_ENABLED:
+        primed.set()
+
+    async def stream_model(agent, prompt, step, parser, leader):
+        """モデル呼び出し1回分（キャッシュの書き込み待ちと計測を含む）"""
+        if not leader:
+            await primed.wait()
+        call_usage = {}
+        started = time.perf_counter()
+        ttft = None
+        try:
+            async for event in stream_agent_json(agent, prompt, step, parser, call_usage):
+                if ttft is None and event["type"] == "stream":
+                    ttft = time.perf_counter() - started
+                    primed.set()
+                yield event
+        finally:
+            primed.set()
+            metrics.record(call_usage, ttft)
+            if usage is not None:
+                for key, value in call_usage.items():
+                    usage[key] = usage.get(key, 0) + value
+
+    def reask_stream(agent, prompt, step, parser):
+        return stream_model(agent, prompt, step, parser, leader=True)
+
+    async def complete_evaluation(agent, i, evaluation, step):
+        """1名分の評価の形式を満たさない項目だけを聞き直し、満たせば results[i] に格納する"""
+        agent_def = agent_defs[i]
+        evaluation = kind.schema.normalize(evaluation)
+        async for event in reask_invalid_fields(agent, kind.schema, evaluation, step, stream=reask_stream):
+            yield event
+        invalid = kind.schema.invalid(evaluation, required_only=True)
+        if not invalid:
+            results[i] = kind.annotate(evaluation, agent_def)
+            yield {"type": kind.event_type, "data": results[i]}
+            return
+        error = f"評価結果の形式が不正です（{'、'.join(field.name for field in invalid)}）"
+        yield {"type": "status", "data": f"{kind.label}: {agent_def['name']} の{error}"}
+        if kind.keep_errors:
+            results[i] = kind.annotate({"evaluator_name": agent_def['name'], "error": error}, agent_def)
+
+    def single_stream(i):
+        agent_def = agent_defs[i]
+
+        async def run():
+            yield {"type": "status", "data": kind.status_format.format(number=i + 1, total=total, name=agent_def['name'])}
+
+            agent = Agent(
+                model=model,
+                system_prompt=shared_system_prompt(kind.shared_prompt(policy_summary)),
+                callback_handler=None
+            )
+            try:
+                parser = StreamingJSONParser()
+                async for event in stream_model(agent, kind.persona_prompt(agent_def), f"{kind.step}_{i}", parser, leader=i == 0):
+                    yield event
+
+                async for event in complete_evaluation(agent, i, parser.result(), f"{kind.step}_{i}"):
+                    yield event
+            except Exception as e:
+                if kind.keep_errors:
+                    results[i] = kind.annotate({"evaluator_name": agent_def['name'], "error": str(e)}, agent_def)
+        return run
+
+    def batch_stream(indices):
+        async def run():
+            names = "、".join(agent_defs[i]['name'] for i in indices)
+            yield {"type": "status", "data": f"{kind.label} {indices[0]+1}〜{indices[-1]+1}/{total} をまとめて評価: {names}"}
+
+            agent = Agent(
+                model=model,
+                system_prompt=shared_system_prompt(kind.batch_shared_prompt(policy_summary)),
+                callback_handler=None
+            )
+            prompt = kind.batch_prompt([agent_defs[i] for i in indices])
+            step = f"{kind.step}_batch_{indices[0]}_{indices[-1]}"
+            parser = StreamingJSONParser(items=("evaluations",))
+            try:
+                async for event in stream_model(agent, prompt, step, parser, leader=indices[0] == 0):
+                    if event["type"] != "partial":
+                        yield event
+                        continue
+                    # 配列の要素が閉じるたびに検証し、形式を満たすものはすぐに評価イベントとして返す
+                    position = event["index"]
+                    if position < len(indices):
+                        i = indices[position]
+                        if results[i] is None and kind.validate(event["data"], agent_defs[i]):
+                            results[i] = kind.annotate(kind.schema.fill_defaults(event["data"]), agent_defs[i])
+                            yield {"type": kind.event_type, "data": results[i]}
+            except Exception as e:
+                yield {"type": "status", "data": f"{kind.label}のまとめて評価に失敗しました: {e}"}
+
+            # 出力が崩れていた（途中で切れた・末尾のカンマなど）要素は、修復した出力から取り出す
+            repaired = parser.result()
+            evaluations = repaired.get("evaluations") if isinstance(repaired, dict) else None
+            evaluations = evaluations if isinstance(evaluations, list) else []
+            for position, evaluation in enumerate(evaluations):
+                if position < len(indices):
+                    i = indices[position]
+                    if results[i] is None and kind.validate(evaluation, agent_defs[i]):
+                        results[i] = kind.annotate(kind.schema.fill_defaults(evaluation), agent_defs[i])
+                        yield {"type": kind.event_type, "data": results[i]}
+
+            failed = [i for i in indices if results[i] is None]
+            if not failed:
+                return
+            if len(indices) == 1:
+                # 1名分でも形式を満たさない場合は、その評価の形式を満たさない項目だけを聞き直す
+                i = indices[0]
+                try:
+                    async for event in complete_evaluation(agent, i, evaluations[0] if evaluations else None, step):
+                        yield event
+                except Exception as e:
+                    if kind.keep_errors:
+                        results[i] = kind.annotate({"evaluator_name": agent_defs[i]['name'], "error": str(e)}, agent_defs[i])
+                return
+
+            # 失敗した市民だけを半分ずつに分けて再評価する
+            yield {"type": "status", "data": f"{kind.label}: {len(failed)}名分を分割して再評価します"}
+            half = (len(failed) + 1) // 2
+            retries = [batch_stream(part) for part in (failed[:half], failed[half:]) if part]
+            async for event in merge_streams(retries, max_concurrency):
+                yield event
+        return run
+
+    if mode == "batched":
+        streams = [batch_stream(list(range(start, min(start + batch_size, total)))) for start in range(0, total, batch_size)]
+    else:
+        streams = [single_stream(i) for i in range(total)]
+
+    async for event in merge_streams(streams, max_concurrency):
+        yield event
+
+    summary = metrics.summary()
+    ttft = summary["ttft_ms"]["median"]
+    yield cache_metrics_event(kind.step, summary)
+    yield {"type": "status", "data": (
+        f"{kind.label}: {summary['requests']}回の呼び出し、入力{summary['inputTokens']}tok"
+        f"（キャッシュ読込{summary['cacheReadInputTokens']}tok / 書込{summary['cacheWriteInputTokens']}tok、"
+        f"ヒット率{summary['cache_hit_ratio']:.0%}）、最初のトークンまで中央値{'-' if ttft is None else ttft}ms"
+    )}
@@ -0,0 +1,99 @@
+import asyncio
+from stream_fanout import merge_streams
+from telemetry import CallTimer, metrics_event
+
+class StepResult:
+    """ステップが出力を公開するときに yield する値（name 省略時はステップ名の出力）"""
+    def __init__(self, value, name=None):
+        self.value = value
+        self.name = name
+
+class PipelineAbort(Exception):
+    """パイプライン全体を中断するときにステップから送出する例外（メッセージはエラーイベントになる）"""
+
+class Step:
+    """パイプラインの1ステップ
+
+    run は inputs に宣言した出力名をキーワード引数として受け取る非同期ジェネレータ。
+    通常のイベントはそのままストリームへ流し、StepResult で自身の outputs を公開する。
+    """
+    def __init__(self, name, run, inputs=(), outputs=None):
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs) if outputs else (name,)
+
+def _validate(steps):
+    """出力名の重複・未定義の入力・循環依存を検出"""
+    producers = {}
+    for step in steps:
+        for output in step.outputs:
+            if output in producers:
+                raise ValueError(f"出力 '{output}' が複数のステップで定義されています")
+            producers[output] = step
+
+    for step in steps:
+        for name in step.inputs:
+            if name not in producers:
+                raise ValueError(f"ステップ '{step.name}' の入力 '{name}' を出力するステップがありません")
+
+    visiting, visited = set(), set()
+
+    def visit(step):
+        if step.name in visited:
+            return
+        if step.name in visiting:
+            raise ValueError(f"ステップ '{step.name}' で循環依存が発生しています")
+        visiting.add(step.name)
+        for name in step.inputs:
+            visit(producers[name])
+        visiting.discard(step.name)
+        visited.add(step.name)
+
+    for step in steps:
+        visit(step)
+
+def _step_stream(step, results, ready):
+    """入力が揃うのを待ってからステップを実行するストリームを作成"""
+    async def run():
+        for name in step.inputs:
+            await ready[name].wait()
+
+        # 入力が揃ってから終了するまでの所要時間を計測する
+        timer = CallTimer(step.name, kind="step")
+        try:
+            async for item in step.run(**{name: results[name] for name in step.inputs}):
+                if isinstance(item, StepResult):
+                    output = item.name or step.name
+                    if output not in step.outputs:
+                        raise ValueError(f"ステップ '{step.name}' は出力 '{output}' を宣言していません")
+                    results[output] = item.value
+                    ready[output].set()
+                else:
+                    yield item
+        except BaseException as e:
+            timer.finish(error=e)
+            raise
+        yield metrics_event(timer.finish())
+
+        # 出力を公開せずに終了した場合は None として後続を進める
+        for output in step.outputs:
+            if not ready[output].is_set():
+                results[output] = None
+                ready[output].set()
+    return run
+
+async def run_dag(steps, results):
+    """依存関係に従ってステップを実行し、イベントを1本のストリームとして返す
+
+    依存関係のないステップは同時に実行されるため、全体の所要時間はクリティカルパスで決まる。
+    各ステップのイベントはそのステップが生成した順序のまま流れる。
+    ステップの出力は results（出力名 -> 値）に格納される。
+    いずれかのステップが例外を送出した場合は残りのステップを中断して例外を再送出する。
+    """
+    _validate(steps)
+    ready = {output: asyncio.Event() for step in steps for output in step.outputs}
+    streams = [_step_stream(step, results, ready) for step in steps]
+
+    async for event in merge_streams(streams, max_concurrency=len(streams) or 1):
+        yield event
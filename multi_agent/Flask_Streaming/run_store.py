@@ -0,0 +1,323 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+# 実行（run）ごとのイベントログ
+# /api/evaluate が返す全イベントを追記専用で保存し、切断後の再接続時に Last-Event-ID 以降を再送する
+# 書き込みは専用スレッドがまとめてコミットする（イベントループ側は連番を割り当ててキューに入れるだけ）
+# 購読者（SSE接続）へはキューで受け渡さず、各購読者が自分の速さでログを読む
+# パイプラインは遅いクライアントに待たされず、未送信のイベントはメモリではなくログに溜まる
+# 購読者は1接続1スレッドなので、同時に追従できる数を RUN_STORE_MAX_FOLLOWERS で制限する
+#
+# 環境変数:
+#   RUN_STORE_DB               保存先のSQLiteファイル（既定: runs.db）
+#   RUN_STORE_RETENTION_HOURS  最後の更新からこの時間が経った実行をイベントごと削除する（既定: 24、"0" で削除しない）
+#   RUN_STORE_MAX_FOLLOWERS    同時に追従できる購読者の上限（既定: 64、"0" で制限しない）
+
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# 1回のコミットにまとめる最大件数
+WRITE_BATCH_SIZE = 500
+# 古い実行を削除する間隔（秒）
+CLEANUP_INTERVAL = 600
+# イベントを書き込めなかった実行に追記するエラーの内容
+WRITE_ERROR = "実行ログへの書き込みに失敗したため、実行を中断扱いにしました"
+
+class RunStore:
+    """実行ごとのイベントを連番付きで保存する追記専用ログ
+
+    同一プロセス内の購読者にはコミットのたびに対象の実行の購読者だけに通知し、
+    別プロセス（複数ワーカー）で追記された分は poll_interval ごとの再読み込みで拾う。
+    append / finish は書き込みスレッドのキューに入れるだけで待たない（同じ実行の書き込み順は保たれる）。
+    """
+    def __init__(self, db_path, poll_interval=1.0, retention_hours=24.0, max_followers=64):
+        self.poll_interval = poll_interval
+        self.retention_hours = retention_hours
+        self._lock = threading.Lock()
+        self._waiters_lock = threading.Lock()
+        self._waiters = {}  # run_id -> [Condition, 待っている購読者の数]
+        self._followers = threading.BoundedSemaphore(max_followers) if max_followers > 0 else None
+        self._seq_lock = threading.Lock()
+        self._seqs = {}  # run_id -> 最後に割り当てた連番（書き込み中の実行のみ）
+        self._failed = set()  # イベントを書き込めず FAILED にした実行の run_id
+        self._writes = queue.Queue()
+        self._writer = None
+        self._last_cleanup = 0.0
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # 書き込みを軽くするため WAL + synchronous=NORMAL にする
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, prompt TEXT, status TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS run_events (run_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, "
+            "PRIMARY KEY (run_id, seq))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_updated_at ON runs (updated_at)")
+        self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで作成"""
+        return cls(
+            os.environ.get("RUN_STORE_DB", "runs.db"),
+            retention_hours=float(os.environ.get("RUN_STORE_RETENTION_HOURS", "24")),
+            max_followers=int(os.environ.get("RUN_STORE_MAX_FOLLOWERS", "64")),
+        )
+
+    def create_run(self, prompt):
+        """新しい実行を登録し、run_id を返す"""
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO runs (run_id, prompt, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, prompt, RUNNING, now, now),
+            )
+            self._db.commit()
+        with self._seq_lock:
+            self._seqs[run_id] = 0
+        return run_id
+
+    def append(self, run_id, event):
+        """イベントを書き込みキューに入れ、割り当てた連番（1始まり）を返す"""
+        seq = self._next_seq(run_id)
+        self._write(("event", run_id, seq, json.dumps(event, ensure_ascii=False)))
+        return seq
+
+    def finish(self, run_id, status):
+        """実行の終了状態を書き込みキューに入れる（それまでに追記したイベントの後に記録される）"""
+        with self._seq_lock:
+            self._seqs.pop(run_id, None)
+        self._write(("finish", run_id, status))
+
+    def flush(self):
+        """キューに入っている書き込みがすべてコミットされるまで待つ"""
+        self._writes.join()
+
+    def cleanup(self, older_than):
+        """最後の更新が older_than（UNIX時刻）より前の実行をイベントごと削除し、削除した実行の数を返す"""
+        with self._lock:
+            run_ids = [r for (r,) in self._db.execute("SELECT run_id FROM runs WHERE updated_at < ?", (older_than,))]
+            self._db.execute(
+                "DELETE FROM run_events WHERE run_id IN (SELECT run_id FROM runs WHERE updated_at < ?)", (older_than,)
+            )
+            self._db.execute("DELETE FROM runs WHERE updated_at < ?", (older_than,))
+            self._db.commit()
+        self._failed.difference_update(run_ids)
+        return len(run_ids)
+
+    def get_run(self, run_id):
+        """実行の情報を返す（存在しない場合は None）"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT run_id, prompt, status, created_at, updated_at FROM runs WHERE run_id = ?", (run_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("run_id", "prompt", "status", "created_at", "updated_at"), row))
+
+    def events_after(self, run_id, seq):
+        """連番が seq より大きいイベントを (連番, イベント) のリストで返す"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, event FROM run_events WHERE run_id = ? AND seq > ? ORDER BY seq", (run_id, seq)
+            ).fetchall()
+        return [(s, json.loads(e)) for s, e in rows]
+
+    def follow(self, run_id, after=0, keepalive=15.0):
+        """after より後のイベントを再送し、実行が終わるまで新しいイベントを待ち続ける
+
+        1回の読み込みで得た (連番, イベント) のリストをまとめて返し、
+        keepalive 秒イベントがなければ空のリストを返す（接続維持用）。
+        """
+        last = after
+        idle_since = time.monotonic()
+        while True:
+            events = self.events_after(run_id, last)
+            if events:
+                last = events[-1][0]
+                idle_since = time.monotonic()
+                yield events
+                continue
+
+            run = self.get_run(run_id)
+            if run is None or run["status"] != RUNNING or run_id in self._failed:
+                # 終了の記録より前に追記されたイベントを取りこぼさないよう、最後にもう一度確認する
+                events = self.events_after(run_id, last)
+                if events:
+                    yield events
+                return
+
+            if time.monotonic() - idle_since >= keepalive:
+                idle_since = time.monotonic()
+                yield []
+            self._wait(run_id)
+
+    def acquire_follower(self):
+        """購読者の枠を1つ確保する（上限に達している場合は False を返す）"""
+        return self._followers is None or self._followers.acquire(blocking=False)
+
+    def release_follower(self):
+        """acquire_follower で確保した枠を返す"""
+        if self._followers is not None:
+            self._followers.release()
+
+    def _wait(self, run_id):
+        """run_id への書き込みの通知を poll_interval 秒まで待つ"""
+        with self._waiters_lock:
+            waiter = self._waiters.setdefault(run_id, [threading.Condition(), 0])
+            waiter[1] += 1
+        try:
+            with waiter[0]:
+                waiter[0].wait(self.poll_interval)
+        finally:
+            with self._waiters_lock:
+                waiter[1] -= 1
+                if waiter[1] == 0:
+                    del self._waiters[run_id]
+
+    def _notify(self, run_ids):
+        with self._waiters_lock:
+            conditions = [self._waiters[r][0] for r in run_ids if r in self._waiters]
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+
+    def _next_seq(self, run_id):
+        with self._seq_lock:
+            if run_id not in self._seqs:
+                with self._lock:
+                    row = self._db.execute(
+                        "SELECT COALESCE(MAX(seq), 0) FROM run_events WHERE run_id = ?", (run_id,)
+                    ).fetchone()
+                self._seqs[run_id] = row[0]
+            seq = self._seqs[run_id] = self._seqs[run_id] + 1
+        return seq
+
+    def _write(self, op):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="run-store-writer", daemon=True)
+                    self._writer.start()
+        self._writes.put(op)
+
+    def _write_loop(self):
+        """キューに溜まった書き込みを WRITE_BATCH_SIZE 件ずつ1回のコミットにまとめる"""
+        while True:
+            ops = [self._writes.get()]
+            while len(ops) < WRITE_BATCH_SIZE:
+                try:
+                    ops.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                failed = self._commit(ops)
+                if failed:
+                    self._mark_failed(failed)
+                self._cleanup_if_due()
+            except sqlite3.Error:
+                # 書き込みに失敗してもスレッドは止めず、以降の書き込みを続ける
+                traceback.print_exc()
+            finally:
+                # 失敗した場合も購読者を起こし、終了した実行の追従を終わらせる
+                self._notify({op[1] for op in ops})
+                for _ in ops:
+                    self._writes.task_done()
+
+    def _commit(self, ops):
+        """ops を1回のコミットで書き込み、書き込めなかった op がある実行の run_id の集合を返す
+
+        op ごとに SAVEPOINT を置き、失敗した op だけを取り消して同じバッチの他の実行の書き込みは残す。
+        """
+        now = time.time()
+        failed = set()
+        with self._lock:
+            try:
+                # SAVEPOINT だけでトランザクションを始めると RELEASE でコミットされるため、先に BEGIN する
+                self._db.execute("BEGIN")
+                for op in ops:
+                    self._db.execute("SAVEPOINT op")
+                    try:
+                        if op[0] == "event":
+                            self._db.execute("INSERT INTO run_events (run_id, seq, event) VALUES (?, ?, ?)", op[1:])
+                        else:
+                            # 書き込みの失敗で FAILED にした実行は、その後の終了通知で上書きしない
+                            self._db.execute(
+                                "UPDATE runs SET status = CASE WHEN status = ? THEN status ELSE ? END, updated_at = ? "
+                                "WHERE run_id = ?",
+                                (FAILED, op[2], now, op[1]),
+                            )
+                    except sqlite3.Error:
+                        traceback.print_exc()
+                        self._db.execute("ROLLBACK TO op")
+                        failed.add(op[1])
+                    self._db.execute("RELEASE op")
+                updated = {op[1] for op in ops if op[0] == "event"}
+                self._db.executemany("UPDATE runs SET updated_at = ? WHERE run_id = ?", [(now, r) for r in updated])
+                self._db.commit()
+            except sqlite3.Error:
+                # コミット自体に失敗した場合はバッチ全体が失われるので、含まれる実行をすべて失敗扱いにする
+                traceback.print_exc()
+                self._db.rollback()
+                failed = {op[1] for op in ops}
+        return failed
+
+    def _mark_failed(self, run_ids):
+        """イベントを書き込めなかった実行を FAILED にし、理由をイベントとして残す
+
+        状態の書き込みにも失敗した場合に備え、同一プロセスの追従はメモリ上の記録でも終わらせる。
+        """
+        self._failed.update(run_ids)
+        with self._seq_lock:
+            finished = {run_id for run_id in run_ids if run_id not in self._seqs}
+        rows = [
+            (run_id, self._next_seq(run_id), json.dumps({"type": "error", "data": WRITE_ERROR}, ensure_ascii=False))
+            for run_id in run_ids
+        ]
+        # 終了済みの実行の連番は保持し続けない
+        with self._seq_lock:
+            for run_id in finished:
+                self._seqs.pop(run_id, None)
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.executemany("INSERT INTO run_events (run_id, seq, event) VALUES (?, ?, ?)", rows)
+                self._db.executemany(
+                    "UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?", [(FAILED, now, r) for r in run_ids]
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                self._db.rollback()
+                raise
+
+    def _cleanup_if_due(self):
+        if self.retention_hours <= 0 or time.monotonic() - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = time.monotonic()
+        self.cleanup(time.time() - self.retention_hours * 3600)
+
+async def record_run(store, run_id, stream):
+    """パイプラインのイベントをすべてログに追記する（クライアントの接続有無に関係なく最後まで実行）"""
+    status = FAILED
+    failed = False
+    try:
+        async for event in stream:
+            store.append(run_id, event)
+            if event.get("type") == "error":
+                failed = True
+        status = FAILED if failed else COMPLETED
+    except Exception as e:
+        store.append(run_id, {"type": "error", "data": str(e)})
+    finally:
+        store.finish(run_id, status)
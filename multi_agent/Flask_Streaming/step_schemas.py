@@ -0,0 +1,231 @@
+import copy
+import json
+import os
+from json_stream import StreamingJSONParser, stream_agent_json
+
+# 各ステップの出力（JSON）の形式と、形式を満たさない項目だけの聞き直し
+#
+# モデルの出力は StreamingJSONParser で解析する（末尾のカンマ・途中で切れた配列・エスケープされていない引用符などは
+# json_stream.repair_json で修復する）。修復後も必須の項目が欠けている／形式が違う場合は、同じエージェントに
+# その項目だけを出力させて補う（会話履歴に元の出力が残っているため、他の項目と整合した値が返る）。
+# 配列の項目は形式を満たさない要素を取り除き、min_items に足りない場合は不足分だけを追加で出力させる。
+# 任意の項目は聞き直さず、形式を満たさなければ既定値にする（必須の項目も聞き直して満たさなければ既定値があれば使う）。
+#
+# 環境変数:
+#   OUTPUT_REASK_ATTEMPTS   聞き直しの最大回数（既定: 2、"0" で聞き直さない）
+
+REASK_ATTEMPTS = int(os.environ.get("OUTPUT_REASK_ATTEMPTS", "2"))
+
+def is_text(value):
+    return isinstance(value, str) and bool(value.strip())
+
+def is_bool(value):
+    return isinstance(value, bool)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_text_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def rating(low, high):
+    """low〜high の数値"""
+    return lambda value: is_number(value) and low <= value <= high
+
+def shape(**checks):
+    """checks のキーの値がすべて検証を満たす dict"""
+    return lambda value: isinstance(value, dict) and all(check(value.get(key)) for key, check in checks.items())
+
+def mapping(check):
+    """値がすべて check を満たす空でない dict"""
+    return lambda value: isinstance(value, dict) and bool(value) and all(check(item) for item in value.values())
+
+def optional(check):
+    """省略（None）も認める"""
+    return lambda value: value is None or check(value)
+
+class Field:
+    """出力の項目1つ分の定義
+
+    check: 値の検証（items=True の場合は配列の各要素の検証）
+    example: 聞き直すときに示す出力形式の例（items=True の場合は要素1件分）
+    required: False の項目は聞き直さない
+    default: 形式を満たさない場合の値（必須の項目は聞き直しても満たさない場合に使う。None の場合は補わない）
+    items: True の場合は配列で、形式を満たさない要素は取り除き、min_items 件に足りなければ不足分を聞き直す
+    """
+    def __init__(self, name, check, example, required=True, default=None, items=False, min_items=0):
+        self.name = name
+        self.check = check
+        self.example = example
+        self.required = required
+        self.default = default
+        self.items = items
+        self.min_items = min_items
+
+    def valid(self, value):
+        if self.items:
+            return isinstance(value, list) and len(value) >= self.min_items and all(self.check(item) for item in value)
+        return self.check(value)
+
+class Schema:
+    """ステップの出力（トップレベルが dict のJSON）の形式"""
+    def __init__(self, label, *fields):
+        self.label = label
+        self.fields = fields
+
+    def normalize(self, data):
+        """dict でなければ空の dict にし、配列の項目から形式を満たさない要素を取り除く（新しい dict を返す）"""
+        data = dict(data) if isinstance(data, dict) else {}
+        for field in self.fields:
+            if field.items and isinstance(data.get(field.name), list):
+                data[field.name] = [item for item in data[field.name] if field.check(item)]
+        return data
+
+    def invalid(self, data, required_only=False):
+        """形式を満たさない項目（required_only の場合は必須の項目だけ）"""
+        return [
+            field for field in self.fields
+            if (field.required or not required_only) and not field.valid(data.get(field.name))
+        ]
+
+    def fill_defaults(self, data):
+        """形式を満たさない項目を既定値にする（要素のある配列はそのまま残す）"""
+        for field in self.invalid(data):
+            if field.default is None or (field.items and isinstance(data.get(field.name), list) and data[field.name]):
+                continue
+            data[field.name] = copy.deepcopy(field.default)
+        return data
+
+    def reask_prompt(self, data, fields):
+        """fields の項目だけを出力させるプロンプト"""
+        problems = []
+        example = {}
+        for field in fields:
+            current = data.get(field.name)
+            if field.items and isinstance(current, list) and current:
+                missing = field.min_items - len(current)
+                problems.append(f"- {field.name}: 形式を満たす要素が{len(current)}件しかありません。既存の要素と重複しない追加の{missing}件だけを出力してください")
+            else:
+                problems.append(f"- {field.name}: 欠けているか形式が正しくありません")
+            example[field.name] = [field.example] if field.items else field.example
+        return f"""直前の出力のうち、次の項目が欠けているか形式を満たしていませんでした。
+{chr(10).join(problems)}
+
+直前の出力と整合するように、これらの項目だけを次の形式のJSONで出力してください（他の項目は出力しないでください）。
+```json
+{json.dumps(example, ensure_ascii=False, indent=2)}
+```"""
+
+    def merge(self, data, patch, fields):
+        """聞き直した結果の fields の項目を data に反映する（要素のある配列の項目には追加する）"""
+        patch = self.normalize(patch)
+        for field in fields:
+            if field.name not in patch:
+                continue
+            current = data.get(field.name)
+            if field.items and isinstance(current, list) and current and isinstance(patch[field.name], list):
+                data[field.name] = current + patch[field.name]
+            else:
+                data[field.name] = patch[field.name]
+
+async def reask_invalid_fields(agent, schema, data, step, stream=stream_agent_json):
+    """必須の項目のうち形式を満たさないものだけを agent に聞き直して data（normalize 済み）に反映し、残りを既定値で補う
+
+    聞き直しのイベントを返す。既定値のない必須の項目は、聞き直した後も形式を満たさなければそのまま残る（schema.invalid で確認する）。
+    stream は (agent, prompt, step, parser) でモデルを呼び出す関数（既定: stream_agent_json）。
+    """
+    for attempt in range(1, REASK_ATTEMPTS + 1):
+        fields = schema.invalid(data, required_only=True)
+        if not fields:
+            break
+        names = "、".join(field.name for field in fields)
+        yield {"type": "status", "data": f"{schema.label}の出力のうち {names} が不正なため、この項目だけを再生成中（{attempt}/{REASK_ATTEMPTS}）..."}
+        parser = StreamingJSONParser()
+        async for event in stream(agent, schema.reask_prompt(data, fields), f"{step}_reask_{attempt}", parser):
+            yield event
+        schema.merge(data, parser.result(), fields)
+    schema.fill_defaults(data)
+
+RESEARCH = Schema(
+    "類似政策の調査",
+    Field("similar_policies", shape(municipality=is_text, policy_name=is_text, summary=is_text),
+          {"municipality": "自治体名", "policy_name": "政策名", "summary": "概要", "results": "成果"},
+          required=False, default=[], items=True),
+    Field("has_references", is_bool, True, required=False, default=False),
+    Field("search_scope", is_text, "大阪市/他の市区町村/日本全体", required=False, default="不明"),
+)
+
+DEMOGRAPHICS = Schema(
+    "人口動態調査",
+    Field("target_area", is_text, "対象地域名"),
+    Field("age_distribution", mapping(is_number), {"20代": 10, "30代": 15, "40代": 15, "50代": 20, "60代以上": 40}),
+    Field("gender_ratio", mapping(is_number), {"male": 48, "female": 52}),
+    Field("family_types", shape(type=is_text, percentage=is_number), {"type": "単身世帯", "percentage": 35},
+          required=False, default=[], items=True),
+    Field("data_source", is_text, "データソース", required=False, default="不明"),
+    Field("data_scope", is_text, "大阪市/他の市区町村/日本全体", required=False, default="不明"),
+)
+
+# 市民エージェントは最低10名（名前・年齢・プロフィールは評価のプロンプトと結果の一覧に使う）
+MIN_CITIZEN_AGENTS = 10
+
+AGENT_DEFS = Schema(
+    "エージェント定義の生成",
+    Field("policy_agents", shape(name=is_text, expertise=is_text, system_prompt=is_text),
+          {"name": "エージェント名", "expertise": "専門分野", "system_prompt": "詳細なプロンプト"}, items=True, min_items=1),
+    Field("citizen_agents", shape(name=is_text, age=rating(0, 120), profile=is_text, is_directly_affected=optional(is_bool)),
+          {"name": "名前", "age": 35, "gender": "性別", "family": "家族構成", "profile": "詳細プロフィール",
+           "is_directly_affected": True, "system_prompt": "評価用プロンプト"},
+          items=True, min_items=MIN_CITIZEN_AGENTS),
+    Field("reviewer_agent", shape(system_prompt=is_text),
+          {"name": "レビュアー名", "expertise": "専門分野", "system_prompt": "レビュー用プロンプト"},
+          required=False, default={"name": "レビュアー", "expertise": "法律・実現性", "system_prompt": "法律と実現性の観点でレビューしてください"}),
+)
+
+POLICY = Schema(
+    "政策立案",
+    Field("policy_title", is_text, "政策名"),
+    Field("summary", is_text, "政策概要"),
+    Field("recommended_policy", is_text, "推奨政策"),
+    Field("referenced_policies", is_text_list, ["参考にした自治体政策"], required=False, default=[]),
+    Field("problem_analysis", is_text, "問題分析", required=False, default=""),
+    Field("implementation_plan", is_text, "実施計画", required=False, default=""),
+    Field("expected_effects", is_text, "期待効果", required=False, default=""),
+    Field("is_temporary", is_bool, False, required=False, default=False),
+)
+
+REVIEW = Schema(
+    "レビュー",
+    Field("approved", is_bool, True, default=False),
+    Field("legal_compliance", shape(score=is_number), {"score": 5, "issues": ["問題点"], "recommendations": ["推奨事項"]},
+          required=False, default={}),
+    Field("feasibility", shape(score=is_number), {"score": 4, "issues": ["問題点"], "recommendations": ["推奨事項"]},
+          required=False, default={}),
+    Field("overall_assessment", is_text, "総合評価", required=False, default=""),
+    Field("improvement_suggestions", is_text, "改善提案（承認されない場合）", required=False, default=""),
+)
+
+CITIZEN_EVALUATION = Schema(
+    "市民評価",
+    Field("evaluator_name", is_text, "市民の名前"),
+    Field("overall_rating", rating(1, 5), 3),
+    Field("detailed_evaluation", mapping(shape(score=rating(1, 5))),
+          {"personal_impact": {"score": 3, "reason": "自分への影響"}, "family_impact": {"score": 3, "reason": "家族への影響"},
+           "community_impact": {"score": 3, "reason": "地域への影響"}, "fairness": {"score": 3, "reason": "公平性"},
+           "sustainability": {"score": 3, "reason": "持続可能性"}}),
+    Field("expectations", is_text, "期待すること", required=False, default=""),
+    Field("concerns", is_text, "懸念すること", required=False, default=""),
+    Field("recommendations", is_text, "提言", required=False, default=""),
+    Field("personal_story", is_text, "この政策が自分の生活にどう影響するか", required=False, default=""),
+)
+
+FUTURE_EVALUATION = Schema(
+    "10年後評価",
+    Field("evaluator_name", is_text, "市民の名前 (10年後)"),
+    Field("ten_year_rating", rating(1, 5), 3),
+    Field("age_now", optional(is_number), 45, required=False),
+    Field("changes_observed", is_text, "10年間で観察された変化", required=False, default=""),
+    Field("long_term_impact", is_text, "長期的な影響の評価", required=False, default=""),
+    Field("unexpected_outcomes", is_text, "予想外の結果", required=False, default=""),
+    Field("current_opinion", is_text, "現在の意見", required=False, default=""),
+)
@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+# 同時に実行するモデル呼び出しの上限（環境変数で変更可能）
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENT_MODEL_CALLS", "5"))
+
+_DONE = object()
+
+class _Failure:
+    """ストリーム内で発生した例外を受け渡すためのラッパー"""
+    def __init__(self, error):
+        self.error = error
+
+async def merge_streams(stream_factories, max_concurrency=DEFAULT_MAX_CONCURRENCY, queue_size=100):
+    """複数の非同期ストリームを同時実行数の上限付きで並列実行し、届いた順に1本のストリームとして返す
+
+    stream_factories は引数なしで非同期ジェネレータを返す関数のリスト。
+    各ストリーム内のイベント順序は保たれ、ストリーム間のイベントは到着順に混ざる。
+    """
+    # 終了・失敗の通知はキューが満杯でも待たずに入れられるよう、キュー自体は上限なしにして
+    # 通常のイベントだけを slots（queue_size 件分）で制限する
+    queue = asyncio.Queue()
+    slots = asyncio.Semaphore(max(1, int(queue_size)))
+    semaphore = asyncio.Semaphore(max(1, int(max_concurrency)))
+
+    async def run(factory):
+        async with semaphore:
+            async for item in factory():
+                await slots.acquire()
+                queue.put_nowait(item)
+
+    def finished(task):
+        # 取り消されたタスクの中ではキューを待たない（完了の通知はコールバックから put_nowait で入れる）
+        if not task.cancelled() and task.exception() is not None:
+            queue.put_nowait(_Failure(task.exception()))
+        queue.put_nowait(_DONE)
+
+    tasks = [asyncio.create_task(run(factory)) for factory in stream_factories]
+    for task in tasks:
+        task.add_done_callback(finished)
+    remaining = len(tasks)
+    try:
+        while remaining:
+            item = await queue.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                slots.release()
+                yield item
+    finally:
+        # 呼び出し側が途中で終了した場合も実行中のストリームを確実に止める
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        # 読まれずに残ったイベントを捨て、空き待ちのストリームがあれば進めてから終了を待つ
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not _DONE and not isinstance(item, _Failure):
+                slots.release()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,232 @@
+import re
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+# 実行時間の計測（モデル呼び出し・ツール・パイプラインのステップ・エントリーポイント）
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# 1回の呼び出しごとに所要時間・最初のトークンまでの時間（TTFT）・トークン数・リトライ回数を記録し、
+# プロセス全体の集計（default_telemetry）にステップごとのヒストグラムとして加算する。
+# 集計は Flask_Streaming/web_app.py の /metrics で p50 / p95 / p99 として公開する。
+
+# レイテンシのヒストグラムのバケット上限（ミリ秒、これを超える値は最後のバケットに入る）
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000, 120000, 300000)
+# 記録するトークン使用量の項目
+TOKEN_KEYS = ("inputTokens", "outputTokens", "cacheReadInputTokens", "cacheWriteInputTokens")
+# ステップ名の末尾の番号（citizen_3, reviewer_attempt_2, citizen_batch_0_4 など）は集計時にまとめる
+_STEP_NUMBER = re.compile(r"(_\d+)+$")
+
+def step_group(step):
+    """集計に使うステップ名（末尾の番号を除いたもの）"""
+    return _STEP_NUMBER.sub("", step) or step
+
+def invocation_usage(result):
+    """エージェントの実行結果から今回の呼び出し分のトークン使用量を取り出す"""
+    metrics = getattr(result, "metrics", None)
+    invocation = getattr(metrics, "latest_agent_invocation", None)
+    usage = getattr(invocation, "usage", None) or getattr(metrics, "accumulated_usage", None) or {}
+    return {key: usage.get(key, 0) for key in TOKEN_KEYS}
+
+class Histogram:
+    """固定バケットのヒストグラム（パーセンタイルはバケット内の線形補間で推定）"""
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return round(min(lower + (upper - lower) * (rank - seen) / count, self.max))
+            seen += count
+        return round(self.max)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count) if self.count else None,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": round(self.max) if self.count else None,
+            "buckets": {
+                **{f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)},
+                "inf": self.counts[-1],
+            },
+        }
+
+class StepStats:
+    """ステップ1種類分の集計"""
+    def __init__(self):
+        self.wall_ms = Histogram()
+        self.ttft_ms = Histogram()
+        self.errors = 0
+        self.retries = 0
+        self.tokens = {}
+
+    def add(self, record):
+        self.wall_ms.observe(record["wall_ms"])
+        if record.get("ttft_ms") is not None:
+            self.ttft_ms.observe(record["ttft_ms"])
+        if record.get("error"):
+            self.errors += 1
+        self.retries += record.get("retries", 0)
+        for key in TOKEN_KEYS:
+            self.tokens[key] = self.tokens.get(key, 0) + record.get(key, 0)
+
+    def snapshot(self):
+        return {
+            "count": self.wall_ms.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            **self.tokens,
+            "wall_ms": self.wall_ms.snapshot(),
+            "ttft_ms": self.ttft_ms.snapshot(),
+        }
+
+class Telemetry:
+    """計測値の集計（種類 → ステップ名 → 集計）"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = datetime.now().isoformat()
+            self._stats = {}
+            self._counters = {}
+
+    def record(self, record):
+        step = step_group(record["step"])
+        with self._lock:
+            self._stats.setdefault(record["kind"], {}).setdefault(step, StepStats()).add(record)
+
+    def count(self, name, step, value=1):
+        """回数の加算（モデル呼び出しの再試行・ヘッジなど）"""
+        with self._lock:
+            steps = self._counters.setdefault(name, {})
+            steps[step] = steps.get(step, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "since": self.started_at,
+                **{kind: {step: stats.snapshot() for step, stats in sorted(steps.items())} for kind, steps in self._stats.items()},
+            }
+            if self._counters:
+                snapshot["counters"] = {name: dict(sorted(steps.items())) for name, steps in sorted(self._counters.items())}
+            return snapshot
+
+default_telemetry = Telemetry()
+
+# count() の加算先に default_telemetry 以外で加える集計（実行ごとの Telemetry など。タスクごとに設定する）
+counter_sinks = ContextVar("counter_sinks", default=())
+
+def count(name, step, value=1):
+    """default_telemetry と現在のタスクの counter_sinks に回数を加算"""
+    default_telemetry.count(name, step, value)
+    for sink in counter_sinks.get():
+        sink.count(name, step, value)
+
+class CallTimer:
+    """1回の呼び出し（kind: model / tool / step / entrypoint）の計測
+
+    finish() で記録を確定し、default_telemetry と sinks（実行ごとの Telemetry など）に加算する。
+    """
+    def __init__(self, step, kind="model", sinks=()):
+        self.step = step
+        self.kind = kind
+        self.sinks = sinks
+        self.started = time.perf_counter()
+        self.ttft = None
+        self.retries = 0
+        self.usage = {}
+        self.record = None
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def add_usage(self, usage):
+        for key in TOKEN_KEYS:
+            self.usage[key] = self.usage.get(key, 0) + (usage.get(key, 0) or 0)
+
+    def absorb(self, child):
+        """内側の呼び出し（ツール内のモデル呼び出しなど）のトークン数・リトライ回数・最初のトークンを反映"""
+        self.add_usage(child.usage)
+        self.retries += child.retries
+        if child.ttft is not None:
+            ttft = child.started + child.ttft - self.started
+            self.ttft = ttft if self.ttft is None else min(self.ttft, ttft)
+
+    def observe(self, event):
+        """Strands のストリームイベント（テキスト・スロットリングによる再試行・最終結果）を反映"""
+        if "data" in event:
+            self.first_token()
+        if "event_loop_throttled_delay" in event:
+            self.retries += 1
+        if "result" in event:
+            self.add_usage(invocation_usage(event["result"]))
+
+    def finish(self, error=None, **extra):
+        """記録を確定して返す（2回目以降は最初の記録を返す）"""
+        if self.record is not None:
+            return self.record
+        self.record = {
+            "step": self.step,
+            "kind": self.kind,
+            "wall_ms": round((time.perf_counter() - self.started) * 1000),
+            "ttft_ms": round(self.ttft * 1000) if self.ttft is not None else None,
+            **{key: self.usage.get(key, 0) for key in TOKEN_KEYS},
+            "retries": self.retries,
+            **extra,
+        }
+        if error is not None:
+            self.record["error"] = type(error).__name__
+        default_telemetry.record(self.record)
+        for sink in self.sinks:
+            sink.record(self.record)
+        return self.record
+
+async def measure(events, timer):
+    """Strands のストリームイベントを計測しながらそのまま返す（終了・例外時に記録を確定）"""
+    try:
+        async for event in events:
+            timer.observe(event)
+            yield event
+    except BaseException as e:
+        timer.finish(error=e)
+        raise
+    timer.finish()
+
+# ストリームで返す計測値のイベント
+#   metrics:       1回の処理（モデル呼び出し・ステップ・実行全体）の計測値。data は CallTimer の記録（kind で種類を区別）
+#   cache_metrics: ステップ内の全モデル呼び出しのトークン数・キャッシュ利用の集計。data はステップごとの集計値
+
+def metrics_event(record):
+    """計測値をストリームの metrics イベントにする"""
+    return {"type": "metrics", "step": record["step"], "data": record}
+
+def cache_metrics_event(step, summary):
+    """ステップ内の呼び出しの使用量の集計をストリームの cache_metrics イベントにする"""
+    return {"type": "cache_metrics", "step": step, "data": summary}
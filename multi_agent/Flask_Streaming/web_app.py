@@ -1,9 +1,82 @@
 from flask import Flask, render_template, request, jsonify, Response
-import asyncio
 import json
+import os
 from multi_agent_app_enhanced import invoke_async_streaming
+from persona_evaluation import EVALUATION_MODES
+from async_bridge import bridge
+from run_store import RunStore, record_run
+from event_coalescer import coalesce_stream_events, GzipFrames, accepts_gzip, GZIP_ENABLED
+from telemetry import default_telemetry
+from model_registry import default_registry
 
 app = Flask(__name__)
+run_store = RunStore.from_env()
+
+# /api/evaluate のリクエストから invoke_async_streaming に渡す項目
+PIPELINE_OPTIONS = ('evaluation_mode', 'batch_size', 'max_concurrency', 'models')
+
+# リクエストで指定できる値の上限（これより大きい指定は上限に切り詰める）
+#   API_MAX_CONCURRENCY  max_concurrency（同時に実行するモデル呼び出しの数）の上限（既定: 20）
+#   API_MAX_BATCH_SIZE   batch_size（batched モードで1回に評価する人数）の上限（既定: 20）
+INT_OPTION_LIMITS = {
+    'max_concurrency': int(os.environ.get('API_MAX_CONCURRENCY', '20')),
+    'batch_size': int(os.environ.get('API_MAX_BATCH_SIZE', '20')),
+}
+
+def pipeline_options(data):
+    """リクエストからパイプラインに渡す項目を取り出して検証する（不正な値は ValueError）"""
+    options = {key: data[key] for key in PIPELINE_OPTIONS if data.get(key) is not None}
+    for key, limit in INT_OPTION_LIMITS.items():
+        if key not in options:
+            continue
+        value = options[key]
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ValueError(f"{key} は1以上の整数で指定してください")
+        options[key] = min(value, limit)
+    if 'evaluation_mode' in options and options['evaluation_mode'] not in EVALUATION_MODES:
+        raise ValueError(f"evaluation_mode は {' / '.join(EVALUATION_MODES)} のいずれかで指定してください")
+    return options
+
+def sse_frames(batch):
+    """ログから読み込んだイベント群を1回の書き込み分のSSEフレームに変換
+
+    id: に連番を入れて再接続時の再開位置にする。空の場合は接続維持用のコメントを返す。
+    """
+    if not batch:
+        return ": keepalive\n\n"
+    return "".join(f"id: {seq}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n" for seq, event in batch)
+
+def follow_run(run_id, after):
+    """ログを再送・追従するSSEレスポンス
+
+    購読者は1接続1スレッドなので、上限（RUN_STORE_MAX_FOLLOWERS）に達している場合は 503 を返す。
+    実行自体は続くので、後から /api/runs/<run_id>/events で受け取れる。
+    """
+    if not run_store.acquire_follower():
+        return jsonify({'error': '同時に接続できる数の上限に達しています', 'run_id': run_id}), 503
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    use_gzip = GZIP_ENABLED and accepts_gzip(request.headers.get('Accept-Encoding'))
+
+    def generate():
+        for batch in run_store.follow(run_id, after):
+            yield sse_frames(batch)
+
+    def generate_gzip():
+        gzip = GzipFrames()
+        for frames in generate():
+            yield gzip.compress(frames)
+        yield gzip.close()
+
+    if use_gzip:
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        response = Response(generate_gzip(), mimetype='text/event-stream', headers=headers)
+    else:
+        response = Response(generate(), mimetype='text/event-stream', headers=headers)
+    # 枠はクライアントの切断を含め、レスポンスが閉じられたときに返す
+    response.call_on_close(run_store.release_follower)
+    return response
 
 @app.route('/')
 def index():
@@ -14,43 +87,57 @@ def evaluate():
     try:
         data = request.json
         prompt = data.get('prompt', '')
-        
+
         if not prompt:
             return jsonify({'error': 'プロンプトが必要です'}), 400
-        
-        def generate():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                async def run_stream():
-                    try:
-                        async for chunk in invoke_async_streaming({'prompt': prompt}):
-                            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                    except Exception as e:
-                        error_chunk = {"type": "error", "data": str(e)}
-                        yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
-                
-                gen = run_stream()
-                while True:
-                    try:
-                        result = loop.run_until_complete(gen.__anext__())
-                        yield result
-                    except StopAsyncIteration:
-                        break
-                    except Exception as e:
-                        error_chunk = {"type": "error", "data": str(e)}
-                        yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
-                        break
-            except Exception as e:
-                error_chunk = {"type": "error", "data": str(e)}
-                yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
-            finally:
-                loop.close()
-        
-        return Response(generate(), mimetype='text/event-stream')
-    
+        # パイプラインへの指定は実行を登録する前に確認する（許可されていないモデル・偽モデル、範囲外の数値は拒否）
+        try:
+            payload = pipeline_options(data)
+            default_registry.with_request_overrides(data.get('models'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # パイプラインは常駐イベントループ上で実行し、全イベントをログに追記する
+        # クライアントが切断しても実行は続き、/api/runs/<run_id>/events から続きを受け取れる
+        run_id = run_store.create_run(prompt)
+        run_store.append(run_id, {"type": "run", "data": {"run_id": run_id}})
+        # モデル出力の細かいチャンクはステップごとにまとめてから記録・送信する
+        # 評価モード・同時実行数・モデル割り当てなどの指定は検証済みの値をパイプラインに渡す
+        events = coalesce_stream_events(invoke_async_streaming({**payload, 'prompt': prompt}))
+        bridge.submit(record_run(run_store, run_id, events))
+
+        return follow_run(run_id, 0)
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/runs/<run_id>/events', methods=['GET'])
+def run_events(run_id):
+    """実行のイベントを Last-Event-ID の次から再送し、実行中であれば新しいイベントを追従する"""
+    if run_store.get_run(run_id) is None:
+        return jsonify({'error': '指定された実行が見つかりません'}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or '0'
+    try:
+        after = int(last_event_id)
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID が不正です'}), 400
+
+    return follow_run(run_id, after)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """プロセス起動後（または reset 後）の計測値の集計
+
+    種類（model: モデル呼び出し / step: パイプラインのステップ / entrypoint: 実行全体）ごと、ステップ名ごとに
+    件数・エラー数・リトライ数・トークン数と、所要時間・最初のトークンまでの時間（ミリ秒）のヒストグラムと p50 / p95 / p99 を返す。
+    counters はモデル呼び出しの再試行・ヘッジ・タイムアウトの回数（model_resilience）。
+    ?reset=1 を付けると返した後に集計をリセットする。
+    """
+    snapshot = default_telemetry.snapshot()
+    if request.args.get('reset') == '1':
+        default_telemetry.reset()
+    return jsonify(snapshot)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,279 @@
+"""オフライン負荷試験（偽モデルでBedrockを呼び出さずにスループットとレイテンシを計測）
+
+全ステップのモデルを偽モデル（fake_model.py。ステップごとの定型のJSONを --ttft-ms / --tokens-per-sec の速度で返す）に置き換え、
+対象ごとに別プロセスで --concurrency 件のセッションを同時に実行して --runs 件を処理し、
+1秒あたりの実行数・エンドツーエンドの所要時間（p50 / p99）・最初のイベントまでの時間・ピークRSS・イベントループの遅延を比較する。
+モデルの応答時間は固定なので、差はオーケストレーション（イベント処理・JSON解析・ログの書き込みなど）の負荷を表す。
+
+対象:
+  enhanced      Flask_Streaming/multi_agent_app_enhanced.py の invoke_async_streaming
+  api           Flask_Streaming/web_app.py の POST /api/evaluate（Flaskのテストクライアントで SSE を最後まで読む）
+  orchestrated  multi_agent_app.py の invoke（mode: orchestrated, stream: true）
+  supervisor    multi_agent_app.py の invoke（mode: supervisor, stream: true）
+
+    python benchmarks/bench_load.py --targets enhanced api orchestrated supervisor --concurrency 8 --runs 32 \\
+        --ttft-ms 300 --tokens-per-sec 60
+
+--slow-rate / --throttle-rate を指定すると、一部の呼び出しの最初のトークンを --slow-ms 遅らせたりスロットリングで失敗させたりして、
+モデル呼び出しの再試行・ヘッジ（model_resilience.py）の効果を p99 で比較できる（回数は各対象の下の行に表示する）。
+スロットリングは model_resilience.py ではなく Strands のイベントループが再試行する（回数は throttle_retries に表示する）。
+
+    python benchmarks/bench_load.py --slow-rate 0.03 --slow-ms 5000 --throttle-rate 0.02
+    MODEL_HEDGE_STEPS=all python benchmarks/bench_load.py --slow-rate 0.03 --slow-ms 5000 --throttle-rate 0.02
+
+--cassette を指定した場合は偽モデルの代わりに、記録したカセット（model_cassette.py）の応答を再生する。
+記録はモデルの割り当て（MODEL_DEFAULT など）を記録時と同じにして、同じプロンプト（PROMPTS）で各対象を1回ずつ実行しておく。
+
+    MODEL_CASSETTE=load.jsonl.gz MODEL_CASSETTE_MODE=record LLM_CACHE_ENABLED=0 python benchmarks/bench_load.py --runs 4 --concurrency 1 --warmup 0
+    python benchmarks/bench_load.py --cassette load.jsonl.gz --time-scale 1
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MULTI_AGENT_DIR = os.path.dirname(BENCH_DIR)
+FLASK_STREAMING_DIR = os.path.join(MULTI_AGENT_DIR, "Flask_Streaming")
+
+# 対象ごとの読み込み元（multi_agent_app.py は両方のディレクトリにあるため、対象ごとに別プロセスで実行する）
+TARGET_DIRS = {
+    "enhanced": FLASK_STREAMING_DIR,
+    "api": FLASK_STREAMING_DIR,
+    "orchestrated": MULTI_AGENT_DIR,
+    "supervisor": MULTI_AGENT_DIR,
+}
+
+PROMPTS = [
+    "保育園の待機児童を減らし、共働き世帯が子育てしやすい環境を整えてほしい",
+    "高齢者が買い物や通院に使える地域の交通手段を増やしてほしい",
+    "空き家を活用して若い世帯が住みやすい住宅を増やしてほしい",
+    "災害時に避難所の情報をスマホで確認できるようにしてほしい",
+]
+
+# イベントループの遅延を測る間隔（秒）
+LAG_INTERVAL = 0.01
+
+def percentile(values, q):
+    """最近傍順位法のパーセンタイル（値がなければ None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+async def sample_lag(samples):
+    """asyncio.sleep が予定より遅れて戻った時間（ミリ秒）を記録し続ける"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append((loop.time() - started - LAG_INTERVAL) * 1000)
+
+async def consume(events):
+    """イベントを最後まで読み、(最初のイベントまでの秒数, 完了したか) を返す"""
+    started = time.perf_counter()
+    first = None
+    completed = False
+    async for event in events:
+        if first is None:
+            first = time.perf_counter() - started
+        if event.get("type") == "error":
+            return first, False
+        completed = completed or event.get("type") == "complete"
+    return first, completed
+
+def sse_events(response):
+    """SSEレスポンスの data 行をイベントとして返す"""
+    for chunk in response.response:
+        text = chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+        for line in text.splitlines():
+            if line.startswith("data: "):
+                yield json.loads(line[len("data: "):])
+
+async def run_worker(args):
+    """対象1件分の計測（子プロセス側）"""
+    sys.path.insert(0, TARGET_DIRS[args.worker])
+    from telemetry import default_telemetry
+    lag_ms = []
+    executor = None
+
+    if args.worker == "enhanced":
+        from multi_agent_app_enhanced import invoke_async_streaming
+
+        async def session(prompt):
+            return await consume(invoke_async_streaming({"prompt": prompt}))
+    elif args.worker == "api":
+        from web_app import app
+        from async_bridge import bridge
+
+        def api_session(prompt):
+            started = time.perf_counter()
+            first = None
+            completed = False
+            response = app.test_client().post("/api/evaluate", json={"prompt": prompt}, buffered=False)
+            for event in sse_events(response):
+                # 最初の run イベント（run_id の通知）はパイプラインの開始前に返るため数えない
+                if event.get("type") == "run":
+                    continue
+                if first is None:
+                    first = time.perf_counter() - started
+                if event.get("type") == "error":
+                    return first, False
+                completed = completed or event.get("type") == "complete"
+            return first, completed
+
+        # リクエストはWSGIのスレッドとして、パイプラインは常駐イベントループ（async_bridge）上で実行される
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+
+        async def session(prompt):
+            return await asyncio.get_running_loop().run_in_executor(executor, api_session, prompt)
+    else:
+        from multi_agent_app import invoke
+
+        async def session(prompt):
+            payload = {"prompt": prompt, "mode": args.worker, "stream": True, "citizen_count": args.citizen_count}
+            return await consume(await invoke(payload))
+
+    async def timed(number, slots):
+        async with slots:
+            started = time.perf_counter()
+            try:
+                first, completed = await session(PROMPTS[number % len(PROMPTS)])
+            except Exception as e:
+                print(f"{args.worker} #{number}: {type(e).__name__}: {e}", file=sys.stderr)
+                first, completed = None, False
+            return {"seconds": time.perf_counter() - started, "first_event": first, "completed": completed}
+
+    # 初回の読み込み（strands のツール登録など）を計測から除くため、先に1件実行する
+    for number in range(args.warmup):
+        await timed(number, asyncio.Semaphore(1))
+    default_telemetry.reset()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.worker == "api":
+        sampler = bridge.submit(sample_lag(lag_ms))
+    else:
+        sampler = asyncio.ensure_future(sample_lag(lag_ms))
+    slots = asyncio.Semaphore(args.concurrency)
+    started = time.perf_counter()
+    runs = await asyncio.gather(*(timed(number, slots) for number in range(args.runs)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    if executor is not None:
+        executor.shutdown()
+
+    snapshot = default_telemetry.snapshot()
+    # モデル呼び出しの再試行・ヘッジなどの回数（全ステップの合計）
+    counters = {name: sum(steps.values()) for name, steps in snapshot.get("counters", {}).items()}
+    # スロットリングによる Strands のイベントループの再試行回数
+    throttle_retries = sum(stats["retries"] for stats in snapshot.get("model", {}).values())
+    if throttle_retries:
+        counters["throttle_retries"] = throttle_retries
+    # ru_maxrss は Linux ではKB単位
+    return {
+        "elapsed": elapsed,
+        "runs": runs,
+        "lag_ms": lag_ms,
+        "base_rss_mb": base_rss / 1024,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "counters": counters,
+    }
+
+def run_target(target, args):
+    """対象を子プロセスで計測し、結果を返す（偽モデルかカセットの再生に割り当て、応答キャッシュは無効にする）"""
+    if args.cassette:
+        # カセットの再生はモデルIDもハッシュに含むため、割り当ては記録時の環境変数のまま使う
+        env = {**os.environ, "MODEL_CASSETTE": os.path.abspath(args.cassette), "MODEL_CASSETTE_MODE": "replay",
+               "MODEL_CASSETTE_TIME_SCALE": str(args.time_scale)}
+    elif os.environ.get("MODEL_CASSETTE_MODE") == "record":
+        # 記録は割り当てどおりのモデル（実際のBedrockなど）を呼び出す。子プロセスは対象のディレクトリで動くためパスは絶対パスにする
+        env = {**os.environ, "MODEL_CASSETTE": os.path.abspath(os.environ["MODEL_CASSETTE"])}
+    else:
+        env = {key: value for key, value in os.environ.items() if not key.startswith("MODEL_ROUTE_") and key != "MODEL_ROUTING_FILE"}
+        env["MODEL_DEFAULT"] = (
+            f"fake:ttft_ms={args.ttft_ms},tokens_per_sec={args.tokens_per_sec},chunk_tokens={args.chunk_tokens},"
+            f"slow_rate={args.slow_rate},slow_ms={args.slow_ms},throttle_rate={args.throttle_rate}"
+        )
+    env["LLM_CACHE_ENABLED"] = "0"
+    with tempfile.TemporaryDirectory() as workdir:
+        env["RUN_STORE_DB"] = os.path.join(workdir, "runs.db")
+        command = [
+            sys.executable, os.path.abspath(__file__), "--worker", target,
+            "--concurrency", str(args.concurrency), "--runs", str(args.runs), "--warmup", str(args.warmup),
+            "--citizen-count", str(args.citizen_count),
+        ]
+        proc = subprocess.run(command, env=env, cwd=TARGET_DIRS[target], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{target} の計測に失敗しました:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def report(target, result):
+    runs = result["runs"]
+    completed = [run for run in runs if run["completed"]]
+    seconds = [run["seconds"] for run in completed]
+    first = [run["first_event"] * 1000 for run in completed if run["first_event"] is not None]
+    lag = result["lag_ms"]
+    print(
+        f"{target:<14}{len(runs):>6}{len(runs) - len(completed):>6}"
+        f"{len(completed) / result['elapsed']:>10.2f}"
+        f"{percentile(seconds, 0.5) or 0:>10.2f}{percentile(seconds, 0.99) or 0:>10.2f}"
+        f"{percentile(first, 0.5) or 0:>10.0f}{percentile(first, 0.99) or 0:>10.0f}"
+        f"{result['peak_rss_mb']:>10.0f}{result['peak_rss_mb'] - result['base_rss_mb']:>+8.0f}"
+        f"{statistics.mean(lag) if lag else 0:>10.1f}{percentile(lag, 0.99) or 0:>10.1f}{max(lag, default=0):>10.1f}"
+    )
+    if result["counters"]:
+        print(" " * 14 + "  ".join(f"{name} {value}" for name, value in sorted(result["counters"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", choices=list(TARGET_DIRS), default=list(TARGET_DIRS))
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に実行するセッション数")
+    parser.add_argument("--runs", type=int, default=None, help="対象ごとの実行数（既定: 同時実行数の4倍）")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前に1件ずつ実行する数")
+    parser.add_argument("--citizen-count", type=int, default=3, help="multi_agent_app の市民エージェント数")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="偽モデルの最初のトークンまでの時間")
+    parser.add_argument("--tokens-per-sec", type=float, default=60, help="偽モデルの出力速度")
+    parser.add_argument("--chunk-tokens", type=int, default=4, help="偽モデルの1チャンクあたりのトークン数")
+    parser.add_argument("--slow-rate", type=float, default=0, help="偽モデルの最初のトークンが遅れる呼び出しの割合")
+    parser.add_argument("--slow-ms", type=float, default=5000, help="遅れる呼び出しで最初のトークンまでの時間に加える時間")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="偽モデルがスロットリングで失敗する呼び出しの割合")
+    parser.add_argument("--cassette", help="偽モデルの代わりに再生するカセット")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="カセットの再生の待ち時間の倍率（1 = 記録時と同じ間隔、0 = 待たない）")
+    parser.add_argument("--worker", choices=list(TARGET_DIRS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.runs = args.runs or args.concurrency * 4
+
+    if args.worker:
+        # 計測結果は標準出力の最後の行に書く（エージェントの途中出力は捨てる）
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        result = asyncio.run(run_worker(args))
+        print(json.dumps(result), file=stdout)
+        return
+
+    if args.cassette:
+        model = f"カセット: {args.cassette}（待ち時間 x{args.time_scale:g}）"
+    elif os.environ.get("MODEL_CASSETTE_MODE") == "record":
+        model = f"カセットに記録: {os.environ.get('MODEL_CASSETTE')}"
+    else:
+        model = f"偽モデル: TTFT {args.ttft_ms:.0f}ms / {args.tokens_per_sec:.0f} tok/s / {args.chunk_tokens} tok/チャンク"
+        if args.slow_rate or args.throttle_rate:
+            model += f"（遅延 {args.slow_rate:.0%} +{args.slow_ms:.0f}ms / スロットリング {args.throttle_rate:.0%}）"
+    print(f"{model}  同時実行数 {args.concurrency} / 対象ごと {args.runs}件")
+    print(
+        f"{'target':<14}{'実行':>6}{'失敗':>6}{'runs/s':>10}{'p50秒':>10}{'p99秒':>10}{'初回p50ms':>10}{'初回p99ms':>10}"
+        f"{'RSS MB':>10}{'増加':>8}{'遅延平均ms':>10}{'遅延p99ms':>10}{'遅延最大ms':>10}"
+    )
+    for target in args.targets:
+        report(target, run_target(target, args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""モデル割り当ての比較ベンチマーク
+
+同じ市民意見を割り当て（--routing）ごとに orchestrated モードで実行し、所要時間・トークン数・概算コストを比較する。
+スコアのずれは、最初の割り当てで設定した市民エージェントと作成した政策案を各割り当てのモデルで評価し直し、
+最初の割り当てとの平均点の差と、市民ごとの点数の差（絶対値の平均）で示す。
+実際のBedrockを呼び出すため、AWS認証情報が必要。
+
+    python benchmarks/bench_model_routing.py --routing baseline= --routing citizen_fast=citizen:fast \\
+        --routing all_fast=citizen:fast,setup:fast,broadlistening:fast
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+# キャッシュが効くと2回目以降の計測がゼロになるため無効化する
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from multi_agent_app import RunContext, run_orchestrated, draft_policy, evaluate_panel, score_evaluations  # noqa: E402
+from model_registry import default_registry  # noqa: E402
+
+# 1Mトークンあたりの価格（USD、既定は Claude Sonnet 4 のオンデマンド料金）
+# 割り当てごとにモデルが異なるため、コストは全トークンをこの単価で換算した目安
+INPUT_PRICE = float(os.environ.get("INPUT_PRICE_PER_MTOK", "3.0"))
+OUTPUT_PRICE = float(os.environ.get("OUTPUT_PRICE_PER_MTOK", "15.0"))
+
+def parse_routing(text):
+    """"名前=ステップ:ティア,ステップ:ティア" を (名前, {ステップ: ティア}) に変換"""
+    name, _, spec = text.partition("=")
+    overrides = {}
+    for item in filter(None, spec.split(",")):
+        step, _, target = item.partition(":")
+        overrides[step.strip()] = target.strip()
+    return name or "default", overrides
+
+def citizen_scores(evaluations):
+    """評価結果から市民ごとの重み付きスコア（{市民エージェント: 点数}）を取り出す"""
+    scores = {}
+    for entry in json.loads(evaluations).get("evaluations", []):
+        if "evaluation" in entry:
+            score = json.loads(score_evaluations([entry]))
+            if "error" not in score:
+                scores[entry["citizen_agent"]] = score["average_weighted_score"]
+    return scores
+
+async def run_pipeline(prompt, citizen_count, models):
+    ctx = RunContext(citizen_count, models=models)
+    started = time.perf_counter()
+    await run_orchestrated(prompt, ctx)
+    elapsed = time.perf_counter() - started
+    usage = ctx.usage.get("tools", {})
+    panel = ctx.step_usage.get("citizen_panel", {})
+    return ctx, {
+        "seconds": elapsed,
+        "tokens": usage.get("inputTokens", 0) + usage.get("outputTokens", 0),
+        "citizen_tokens": panel.get("inputTokens", 0) + panel.get("outputTokens", 0),
+        "cost": (usage.get("inputTokens", 0) * INPUT_PRICE + usage.get("outputTokens", 0) * OUTPUT_PRICE) / 1_000_000,
+    }
+
+async def rescore(base_ctx, policy_text, models):
+    """基準の市民エージェント設定と政策案を、指定した割り当てのモデルで評価し直す"""
+    ctx = RunContext(base_ctx.citizen_count, models=models)
+    ctx.citizen_agents_config = base_ctx.citizen_agents_config
+    started = time.perf_counter()
+    evaluations = await evaluate_panel(ctx, policy_text)
+    elapsed = time.perf_counter() - started
+    return json.loads(score_evaluations(evaluations)), citizen_scores(evaluations), elapsed
+
+async def benchmark(args):
+    routings = [parse_routing(text) for text in args.routing]
+    registries = [(name, default_registry.with_overrides(overrides)) for name, overrides in routings]
+
+    results = {name: {"runs": [], "panel": []} for name, _ in registries}
+    base_ctx = None
+    for _ in range(args.repeat):
+        for name, models in registries:
+            ctx, run = await run_pipeline(args.prompt, args.citizen_count, models)
+            results[name]["runs"].append(run)
+            if base_ctx is None:
+                base_ctx = ctx
+
+    # スコアのずれは同じ政策案・同じ市民エージェントで比較する
+    policy_text = await draft_policy(base_ctx, args.prompt)
+    for _ in range(args.repeat):
+        for name, models in registries:
+            results[name]["panel"].append(await rescore(base_ctx, policy_text, models))
+    return registries, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompt", default="保育園の待機児童を減らし、共働き世帯が子育てしやすい環境を整えてほしい")
+    parser.add_argument("--citizen-count", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--routing", action="append", default=None,
+                        help="名前=ステップ:ティア,...（最初の割り当てがスコアのずれの基準、既定: baseline= と citizen_fast=citizen:fast）")
+    args = parser.parse_args()
+    args.routing = args.routing or ["baseline=", "citizen_fast=citizen:fast"]
+
+    registries, results = asyncio.run(benchmark(args))
+
+    print(f"市民エージェント {args.citizen_count}名 / 各 {args.repeat}回")
+    for name, models in registries:
+        changed = {step: model for step, model in models.routing().items() if model != default_registry.model_id(step)}
+        print(f"  {name}: {changed or '既定の割り当て'}")
+    print(f"{'routing':<16}{'秒(中央値)':>12}{'全体tok':>10}{'市民tok':>10}{'概算USD':>10}{'評価秒':>10}{'平均点':>8}{'差':>8}{'市民差':>8}")
+
+    base_name = registries[0][0]
+    base_scores = [scores for _, scores, _ in results[base_name]["panel"]]
+    base_average = statistics.mean(score.get("average_weighted_score", 0) for score, _, _ in results[base_name]["panel"])
+    for name, _ in registries:
+        runs = results[name]["runs"]
+        panel = results[name]["panel"]
+        average = statistics.mean(score.get("average_weighted_score", 0) for score, _, _ in panel)
+        # 市民ごとの点数の差（同じ回の基準の評価と比べる）
+        gaps = [
+            abs(scores[key] - base[key])
+            for (_, scores, _), base in zip(panel, base_scores)
+            for key in scores.keys() & base.keys()
+        ]
+        print(
+            f"{name:<16}"
+            f"{statistics.median(r['seconds'] for r in runs):>12.1f}"
+            f"{statistics.mean(r['tokens'] for r in runs):>10.0f}"
+            f"{statistics.mean(r['citizen_tokens'] for r in runs):>10.0f}"
+            f"{statistics.mean(r['cost'] for r in runs):>10.4f}"
+            f"{statistics.median(elapsed for _, _, elapsed in panel):>10.1f}"
+            f"{average:>8.1f}"
+            f"{average - base_average:>+8.1f}"
+            f"{statistics.mean(gaps) if gaps else 0:>8.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
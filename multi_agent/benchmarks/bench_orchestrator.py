@@ -0,0 +1,76 @@
+"""実行モード比較ベンチマーク（監督エージェント vs コードによるオーケストレーター）
+
+同じ市民意見を supervisor / orchestrated の両モードで実行し、
+所要時間・監督エージェントのトークン数・ツール内のトークン数・概算コストを比較する。
+実際のBedrockを呼び出すため、AWS認証情報が必要。
+
+    python benchmarks/bench_orchestrator.py --prompt "保育園の待機児童を減らしてほしい" --repeat 2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# キャッシュが効くと2回目以降の計測がゼロになるため無効化する
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from multi_agent_app import RunContext, run_supervised, run_orchestrated  # noqa: E402
+
+# 1Mトークンあたりの価格（USD、既定は Claude Sonnet 4 のオンデマンド料金）
+INPUT_PRICE = float(os.environ.get("INPUT_PRICE_PER_MTOK", "3.0"))
+OUTPUT_PRICE = float(os.environ.get("OUTPUT_PRICE_PER_MTOK", "15.0"))
+# プロンプトキャッシュの読み取り・書き込み（入力価格のそれぞれ 0.1倍・1.25倍）
+CACHE_READ_PRICE = float(os.environ.get("CACHE_READ_PRICE_PER_MTOK", str(INPUT_PRICE * 0.1)))
+CACHE_WRITE_PRICE = float(os.environ.get("CACHE_WRITE_PRICE_PER_MTOK", str(INPUT_PRICE * 1.25)))
+
+MODES = {
+    "supervisor": run_supervised,
+    "orchestrated": run_orchestrated,
+}
+
+def run_once(mode, prompt, citizen_count):
+    ctx = RunContext(citizen_count)
+    started = time.perf_counter()
+    asyncio.run(MODES[mode](prompt, ctx))
+    elapsed = time.perf_counter() - started
+    supervisor = ctx.usage.get("supervisor", {})
+    tools = ctx.usage.get("tools", {})
+    input_tokens = supervisor.get("inputTokens", 0) + tools.get("inputTokens", 0)
+    output_tokens = supervisor.get("outputTokens", 0) + tools.get("outputTokens", 0)
+    cache_read = supervisor.get("cacheReadInputTokens", 0) + tools.get("cacheReadInputTokens", 0)
+    cache_write = supervisor.get("cacheWriteInputTokens", 0) + tools.get("cacheWriteInputTokens", 0)
+    return {
+        "seconds": elapsed,
+        "supervisor_tokens": supervisor.get("inputTokens", 0) + supervisor.get("outputTokens", 0),
+        "tool_tokens": tools.get("inputTokens", 0) + tools.get("outputTokens", 0),
+        "cache_read_tokens": cache_read,
+        "cost": (input_tokens * INPUT_PRICE + output_tokens * OUTPUT_PRICE
+                 + cache_read * CACHE_READ_PRICE + cache_write * CACHE_WRITE_PRICE) / 1_000_000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompt", default="保育園の待機児童を減らし、共働き世帯が子育てしやすい環境を整えてほしい")
+    parser.add_argument("--citizen-count", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    print(f"市民エージェント {args.citizen_count}名 / 各 {args.repeat}回")
+    print(f"{'mode':<14}{'秒(中央値)':>12}{'監督tok':>10}{'ツールtok':>10}{'キャッシュ読':>10}{'概算USD':>10}")
+    for mode in args.modes:
+        runs = [run_once(mode, args.prompt, args.citizen_count) for _ in range(args.repeat)]
+        print(
+            f"{mode:<14}"
+            f"{statistics.median(r['seconds'] for r in runs):>12.1f}"
+            f"{statistics.mean(r['supervisor_tokens'] for r in runs):>10.0f}"
+            f"{statistics.mean(r['tool_tokens'] for r in runs):>10.0f}"
+            f"{statistics.mean(r['cache_read_tokens'] for r in runs):>10.0f}"
+            f"{statistics.mean(r['cost'] for r in runs):>10.4f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""ブロードリスニング投稿のクラスタリング（ハッシュTF-IDF + ミニバッチk-means）
+
+外部ライブラリやネットワークを使わずに投稿をテーマごとにまとめる。
+分析エージェントには投稿そのものではなく、クラスタごとの件数と代表投稿だけを渡すため、
+プロンプトの大きさは投稿数ではなくクラスタ数で決まる。
+
+環境変数:
+  BROADLISTENING_CLUSTERS         クラスタ数の上限（既定: 8）
+  BROADLISTENING_REPRESENTATIVES  クラスタごとの代表投稿の件数（既定: 3）
+"""
+import math
+import os
+import random
+import re
+import zlib
+from collections import Counter
+
+DEFAULT_CLUSTERS = int(os.environ.get("BROADLISTENING_CLUSTERS", "8"))
+DEFAULT_REPRESENTATIVES = int(os.environ.get("BROADLISTENING_REPRESENTATIVES", "3"))
+
+# 文字 2〜3-gram を 2^18 次元にハッシュする（日本語は分かち書きせずに扱える）
+NGRAM_SIZES = (2, 3)
+N_FEATURES = 1 << 18
+# 代表投稿として渡す本文の最大文字数
+MAX_POST_CHARS = 200
+# 代表投稿どうしのコサイン類似度がこれを超える場合は言い回し違いの同じ投稿とみなし、代表に重ねて選ばない
+REPRESENTATIVE_MAX_SIMILARITY = 0.8
+
+NOISE_PATTERN = re.compile(r"https?://\S+|@\w+|[\s#0-9]+", re.IGNORECASE)
+
+def char_ngrams(text):
+    """URL・メンション・空白・数字を除いた本文の文字 n-gram"""
+    text = NOISE_PATTERN.sub("", text.casefold())
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+def hashing_tfidf(texts):
+    """投稿ごとのハッシュTF-IDFベクトル（{特徴番号: 重み} の疎ベクトル、L2正規化済み）"""
+    counts = []
+    df = Counter()
+    for text in texts:
+        tf = Counter(zlib.crc32(gram.encode("utf-8")) & (N_FEATURES - 1) for gram in char_ngrams(text))
+        counts.append(tf)
+        df.update(tf.keys())
+
+    total = len(texts)
+    vectors = []
+    for tf in counts:
+        vector = {index: (1 + math.log(count)) * (math.log((1 + total) / (1 + df[index])) + 1) for index, count in tf.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        vectors.append({index: weight / norm for index, weight in vector.items()})
+    return vectors
+
+class Centroid:
+    """クラスタ中心（疎ベクトル）
+
+    更新のたびに全要素を縮小しないよう、実際の値を scale * weights として保持する。
+    """
+    def __init__(self, vector):
+        self.weights = dict(vector)
+        self.scale = 1.0
+        self.norm2 = sum(weight * weight for weight in vector.values())
+        self.count = 1
+
+    def dot(self, vector):
+        weights = self.weights
+        return self.scale * sum(weight * weights.get(index, 0.0) for index, weight in vector.items())
+
+    def distance2(self, vector):
+        """正規化済みベクトルとの距離の2乗"""
+        return 1.0 - 2.0 * self.dot(vector) + self.norm2
+
+    def update(self, vector):
+        """学習率 1/件数 で投稿の方向へ動かす（ミニバッチk-means）"""
+        self.count += 1
+        eta = 1.0 / self.count
+        dot = self.dot(vector)
+        self.norm2 = (1 - eta) ** 2 * self.norm2 + 2 * (1 - eta) * eta * dot + eta * eta
+        self.scale *= 1 - eta
+        step = eta / self.scale
+        weights = self.weights
+        for index, weight in vector.items():
+            weights[index] = weights.get(index, 0.0) + step * weight
+        if self.scale < 1e-6:
+            self.weights = {index: weight * self.scale for index, weight in weights.items()}
+            self.scale = 1.0
+
+def init_centroids(vectors, k, rng):
+    """k-means++ で初期中心を選ぶ"""
+    centroids = [Centroid(vectors[rng.randrange(len(vectors))])]
+    nearest = [centroids[0].distance2(vector) for vector in vectors]
+    while len(centroids) < k:
+        total = sum(nearest)
+        if total <= 1e-12:
+            break
+        threshold = rng.random() * total
+        for index, distance in enumerate(nearest):
+            threshold -= distance
+            if threshold <= 0:
+                break
+        centroids.append(Centroid(vectors[index]))
+        nearest = [min(d, centroids[-1].distance2(v)) for d, v in zip(nearest, vectors)]
+    return centroids
+
+def nearest_centroid(centroids, vector):
+    return min(range(len(centroids)), key=lambda i: centroids[i].distance2(vector))
+
+def minibatch_kmeans(vectors, k, batch_size=128, iterations=30, seed=0):
+    """ミニバッチk-means（Sculley 2010）。各投稿のクラスタ番号と中心を返す"""
+    rng = random.Random(seed)
+    centroids = init_centroids(vectors, min(k, len(vectors)), rng)
+    for _ in range(iterations):
+        batch = [vectors[rng.randrange(len(vectors))] for _ in range(min(batch_size, len(vectors)))]
+        assigned = [nearest_centroid(centroids, vector) for vector in batch]
+        for vector, cluster in zip(batch, assigned):
+            centroids[cluster].update(vector)
+    labels = [nearest_centroid(centroids, vector) for vector in vectors]
+    return labels, centroids
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(index, 0.0) for index, weight in a.items())
+
+def pick_representatives(positions, vectors, centroid, limit):
+    """中心に近い順に、互いに似すぎない投稿を代表として選ぶ"""
+    norm = math.sqrt(centroid.norm2) or 1.0
+    ranked = sorted(positions, key=lambda position: -centroid.dot(vectors[position]) / norm)
+    chosen = []
+    for position in ranked:
+        if len(chosen) >= limit:
+            break
+        if all(cosine(vectors[position], vectors[other]) <= REPRESENTATIVE_MAX_SIMILARITY for other in chosen):
+            chosen.append(position)
+    return chosen
+
+def cluster_posts(texts, n_clusters=DEFAULT_CLUSTERS, representatives=DEFAULT_REPRESENTATIVES, seed=0):
+    """投稿をテーマごとにまとめ、件数の多い順にクラスタの件数・割合・代表投稿（中心に近い投稿）を返す"""
+    texts = [text for text in texts if isinstance(text, str) and text.strip()]
+    if not texts:
+        return []
+    vectors = hashing_tfidf(texts)
+    labels, centroids = minibatch_kmeans(vectors, n_clusters, seed=seed)
+
+    members = {}
+    for position, label in enumerate(labels):
+        members.setdefault(label, []).append(position)
+
+    clusters = []
+    for label, positions in members.items():
+        chosen = pick_representatives(positions, vectors, centroids[label], representatives)
+        clusters.append({
+            "cluster": 0,
+            "size": len(positions),
+            "share": round(len(positions) / len(texts), 3),
+            "representatives": [texts[position][:MAX_POST_CHARS] for position in chosen],
+        })
+    clusters.sort(key=lambda cluster: -cluster["size"])
+    return clusters
+
+def summarize_broadlistening(data, n_clusters=DEFAULT_CLUSTERS, representatives=DEFAULT_REPRESENTATIVES):
+    """ブロードリスニング用JSON（dict）の samples をクラスタの要約に置き換えたものを返す
+
+    各クラスタの estimated_posts は、重複除去後の全件数（meta.filtered_count）を割合で按分した推定件数。
+    """
+    samples = data.get("samples", [])
+    clusters = cluster_posts(samples, n_clusters, representatives)
+    population = data.get("meta", {}).get("filtered_count") or len(samples)
+    for number, cluster in enumerate(clusters, 1):
+        cluster["cluster"] = number
+        cluster["estimated_posts"] = round(cluster["share"] * population)
+    return {
+        "query": data.get("query"),
+        "collection_window": data.get("collection_window"),
+        "meta": {**data.get("meta", {}), "clustered_samples": len(samples)},
+        "clusters": clusters,
+    }
@@ -0,0 +1,362 @@
+"""ブロードリスニング用のSNS投稿コーパスの取り込み
+
+ローカルのJSONL（.jsonl / .ndjson、gzip圧縮可）またはParquetのダンプを1件ずつ読み、
+query と collection_window で絞り込み、正規化・重複除去をしたうえで
+generate_broadlistening_collection_mock と同じ {query, collection_window, meta, samples} 形式にまとめる。
+全件をメモリに載せず、保持するのはサンプル（リザーバ）と直近の重複判定用インデックスだけ。
+
+    python broadlistening_ingest.py posts.jsonl --query "保育園 OR 待機児童 lang:ja" \\
+        --from 2025-09-01T00:00:00+09:00 --to 2025-10-01T00:00:00+09:00 > bl.json
+
+環境変数:
+  BROADLISTENING_SAMPLE_SIZE   samples に含める件数（既定: 1000、分析時にクラスタへまとめる）
+  BROADLISTENING_DEDUP_WINDOW  重複判定で保持する直近の投稿数（既定: 100000）
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+import zlib
+from collections import deque
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from zoneinfo import ZoneInfo
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Parquetを読まない場合は不要
+    pq = None
+
+DEFAULT_SAMPLE_SIZE = int(os.environ.get("BROADLISTENING_SAMPLE_SIZE", "1000"))
+DEFAULT_DEDUP_WINDOW = int(os.environ.get("BROADLISTENING_DEDUP_WINDOW", "100000"))
+DEFAULT_TIMEZONE = "Asia/Tokyo"
+
+# 投稿レコードのフィールド名の候補（先に見つかったものを使う）
+TEXT_FIELDS = ("text", "full_text", "content", "body")
+TIMESTAMP_FIELDS = ("created_at", "timestamp", "posted_at", "date")
+LANG_FIELDS = ("lang", "language")
+
+# 近似重複の判定（MinHash + LSH）
+#   文字5-gram の集合を 32 個のビンに分けて最小値を取り（one permutation hashing）、4ビンずつ 8 バンドに分ける
+#   いずれかのバンドが一致すれば重複とみなす（Jaccard 類似度がおよそ 0.6 以上で一致しやすい）
+SHINGLE_SIZE = 5
+MINHASH_BINS = 32
+LSH_BANDS = 8
+_BIN_BITS = MINHASH_BINS.bit_length() - 1
+_VALUE_MASK = (1 << (32 - _BIN_BITS)) - 1
+_EMPTY = 1 << 32
+
+URL_PATTERN = re.compile(r"https?://[^\s<>\"'）」]+", re.IGNORECASE)
+HASHTAG_PATTERN = re.compile(r"#(\w+)")
+MENTION_PATTERN = re.compile(r"@\w+")
+RETWEET_PREFIX = re.compile(r"^rt\s+@\w+:\s*")
+QUERY_TOKEN = re.compile(r'"[^"]*"|\S+')
+# URLから取り除くトラッキング用のパラメータ
+TRACKING_PARAMS = ("fbclid", "gclid", "igshid", "ref_src", "ref_url", "s", "t")
+
+@lru_cache(maxsize=65536)
+def canonical_url(url):
+    """URLを正規化（スキーム・ホストの小文字化、www. と既定ポート・フラグメント・トラッキング用パラメータの除去）"""
+    try:
+        parts = urlsplit(url.rstrip(".,!?、。"))
+    except ValueError:
+        return url
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+    )
+    return urlunsplit(("https", host, parts.path.rstrip("/"), urlencode(query), ""))
+
+def normalize_text(text):
+    """投稿本文を正規化（NFKC、URLとハッシュタグの正規化、空白の統一）"""
+    text = unicodedata.normalize("NFKC", text)
+    if "://" in text:
+        text = URL_PATTERN.sub(lambda match: canonical_url(match.group(0)), text)
+    text = HASHTAG_PATTERN.sub(lambda match: "#" + match.group(1).casefold(), text)
+    return " ".join(text.split())
+
+def dedup_text(normalized):
+    """重複判定用の本文（リツイートの接頭辞とメンションを除き、大文字・小文字を区別しない）"""
+    text = RETWEET_PREFIX.sub("", normalized.casefold())
+    return " ".join(MENTION_PATTERN.sub("", text).split())
+
+def minhash_signature(text):
+    """文字 SHINGLE_SIZE-gram の MinHash シグネチャ（MINHASH_BINS 個の整数）"""
+    signature = [_EMPTY] * MINHASH_BINS
+    # 1文字4バイトの固定長にして、n-gram ごとの部分列をコピーせずにハッシュする（実行ごとに同じ値になる）
+    data = memoryview(text.encode("utf-32-le"))
+    width = 4 * SHINGLE_SIZE
+    for start in range(0, max(4, len(data) - width + 4), 4):
+        h = zlib.crc32(data[start:start + width])
+        b = h >> (32 - _BIN_BITS)
+        v = h & _VALUE_MASK
+        if v < signature[b]:
+            signature[b] = v
+
+    # 短い投稿で空のビンが残った場合は次の空でないビンの値で埋める（空のビン同士が一致して誤判定しないように）
+    if _EMPTY in signature:
+        for i in range(MINHASH_BINS):
+            if signature[i] == _EMPTY:
+                for offset in range(1, MINHASH_BINS):
+                    value = signature[(i + offset) % MINHASH_BINS]
+                    if value != _EMPTY and value < _VALUE_MASK + 1:
+                        signature[i] = value + offset * (_VALUE_MASK + 1)
+                        break
+    return signature
+
+class DedupIndex:
+    """近似重複の判定用インデックス（LSH）
+
+    保持するのは直近 window 件の投稿のバンドだけで、古いものから捨てる（メモリ使用量を一定に保つ）。
+    """
+    def __init__(self, window=DEFAULT_DEDUP_WINDOW):
+        self.window = window
+        self._buckets = {}
+        self._recent = deque()
+        self._count = 0
+
+    def add(self, text):
+        """重複していなければ登録して True、既出の投稿の近似重複であれば False を返す"""
+        text = dedup_text(text)
+        # 完全一致（リツイートなど）はシグネチャを計算せずに判定する
+        exact = hash(text)
+        if exact in self._buckets:
+            return False
+        signature = minhash_signature(text)
+        rows = MINHASH_BINS // LSH_BANDS
+        keys = [exact] + [hash((band, *signature[band * rows:(band + 1) * rows])) for band in range(LSH_BANDS)]
+        if any(key in self._buckets for key in keys):
+            return False
+
+        self._count += 1
+        for key in keys:
+            self._buckets[key] = self._count
+        self._recent.append((self._count, keys))
+        if len(self._recent) > self.window:
+            number, old_keys = self._recent.popleft()
+            for key in old_keys:
+                if self._buckets.get(key) == number:
+                    del self._buckets[key]
+        return True
+
+class SearchQuery:
+    """SNS検索クエリ（例: 保育園 送迎 OR 待機児童 -広告 lang:ja）
+
+    OR で区切った各キーワードのいずれかに一致すれば対象とする。キーワード内の空白区切りの語はすべて含む必要がある。
+    "..." は語句の完全一致、-語 は除外、lang:xx は言語の指定。照合は正規化後の本文で大文字・小文字を区別せずに行う。
+    """
+    def __init__(self, query):
+        self.query = query
+        self.lang = None
+        self.clauses = [[]]
+        self.excludes = []
+        for token in QUERY_TOKEN.findall(query):
+            if token == "OR":
+                if self.clauses[-1]:
+                    self.clauses.append([])
+                continue
+            if token.startswith("lang:"):
+                self.lang = token[5:]
+                continue
+            term = token.strip("()")
+            exclude = term.startswith("-") and len(term) > 1
+            term = normalize_text(term.lstrip("-").strip('"')).casefold()
+            if not term:
+                continue
+            if exclude:
+                self.excludes.append(term)
+            else:
+                self.clauses[-1].append(term)
+        self.clauses = [clause for clause in self.clauses if clause]
+
+    def matches(self, normalized, lang=None):
+        """正規化済みの本文（と投稿の言語）がクエリに一致するか"""
+        if self.lang and lang and lang != self.lang:
+            return False
+        text = normalized.casefold()
+        if any(term in text for term in self.excludes):
+            return False
+        if not self.clauses:
+            return True
+        return any(all(term in text for term in clause) for clause in self.clauses)
+
+def parse_timestamp(value, tz):
+    """投稿日時を timezone 付きの datetime に変換（ISO 8601 文字列・UNIX時刻（秒/ミリ秒）・datetime に対応）"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=tz)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000 if value > 1e11 else value, timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=tz)
+
+def resolve_window(collection_window=None):
+    """collection_window（from / to / timezone）を datetime に変換。省略時は直近30日間"""
+    window = dict(collection_window or {})
+    tz = ZoneInfo(window.get("timezone") or DEFAULT_TIMEZONE)
+    end = parse_timestamp(window.get("to"), tz) or datetime.now(tz)
+    start = parse_timestamp(window.get("from"), tz) or end - timedelta(days=30)
+    return start, end, tz
+
+def corpus_files(paths):
+    """入力パス（ファイルまたはディレクトリ）から読み込むファイルの一覧を作成"""
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.endswith((".jsonl", ".ndjson", ".jsonl.gz", ".ndjson.gz", ".parquet")))
+        else:
+            files.append(path)
+    return sorted(files)
+
+def iter_jsonl(path, stats):
+    """JSONLを1行ずつ読み込む（壊れた行は invalid_records に数えて読み飛ばす）"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                stats["invalid_records"] += 1
+                continue
+            if isinstance(record, dict):
+                yield record
+            else:
+                stats["invalid_records"] += 1
+
+def iter_parquet(path, batch_size=8192):
+    """Parquetを行グループ単位で読み込む（使う列だけを読む）"""
+    if pq is None:
+        raise RuntimeError("Parquetの読み込みには pyarrow が必要です（pip install pyarrow）")
+    parquet = pq.ParquetFile(path)
+    wanted = set(TEXT_FIELDS + TIMESTAMP_FIELDS + LANG_FIELDS)
+    columns = [name for name in parquet.schema_arrow.names if name in wanted]
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        yield from batch.to_pylist()
+
+def iter_records(paths, stats):
+    """コーパスの全レコードを順に返す"""
+    for path in corpus_files(paths):
+        if path.endswith(".parquet"):
+            yield from iter_parquet(path)
+        else:
+            yield from iter_jsonl(path, stats)
+
+def first_field(record, fields):
+    for field in fields:
+        value = record.get(field)
+        if value is not None:
+            return value
+    return None
+
+def ingest(paths, query, collection_window=None, sample_size=DEFAULT_SAMPLE_SIZE, dedup_window=DEFAULT_DEDUP_WINDOW, seed=None):
+    """コーパスを絞り込み・正規化・重複除去し、ブロードリスニング用のJSON（dict）を返す
+
+    meta.total_collected は query と collection_window に一致した件数、
+    meta.filtered_count は近似重複を除いた件数。samples はその中から無作為に sample_size 件を選んだもの（投稿日時順）。
+    """
+    search = SearchQuery(query)
+    start, end, tz = resolve_window(collection_window)
+    dedup = DedupIndex(dedup_window)
+    rng = random.Random(seed)
+    stats = {"scanned": 0, "invalid_records": 0, "out_of_window": 0}
+    total_collected = 0
+    filtered_count = 0
+    reservoir = []
+
+    for record in iter_records(paths, stats):
+        stats["scanned"] += 1
+        text = first_field(record, TEXT_FIELDS)
+        if not isinstance(text, str) or not text.strip():
+            stats["invalid_records"] += 1
+            continue
+        posted_at = parse_timestamp(first_field(record, TIMESTAMP_FIELDS), tz)
+        if posted_at is None or not start <= posted_at < end:
+            stats["out_of_window"] += 1
+            continue
+
+        normalized = normalize_text(text)
+        if not search.matches(normalized, first_field(record, LANG_FIELDS)):
+            continue
+        total_collected += 1
+        if not dedup.add(normalized):
+            continue
+        filtered_count += 1
+
+        # リザーバサンプリング（重複を除いた投稿から一様に sample_size 件を選ぶ）
+        if len(reservoir) < sample_size:
+            reservoir.append((posted_at, normalized))
+        else:
+            slot = rng.randrange(filtered_count)
+            if slot < sample_size:
+                reservoir[slot] = (posted_at, normalized)
+
+    reservoir.sort(key=lambda item: item[0])
+    return {
+        "query": query,
+        "collection_window": {
+            "from": start.astimezone(tz).isoformat(),
+            "to": end.astimezone(tz).isoformat(),
+            "timezone": str(tz),
+        },
+        "meta": {
+            "language": search.lang or "ja",
+            "total_collected": total_collected,
+            "filtered_count": filtered_count,
+            "duplicates_removed": total_collected - filtered_count,
+            "scanned": stats["scanned"],
+            "out_of_window": stats["out_of_window"],
+            "invalid_records": stats["invalid_records"],
+            "sample_count": len(reservoir),
+        },
+        "samples": [text for _, text in reservoir],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="JSONL / Parquet ファイルまたはディレクトリ")
+    parser.add_argument("--query", required=True)
+    parser.add_argument("--from", dest="start", help="収集期間の開始（ISO 8601、既定: 終了の30日前）")
+    parser.add_argument("--to", dest="end", help="収集期間の終了（ISO 8601、既定: 現在）")
+    parser.add_argument("--timezone", default=DEFAULT_TIMEZONE)
+    parser.add_argument("--sample-size", type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument("--dedup-window", type=int, default=DEFAULT_DEDUP_WINDOW)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = ingest(
+        args.paths,
+        args.query,
+        {"from": args.start, "to": args.end, "timezone": args.timezone},
+        sample_size=args.sample_size,
+        dedup_window=args.dedup_window,
+        seed=args.seed,
+    )
+    elapsed = time.perf_counter() - started
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    scanned = result["meta"]["scanned"]
+    print(f"{scanned}件を{elapsed:.1f}秒で処理（{scanned / elapsed if elapsed else 0:.0f}件/秒）", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from telemetry import step_group
+
+# モデル応答キャッシュ
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# 同じプロンプトに同じ応答を返すため、既定では無効にしている。有効にした場合も LLM_CACHE_STEPS のステップだけを対象にし、
+# 市民評価・10年後評価・レビューなど実行ごとに異なる応答を期待するステップはキャッシュしない。
+#
+# 環境変数:
+#   LLM_CACHE_ENABLED      "1" でキャッシュを有効化（既定: 無効）
+#   LLM_CACHE_STEPS        キャッシュするステップ名（カンマ区切り、末尾の番号を除いた名前。"all" で全ステップ。
+#                          既定: research,demographics）
+#   LLM_CACHE_MAX_ENTRIES  メモリ上に保持する最大件数（既定: 256）
+#   LLM_CACHE_TTL          有効期限（秒、既定: 3600）
+#   LLM_CACHE_DB           指定した場合はSQLiteファイルにも保存し、プロセス再起動後も再利用する
+
+class LLMCache:
+    """モデル応答のキャッシュ（メモリ上のLRU + 任意でSQLiteによる永続化）
+
+    値はストリーミング時のチャンク列として保存し、ヒット時は同じ区切りで再生できるようにする。
+    """
+    def __init__(self, max_entries=256, ttl=3600, db_path=None, steps=("research", "demographics")):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.steps = set(steps)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, chunks TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで作成（無効化されている場合は None）"""
+        if os.environ.get("LLM_CACHE_ENABLED", "0") != "1":
+            return None
+        steps = os.environ.get("LLM_CACHE_STEPS", "research,demographics")
+        return cls(
+            max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "256")),
+            ttl=float(os.environ.get("LLM_CACHE_TTL", "3600")),
+            db_path=os.environ.get("LLM_CACHE_DB") or None,
+            steps=[step.strip() for step in steps.split(",") if step.strip()],
+        )
+
+    def covers(self, step):
+        """step の応答をキャッシュするか"""
+        return "all" in self.steps or (step is not None and step_group(step) in self.steps)
+
+    def get(self, key):
+        """キャッシュ済みのチャンク列を返す（未登録・期限切れの場合は None）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, chunks = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return list(chunks)
+                del self._memory[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT chunks, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            chunks = json.loads(row[0])
+            self._remember(key, row[1], chunks)
+            return list(chunks)
+
+    def put(self, key, chunks):
+        """チャンク列を保存"""
+        expires_at = time.time() + self.ttl
+        chunks = list(chunks)
+        with self._lock:
+            self._remember(key, expires_at, chunks)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, chunks, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(chunks, ensure_ascii=False), expires_at),
+                )
+                self._db.commit()
+
+    def clear(self):
+        """全件削除"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def _remember(self, key, expires_at, chunks):
+        self._memory[key] = (expires_at, chunks)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+default_cache = LLMCache.from_env()
+
+def make_cache_key(model_id, system_prompt, prompt, params=None, history=None, tools=None):
+    """(モデルID, システムプロンプト, ユーザープロンプト, サンプリング設定, 会話履歴, ツール) からキーを作成"""
+    material = json.dumps(
+        {
+            "model_id": model_id,
+            "system_prompt": system_prompt,
+            "prompt": prompt,
+            "params": params or {},
+            "history": history or [],
+            "tools": sorted(tools or []),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def agent_cache_key(agent, prompt):
+    """エージェントの現在の設定と会話履歴を含めたキャッシュキー"""
+    config = agent.model.get_config()
+    config = dict(config) if isinstance(config, dict) else {}
+    model_id = config.pop("model_id", None)
+    return make_cache_key(
+        model_id,
+        agent.system_prompt,
+        prompt,
+        params=config,
+        history=agent.messages,
+        tools=getattr(agent, "tool_names", []),
+    )
+
+def _append_history(agent, prompt, text):
+    """キャッシュヒット時も、実際に呼び出した場合と同じ会話履歴をエージェントに残す"""
+    content = prompt if isinstance(prompt, list) else [{"text": prompt}]
+    agent.messages.append({"role": "user", "content": content})
+    agent.messages.append({"role": "assistant", "content": [{"text": text}]})
+
+async def cached_stream_async(agent, prompt, step=None, cache=None):
+    """agent.stream_async の前段でキャッシュを参照する
+
+    ヒットした場合は保存済みのチャンクを {"data": チャンク} の合成ストリームとして返す。
+    ミスした場合は通常どおりストリーミングし、最後まで完了した応答のみ保存する。
+    キャッシュが無効な場合・step がキャッシュの対象外の場合はそのまま呼び出す。
+    """
+    cache = cache or default_cache
+    if cache is None or not cache.covers(step):
+        async for event in agent.stream_async(prompt):
+            yield event
+        return
+
+    key = agent_cache_key(agent, prompt)
+    # SQLiteの読み書きでイベントループを止めないよう別スレッドで行う
+    chunks = await asyncio.to_thread(cache.get, key)
+    if chunks is not None:
+        for chunk in chunks:
+            yield {"data": chunk}
+        _append_history(agent, prompt, "".join(chunks))
+        return
+
+    recorded = []
+    completed = False
+    async for event in agent.stream_async(prompt):
+        if "data" in event:
+            recorded.append(event["data"])
+        if "result" in event:
+            completed = True
+        yield event
+    if completed:
+        await asyncio.to_thread(cache.put, key, recorded)
+
+def cached_call(agent, prompt, step=None, cache=None):
+    """agent(prompt) の前段でキャッシュを参照し、応答テキストを返す"""
+    cache = cache or default_cache
+    key = agent_cache_key(agent, prompt) if cache is not None and cache.covers(step) else None
+    if key is not None:
+        chunks = cache.get(key)
+        if chunks is not None:
+            text = "".join(chunks)
+            _append_history(agent, prompt, text)
+            return text
+
+    result = agent(prompt)
+    if isinstance(result.message, dict):
+        text = result.message['content'][0]['text']
+    else:
+        text = result.message
+
+    if key is not None:
+        cache.put(key, [text])
+    return text
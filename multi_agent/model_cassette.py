@@ -0,0 +1,210 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from strands.models import BedrockModel
+from strands.models.model import Model
+
+# モデルとのやり取りの記録・再生（カセット）
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# record: 各モデル呼び出しのリクエストと、ストリーミングで返ったイベントを受信時刻（呼び出し開始からのミリ秒）付きで記録する
+# replay: リクエストのハッシュで記録を引き、同じイベントを同じ間隔で返す（ネットワークには接続しない）
+#         記録にないリクエストは CassetteMiss で失敗させる
+# Agent の stream_async / __call__ / invoke_async はいずれもモデルの stream を呼び出すため、モデルの層で記録すれば
+# ツールを使う監督エージェントも含めて全呼び出しを再現できる（ツール自体は再生時も実際に実行される）。
+#
+# 環境変数:
+#   MODEL_CASSETTE             カセットのファイル（JSON Lines、.gz で終わる場合はgzip圧縮。未指定の場合は無効）
+#   MODEL_CASSETTE_MODE        record / replay（既定: replay）
+#   MODEL_CASSETTE_TIME_SCALE  再生時の待ち時間の倍率（既定: 1 = 記録時と同じ間隔、0.1 = 10倍速、0 = 待たない）
+#
+# 記録時は応答キャッシュ（llm_cache）を無効にしておく（LLM_CACHE_ENABLED=0）。キャッシュに当たった呼び出しはモデルに届かないため記録されない。
+
+RECORD = "record"
+REPLAY = "replay"
+
+class CassetteMiss(KeyError):
+    """再生時に記録にないリクエストが来た"""
+
+def _encode(value):
+    """JSONにできない値（画像などの bytes）を {"__bytes__": base64} に置き換える"""
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+def _decode(value):
+    if isinstance(value, dict):
+        if set(value) == {"__bytes__"}:
+            return base64.b64decode(value["__bytes__"])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+def _canonical_messages(messages):
+    """並行に実行したツールの結果は完了順に並ぶため、ハッシュの計算では toolUseId の順に並べ替える"""
+    canonical = []
+    for message in messages:
+        content = message.get("content", [])
+        if content and all("toolResult" in block for block in content):
+            content = sorted(content, key=lambda block: block["toolResult"].get("toolUseId", ""))
+        canonical.append({**message, "content": content})
+    return canonical
+
+def request_key(model_id, messages, tool_specs=None, system_prompt=None, tool_choice=None):
+    """(モデルID, 会話, ツール定義, システムプロンプト, ツール選択) のハッシュ"""
+    material = json.dumps(
+        _encode({
+            "model_id": model_id,
+            "messages": _canonical_messages(messages),
+            "tool_specs": sorted(tool_specs or [], key=lambda spec: spec.get("name", "")),
+            "system_prompt": system_prompt,
+            "tool_choice": tool_choice,
+        }),
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class Cassette:
+    """カセットのファイル1つ分（リクエストのハッシュ → 記録した応答の列）
+
+    同じリクエストが複数回あった場合は記録した順に返し、記録した回数を超えた分は最後の応答を繰り返す。
+    """
+    def __init__(self, path, mode=REPLAY, time_scale=1.0):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"MODEL_CASSETTE_MODE は {RECORD} か {REPLAY} を指定してください: {mode}")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._served = {}
+        if mode == REPLAY:
+            self._load()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から作成（MODEL_CASSETTE が未指定の場合は None）"""
+        path = os.environ.get("MODEL_CASSETTE")
+        if not path:
+            return None
+        return cls(path, os.environ.get("MODEL_CASSETTE_MODE", REPLAY), float(os.environ.get("MODEL_CASSETTE_TIME_SCALE", "1")))
+
+    def _open(self, mode):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self):
+        with self._open("r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+
+    def record(self, entry):
+        """応答を1件追記する（呼び出しが完了した順に書き込む）"""
+        line = json.dumps(_encode(entry), ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            with self._open("a") as f:
+                f.write(line + "\n")
+
+    def next(self, key):
+        """リクエストに対応する記録を返す（記録がなければ CassetteMiss）"""
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMiss(f"カセット {self.path} に記録のないモデル呼び出しです（key={key}）")
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+            return entries[min(index, len(entries) - 1)]
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+def default_cassette():
+    """環境変数で指定したカセット（プロセス内で1つを共有する。未指定の場合は None）"""
+    path = os.environ.get("MODEL_CASSETTE")
+    if not path:
+        return None
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette.from_env()
+        return _cassettes[path]
+
+class CassetteModel(Model):
+    """モデル呼び出しを記録・再生する Strands のモデル
+
+    record では model（BedrockModel や FakeModel）を呼び出して記録し、replay では model を使わずに記録から返す。
+    """
+    def __init__(self, cassette, model_id, model=None, step=None):
+        if cassette.mode == RECORD and model is None:
+            raise ValueError("記録には呼び出し先のモデルが必要です")
+        self.cassette = cassette
+        self.model_id = model_id
+        self.model = model
+        self.step = step
+
+    def update_config(self, **model_config):
+        if self.model is not None:
+            self.model.update_config(**model_config)
+
+    def get_config(self):
+        if self.model is not None:
+            return self.model.get_config()
+        return {"model_id": self.model_id}
+
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        if self.model is None:
+            raise NotImplementedError("構造化出力の再生には対応していません")
+        return self.model.structured_output(output_model, prompt, system_prompt=system_prompt, **kwargs)
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, *, tool_choice=None, system_prompt_content=None, **kwargs):
+        key = request_key(self.model_id, messages, tool_specs, system_prompt_content or system_prompt, tool_choice)
+        if self.cassette.mode == REPLAY:
+            async for event in self._replay(key):
+                yield event
+            return
+
+        started = time.perf_counter()
+        events = []
+        async for event in self.model.stream(
+            messages, tool_specs, system_prompt, tool_choice=tool_choice, system_prompt_content=system_prompt_content, **kwargs
+        ):
+            events.append([round((time.perf_counter() - started) * 1000, 1), event])
+            yield event
+        # 途中で失敗した呼び出し（スロットリングなど）は記録せず、再試行した呼び出しだけを記録する
+        self.cassette.record({"key": key, "model_id": self.model_id, "step": self.step, "events": events})
+
+    async def _replay(self, key):
+        entry = self.cassette.next(key)
+        started = time.perf_counter()
+        for offset_ms, event in entry["events"]:
+            # 記録時の受信時刻まで待つ（待ち時間は開始からの累計で合わせ、sleep の誤差を積み上げない）
+            elapsed = offset_ms / 1000 * self.cassette.time_scale
+            wait = elapsed - (time.perf_counter() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield _decode(event)
+
+def cassette_model(model, step=None):
+    """モデル（モデルIDまたは Model）を環境変数で指定したカセットで記録・再生するモデルにする"""
+    cassette = default_cassette()
+    model_id = model if isinstance(model, str) else model.get_config().get("model_id")
+    if cassette.mode == REPLAY:
+        return CassetteModel(cassette, model_id, step=step)
+    if isinstance(model, str):
+        model = BedrockModel(model_id=model)
+    return CassetteModel(cassette, model_id, model, step)
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import random
+import threading
+from collections import deque
+
+from strands.models import BedrockModel
+from strands.models.model import Model
+
+from telemetry import count
+
+# モデル呼び出しの期限・再試行・ヘッジ
+# 同一内容のファイルを各デプロイ単位（agentcore/, multi_agent/, multi_agent/Flask_Streaming/）に配置している
+# multi_agent/ の版を編集し、tools/sync_shared_modules.py で他へコピーする（tests/test_shared_modules.py で一致を確認）
+#
+# model_registry が全ステップのモデルをこのラッパーで包む。1回のモデル呼び出し（stream）ごとに:
+# - 最初の応答イベントが MODEL_TTFT_TIMEOUT 秒以内に届かなければ打ち切り、ジッター付きの指数バックオフで再試行する
+# - スロットリング（ModelThrottledException）はここでは再試行しない（Strands のイベントループが再試行するため、
+#   ここでも再試行すると試行回数が掛け算で増える）
+# - MODEL_HEDGE_STEPS のステップでは、最初の応答イベントがそのステップの最近の p95 を過ぎても届かなければ
+#   同じリクエストをもう1本送り、先に応答を返し始めた方を使う（もう一方は取り消す）
+# - 呼び出し全体が MODEL_CALL_DEADLINE 秒を超えたら ModelCallTimeout で失敗させる
+# 応答を返し始めた後は呼び出し元にそのまま流しているため、再試行・ヘッジは最初の応答イベントまでの間だけ行う。
+# 再試行・ヘッジ・タイムアウトの回数は telemetry.count で /metrics（counters）と実行ごとの計測値に加算する。
+#
+# 環境変数:
+#   MODEL_RESILIENCE          "0" で無効化（既定: 有効）
+#   MODEL_CALL_DEADLINE       1回の呼び出しの期限（秒、既定: 300）
+#   MODEL_TTFT_TIMEOUT        最初の応答イベントまでの期限（秒、既定: 60）
+#   MODEL_RETRY_ATTEMPTS      最初の応答イベントの期限切れによる再試行を含めた最大試行回数（既定: 4）
+#   MODEL_RETRY_BASE_DELAY    バックオフの基準（秒、既定: 1。n回目の待ち時間は 0〜基準×2^n の一様乱数）
+#   MODEL_RETRY_MAX_DELAY     バックオフの上限（秒、既定: 20）
+#   MODEL_HEDGE_STEPS         ヘッジするステップ名（カンマ区切り、"all" で全ステップ。既定: なし）
+#   MODEL_HEDGE_QUANTILE      ヘッジを送るまでの待ち時間に使う分位（既定: 0.95）
+#   MODEL_HEDGE_DELAY         計測数が MODEL_HEDGE_MIN_SAMPLES 未満の間の待ち時間（秒、既定: 10）
+#   MODEL_HEDGE_MIN_SAMPLES   分位を使い始める計測数（既定: 20）
+
+RESILIENCE_ENABLED = os.environ.get("MODEL_RESILIENCE", "1") != "0"
+CALL_DEADLINE = float(os.environ.get("MODEL_CALL_DEADLINE", "300"))
+TTFT_TIMEOUT = float(os.environ.get("MODEL_TTFT_TIMEOUT", "60"))
+RETRY_ATTEMPTS = int(os.environ.get("MODEL_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.environ.get("MODEL_RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.environ.get("MODEL_RETRY_MAX_DELAY", "20"))
+HEDGE_STEPS = {step.strip() for step in os.environ.get("MODEL_HEDGE_STEPS", "").split(",") if step.strip()}
+HEDGE_QUANTILE = float(os.environ.get("MODEL_HEDGE_QUANTILE", "0.95"))
+HEDGE_DELAY = float(os.environ.get("MODEL_HEDGE_DELAY", "10"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("MODEL_HEDGE_MIN_SAMPLES", "20"))
+# 分位の計算に使う直近の計測数
+TTFT_WINDOW = 200
+
+class ModelCallTimeout(TimeoutError):
+    """モデル呼び出しが期限（最初の応答イベント・呼び出し全体）に間に合わなかった"""
+
+class TtftWindow:
+    """(モデルID, ステップ) ごとの直近の最初の応答イベントまでの時間（秒）"""
+    def __init__(self, size=TTFT_WINDOW):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.size)).append(seconds)
+
+    def quantile(self, key, q):
+        """分位（計測数が HEDGE_MIN_SAMPLES 未満の場合は None）"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+ttft_window = TtftWindow()
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+class _Attempt:
+    """1本のリクエスト（ストリームをタスクで読み進め、最初のイベントが届いたら started を完了する）"""
+    def __init__(self, stream, hedge=False):
+        loop = asyncio.get_running_loop()
+        self.hedge = hedge
+        self.sent_at = loop.time()
+        self.first_at = None
+        self.events = asyncio.Queue()
+        # 最初のイベント（またはストリームの終了）で None、最初のイベントより前に失敗した場合はその例外
+        self.started = loop.create_future()
+        self.task = asyncio.ensure_future(self._pump(stream))
+
+    def _start(self, error=None):
+        if not self.started.done():
+            self.first_at = asyncio.get_running_loop().time()
+            self.started.set_result(error)
+
+    async def _pump(self, stream):
+        try:
+            async for event in stream:
+                self._start()
+                self.events.put_nowait(event)
+        except Exception as e:
+            if not self.started.done():
+                self._start(e)
+                return
+            self.events.put_nowait(_Failure(e))
+            return
+        self._start()
+        self.events.put_nowait(_DONE)
+
+    def cancel(self):
+        self.task.cancel()
+
+def backoff_delay(attempt):
+    """attempt 回目（0始まり）の再試行までの待ち時間（フルジッター）"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class ResilientModel(Model):
+    """期限・再試行・ヘッジ付きで model を呼び出す Strands のモデル"""
+    def __init__(self, model, step=None, hedge=None):
+        self.model = model
+        self.step = step or "model"
+        self.hedge = hedge if hedge is not None else ("all" in HEDGE_STEPS or self.step in HEDGE_STEPS)
+
+    def update_config(self, **model_config):
+        self.model.update_config(**model_config)
+
+    def get_config(self):
+        return self.model.get_config()
+
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        return self.model.structured_output(output_model, prompt, system_prompt=system_prompt, **kwargs)
+
+    def _window_key(self):
+        config = self.get_config()
+        return (config.get("model_id") if isinstance(config, dict) else None, self.step)
+
+    def _hedge_delay(self):
+        quantile = ttft_window.quantile(self._window_key(), HEDGE_QUANTILE)
+        return HEDGE_DELAY if quantile is None else quantile
+
+    async def _first_response(self, start, deadline):
+        """最初の応答イベントが届いたリクエストを返す（ヘッジした場合は先に届いた方。期限切れは ModelCallTimeout）"""
+        loop = asyncio.get_running_loop()
+        attempts = [start()]
+        ttft_deadline = min(loop.time() + TTFT_TIMEOUT, deadline)
+        hedge_at = loop.time() + self._hedge_delay() if self.hedge else None
+        error = None
+        try:
+            while attempts:
+                wake = ttft_deadline if hedge_at is None else min(ttft_deadline, hedge_at)
+                done, _ = await asyncio.wait(
+                    {attempt.started for attempt in attempts}, timeout=max(wake - loop.time(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for attempt in list(attempts):
+                    if attempt.started in done:
+                        attempts.remove(attempt)
+                        if attempt.started.result() is None:
+                            return attempt
+                        error = attempt.started.result()
+                if done:
+                    continue
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    # 最初のリクエストが遅いため同じリクエストをもう1本送る（失敗したリクエストの代わりには送らない）
+                    hedge_at = None
+                    attempts.append(start(hedge=True))
+                    count("model_hedges", self.step)
+                elif loop.time() >= ttft_deadline:
+                    count("model_ttft_timeouts", self.step)
+                    raise ModelCallTimeout(f"{self.step}: 最初の応答イベントが {TTFT_TIMEOUT:g} 秒以内に届きませんでした")
+            raise error
+        finally:
+            # 使わなかったリクエスト（ヘッジで負けた方・期限切れ）は取り消す
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CALL_DEADLINE
+
+        def start(hedge=False):
+            return _Attempt(self.model.stream(messages, tool_specs, system_prompt, **kwargs), hedge)
+
+        for retry in range(RETRY_ATTEMPTS):
+            try:
+                winner = await self._first_response(start, deadline)
+                break
+            except ModelCallTimeout:
+                delay = backoff_delay(retry)
+                if retry == RETRY_ATTEMPTS - 1 or loop.time() + delay >= deadline:
+                    raise
+                count("model_retries", self.step)
+                await asyncio.sleep(delay)
+        if winner.hedge:
+            count("model_hedge_wins", self.step)
+        ttft_window.add(self._window_key(), winner.first_at - winner.sent_at)
+
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(winner.events.get(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    count("model_deadline_exceeded", self.step)
+                    raise ModelCallTimeout(f"{self.step}: 呼び出しが {CALL_DEADLINE:g} 秒以内に終わりませんでした") from None
+                if event is _DONE:
+                    return
+                if isinstance(event, _Failure):
+                    raise event.error
+                yield event
+        finally:
+            # 呼び出し元が途中で読むのをやめた場合（切断・取り消し）もリクエストを止める
+            winner.cancel()
+
+def resilient_model(model, step=None):
+    """モデル（モデルIDまたは Model）を期限・再試行・ヘッジ付きのモデルにする"""
+    if isinstance(model, str):
+        model = BedrockModel(model_id=model)
+    return ResilientModel(model, step)
@@ -1,18 +1,230 @@
 from bedrock_agentcore import BedrockAgentCoreApp
-from strands import Agent, tool
+from strands import Agent, tool, ToolContext
+from strands.tools.executors import ConcurrentToolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import contextvars
 import json
+import os
+import re
+import threading
+import time
+from llm_cache import cached_stream_async
+from broadlistening_ingest import ingest, DEFAULT_SAMPLE_SIZE
+from broadlistening_cluster import summarize_broadlistening
+from model_registry import default_registry
+from telemetry import CallTimer, Telemetry, cache_metrics_event, counter_sinks, measure, metrics_event
 
 app = BedrockAgentCoreApp()
 
-# グローバル変数でエージェント設定を保持
-policy_agent_config = {}
-citizen_agents_config = {}
-broadlistening_analysis = {}
-
-@tool 
-def generate_broadlistening_collection_mock(citizen_opinion: str) -> str:
+# 市民エージェントの既定人数（リクエストの citizen_count で変更可）と、パネル評価の同時実行数の上限
+DEFAULT_CITIZEN_COUNT = int(os.environ.get("CITIZEN_COUNT", "3"))
+PANEL_MAX_CONCURRENCY = int(os.environ.get("PANEL_MAX_CONCURRENCY", "5"))
+# 監督エージェントが1ターンで並行に呼び出したツールのうち、同時に実行する数の上限
+TOOL_MAX_CONCURRENCY = int(os.environ.get("TOOL_MAX_CONCURRENCY", "4"))
+
+# 実行モード（リクエストの mode で変更可）
+#   supervisor: 監督エージェント（LLM）が次に呼ぶツールを判断する（既定）
+#   orchestrated: 決められた手順をコードで直接実行し、監督エージェントのモデル呼び出しを省く
+DEFAULT_MODE = os.environ.get("ORCHESTRATION_MODE", "supervisor")
+# 政策案の作成・評価・改善ループの最大回数
+MAX_POLICY_LOOPS = 3
+
+# 最終報告の見出し（監督エージェントへの指示と build_report の両方がこの順に並べる）
+REPORT_TITLE = "政策検討結果報告"
+REPORT_SECTIONS = (
+    ("市民意見", "検討のきっかけになった市民意見"),
+    ("ブロードリスニング分析", "主要テーマ・市民感情・優先課題"),
+    ("検討体制", "政策作成エージェントと市民エージェントの構成"),
+    ("検討経過", "各回の得点・判定・評価者の人数"),
+    ("最終判定", "承認・未承認・廃案のいずれかと最終の得点"),
+    ("市民からの改善提案", "最終回の評価で挙がった改善提案（なければ「なし」）"),
+    ("ブロードリスニング分析結果の反映", "分析結果が政策にどのように反映されたか"),
+    ("最終政策案", "最終的な政策案のハンドル（artifact://policy/...）を1行で記載（本文に展開されます）"),
+)
+
+# ブロードリスニング分析の map-reduce
+# 投稿はクラスタの要約（BROADLISTENING_CLUSTERS 個）にまとめてから渡すため、1回の分析で扱える投稿数を超えると
+# 少数派のテーマがクラスタに埋もれる。収集した投稿がシャードの大きさを超える場合は、投稿をシャードに分けて
+# シャードごとにクラスタにまとめて分析し（map）、部分結果を統合する（reduce）。
+# 既定のシャードの大きさは収集件数の既定（BROADLISTENING_SAMPLE_SIZE）と同じで、リクエストの broadlistening.sample_size で
+# それより多くの投稿を収集した場合に map-reduce になる。
+#   BROADLISTENING_SHARD_SIZE       1回の分析で扱う投稿数（既定: BROADLISTENING_SAMPLE_SIZE）
+#   BROADLISTENING_MAP_CONCURRENCY  シャードの分析・統合の同時実行数
+#   BROADLISTENING_REDUCE_FAN_IN    1回の統合でまとめる部分結果の数
+BROADLISTENING_SHARD_SIZE = int(os.environ.get("BROADLISTENING_SHARD_SIZE") or DEFAULT_SAMPLE_SIZE)
+BROADLISTENING_MAP_CONCURRENCY = int(os.environ.get("BROADLISTENING_MAP_CONCURRENCY", "4"))
+REDUCE_FAN_IN = int(os.environ.get("BROADLISTENING_REDUCE_FAN_IN", "4"))
+
+# ブロードリスニングの収集元となるSNS投稿コーパス（JSONL / Parquet のファイルまたはディレクトリ）
+# 指定しない場合（リクエストの broadlistening.path もない場合）はLLMで架空の投稿を生成する
+#   BROADLISTENING_CORPUS_ROOTS       リクエストの broadlistening.path で指定できるディレクトリ（os.pathsep 区切り、
+#                                     既定: BROADLISTENING_CORPUS のみ）。相対パスは先頭のディレクトリからの位置とみなす
+#   BROADLISTENING_MAX_SAMPLE_SIZE    リクエストの broadlistening.sample_size の上限（既定: 10000）
+BROADLISTENING_CORPUS = os.environ.get("BROADLISTENING_CORPUS") or None
+BROADLISTENING_CORPUS_ROOTS = [
+    os.path.realpath(root)
+    for root in (os.environ.get("BROADLISTENING_CORPUS_ROOTS") or BROADLISTENING_CORPUS or "").split(os.pathsep) if root
+]
+BROADLISTENING_MAX_SAMPLE_SIZE = int(os.environ.get("BROADLISTENING_MAX_SAMPLE_SIZE", "10000"))
+
+# 共通部分（政策案・評価形式）をシステムプロンプトにまとめ、Bedrockのプロンプトキャッシュの対象にする
+#   "0" で無効化（キャッシュ非対応のモデルを使う場合など）
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE_ENABLED", "1") != "0"
+# 実行中のツールの計測（ツール内のモデル呼び出しのトークン数・リトライ回数をツールの計測値に含める）
+current_tool = contextvars.ContextVar("current_tool", default=None)
+# 集計するトークン使用量の項目
+USAGE_KEYS = ("inputTokens", "outputTokens", "totalTokens", "cacheReadInputTokens", "cacheWriteInputTokens")
+
+# ツール間で受け渡すデータのハンドル（例: artifact://policy/2）
+ARTIFACT_SCHEME = "artifact://"
+ARTIFACT_PATTERN = re.compile(r"artifact://([a-z_]+)/(\d+)")
+
+class RunContext:
+    """1回の実行（invoke）の中でツール間で共有する状態
+
+    同じプロセスで複数の invoke が並行しても互いの設定が混ざらないよう、
+    グローバル変数ではなく実行ごとに作成して監督エージェントの invocation_state で各ツールに渡す。
+    """
+    def __init__(self, citizen_count=DEFAULT_CITIZEN_COUNT, broadlistening_source=None, models=None):
+        self.citizen_count = citizen_count
+        # ステップごとのモデル割り当て（リクエストの models で上書きしたもの）
+        self.models = models or default_registry
+        # コーパスからの収集設定（path, query, collection_window, sample_size）。None の場合はモック生成
+        self.broadlistening_source = broadlistening_source
+        self.policy_agent_config = {}
+        self.citizen_agents_config = {}
+        self.broadlistening_analysis = {}
+        # トークン使用量（"supervisor": 監督エージェント, "tools": ツール内のモデル呼び出し）
+        self.usage = {}
+        # ステップごとのトークン使用量（プロンプトキャッシュの読み書き・呼び出し回数を含む）
+        self.step_usage = {}
+        self._usage_lock = threading.Lock()
+        # ツール間で受け渡す大きなデータ（ハンドル "artifact://種類/番号" で参照する）
+        self.artifacts = {}
+        self._artifact_lock = threading.Lock()
+        # 同時に実行するツールの数を TOOL_MAX_CONCURRENCY 個までに抑える
+        self.tool_slots = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+        # ストリーミングで呼び出された場合の進捗イベントの送り先
+        self.events = None
+        # この実行の計測値（プロセス全体の集計は telemetry.default_telemetry）
+        self.telemetry = Telemetry()
+
+    def put_artifact(self, kind, value):
+        """データを保存し、参照用のハンドルを返す"""
+        with self._artifact_lock:
+            number = sum(1 for handle in self.artifacts if handle.startswith(f"{ARTIFACT_SCHEME}{kind}/")) + 1
+            handle = f"{ARTIFACT_SCHEME}{kind}/{number}"
+            self.artifacts[handle] = value
+        return handle
+
+    def resolve(self, value):
+        """ハンドルであれば保存済みのデータに置き換える（ハンドル以外はそのまま返す）"""
+        if not isinstance(value, str) or not ARTIFACT_PATTERN.fullmatch(value.strip()):
+            return value
+        handle = value.strip()
+        with self._artifact_lock:
+            if handle not in self.artifacts:
+                raise ValueError(f"不明なアーティファクトです: {handle}")
+            return self.artifacts[handle]
+
+    def expand_artifacts(self, text, kinds=("policy",)):
+        """文章中のハンドルを保存済みのデータに展開（最終報告用）"""
+        def expand(match):
+            handle = match.group(0)
+            if match.group(1) in kinds and handle in self.artifacts:
+                return f"\n\n{self.artifacts[handle]}\n\n"
+            return handle
+        return ARTIFACT_PATTERN.sub(expand, text)
+
+    def emit(self, event):
+        """進捗イベントを通知（ストリーミングで呼び出されていない場合は何もしない）"""
+        if self.events is not None:
+            self.events.put_nowait(event)
+
+    def add_usage(self, role, usage):
+        """モデル呼び出しのトークン使用量を加算"""
+        with self._usage_lock:
+            total = self.usage.setdefault(role, {})
+            for key in USAGE_KEYS:
+                total[key] = total.get(key, 0) + usage.get(key, 0)
+
+    def add_step_usage(self, step, usage, ttft=None):
+        """ステップ（例: citizen_panel）ごとの使用量を加算"""
+        with self._usage_lock:
+            total = self.step_usage.setdefault(step, {})
+            for key in USAGE_KEYS:
+                total[key] = total.get(key, 0) + usage.get(key, 0)
+            total["requests"] = total.get("requests", 0) + 1
+            if ttft is not None:
+                total["ttft_total"] = total.get("ttft_total", 0) + ttft
+
+def get_run_context(tool_context: ToolContext) -> RunContext:
+    """ツールの実行中の RunContext を取得"""
+    return tool_context.invocation_state["run_context"]
+
+@asynccontextmanager
+async def tool_slot(tool_context: ToolContext):
+    """ツールの実行枠を確保して RunContext を返す（空きがなければ他のツールの完了を待つ）
+
+    枠の確保を待った時間（wait_ms）と実行の所要時間を計測し、metrics イベントとして通知する。
+    """
+    ctx = get_run_context(tool_context)
+    queued = time.perf_counter()
+    async with ctx.tool_slots:
+        timer = CallTimer(tool_context.tool_use["name"], kind="tool", sinks=(ctx.telemetry,))
+        wait_ms = round((timer.started - queued) * 1000)
+        token = current_tool.set(timer)
+        error = None
+        try:
+            yield ctx
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_tool.reset(token)
+            ctx.emit(metrics_event(timer.finish(error=error, wait_ms=wait_ms)))
+
+async def ask(ctx, agent, prompt, step=None, first_chunk=None):
+    """ツール内のモデル呼び出し（キャッシュを参照してストリーミングで受け取り、使用量を RunContext に記録）
+
+    step を指定した場合はステップごとの使用量（プロンプトキャッシュの読み書き・最初のトークンまでの時間を含む）にも記録する。
+    first_chunk（asyncio.Event）を指定した場合は最初のチャンクを受け取った時点で set する。
+    """
+    parts = []
+    timer = CallTimer(step or "model", sinks=(ctx.telemetry,))
+    async for event in measure(cached_stream_async(agent, prompt, step), timer):
+        if "data" in event:
+            if not parts and first_chunk is not None:
+                first_chunk.set()
+            parts.append(event["data"])
+    usage = agent.event_loop_metrics.accumulated_usage
+    ctx.add_usage("tools", usage)
+    if step is not None:
+        ctx.add_step_usage(step, usage, timer.ttft)
+    if current_tool.get() is not None:
+        current_tool.get().absorb(timer)
+    ctx.emit(metrics_event(timer.record))
+    return "".join(parts)
+
+def usage_summary(usage):
+    """ステップの使用量の集計（キャッシュのヒット率と最初のトークンまでの時間の平均を含む）"""
+    prompt_tokens = usage.get("inputTokens", 0) + usage.get("cacheReadInputTokens", 0) + usage.get("cacheWriteInputTokens", 0)
+    requests = usage.get("requests", 0)
+    return {
+        **{key: value for key, value in usage.items() if key != "ttft_total"},
+        "cache_hit_ratio": round(usage.get("cacheReadInputTokens", 0) / prompt_tokens, 3) if prompt_tokens else 0.0,
+        "ttft_ms_avg": round(usage.get("ttft_total", 0) * 1000 / requests) if requests else None,
+    }
+
+def citizen_number(key):
+    """citizen_agent_3 のようなキーから番号を取り出す（並び順用）"""
+    suffix = key.rsplit("_", 1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+async def collect_broadlistening_mock(ctx, citizen_opinion):
     """ブロードリスニングのデータ収集のモック作成（SNS検索キーワードと架空投稿を生成し、ブロードリスニング用JSONを返す）"""
-    mock_agent = Agent(model="us.anthropic.claude-sonnet-4-20250514-v1:0")
+    mock_agent = Agent(model=ctx.models.model_for("broadlistening"))
 
     # 生成AIへのプロンプト
     # - 出力は純粋なJSON文字列のみ
@@ -63,8 +275,7 @@ def generate_broadlistening_collection_mock(citizen_opinion: str) -> str:
 }}
 """
     # モデル呼び出し
-    result = mock_agent(prompt)
-    text = result.message['content'][0]['text'] if isinstance(result.message, dict) else result.message
+    text = await ask(ctx, mock_agent, prompt, step="broadlistening_mock")
     text = text.strip()
 
     # 純JSONで返ってくる前提。パースできたらJSON文字列として返す（構造は維持）
@@ -75,21 +286,100 @@ def generate_broadlistening_collection_mock(citizen_opinion: str) -> str:
         # 例外処理
         raise ValueError(f"generate_broadlistening_collection_mock returned non-JSON output: {str(e)}")
 
-@tool
-def analyze_broadlistening_results(citizen_opinion: str, broadlistening_data: str) -> str:
-    """ブロードリスニング結果分析エージェント"""
-    global broadlistening_analysis
-    
-    analysis_agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
-    )
-    
+async def generate_search_query(ctx, citizen_opinion):
+    """市民意見からコーパス検索用のSNS検索クエリ（キーワード1 OR キーワード2 ... lang:ja）を作成"""
+    query_agent = Agent(model=ctx.models.model_for("broadlistening"))
     prompt = f"""
+あなたはSNSリサーチャーです。以下の市民意見に関連する投稿を集めるためのSNS検索キーワードを5〜8個作成してください。
+キーワードは1〜3語（空白区切りの語はすべて含む投稿に一致）とし、" OR " でつないで末尾に lang:ja を付けた1行だけを出力してください。
+説明文・前置き・コードブロックは禁止です。
+
+入力の市民意見:
+{citizen_opinion}
+
+出力例:
+保育園 送迎 OR 待機児童 OR 学童 定員 OR 子育て支援 申請 lang:ja
+"""
+    query = (await ask(ctx, query_agent, prompt, step="search_query")).strip().splitlines()
+    return query[0].strip() if query else f"{citizen_opinion} lang:ja"
+
+def corpus_path(path):
+    """リクエストで指定されたコーパスのパスを BROADLISTENING_CORPUS_ROOTS の中の実際のパスにする（外を指す場合は ValueError）"""
+    if not isinstance(path, str) or not path.strip():
+        raise ValueError("broadlistening.path はファイルまたはディレクトリのパスで指定してください")
+    if not BROADLISTENING_CORPUS_ROOTS:
+        raise ValueError("broadlistening.path は指定できません（BROADLISTENING_CORPUS_ROOTS が設定されていません）")
+    # シンボリックリンクや .. で許可したディレクトリの外に出られないよう、解決した後のパスで確認する
+    resolved = os.path.realpath(os.path.join(BROADLISTENING_CORPUS_ROOTS[0], path))
+    for root in BROADLISTENING_CORPUS_ROOTS:
+        if resolved == root or resolved.startswith(root.rstrip(os.sep) + os.sep):
+            return resolved
+    raise ValueError(f"broadlistening.path が指定できるディレクトリの外を指しています: {path}")
+
+def broadlistening_source_from(payload):
+    """リクエストの broadlistening から収集元の設定を作成（コーパスを使わない場合は None、不正な指定は ValueError）"""
+    requested = payload.get("broadlistening") or {}
+    if not isinstance(requested, dict):
+        raise ValueError("broadlistening はオブジェクトで指定してください")
+    source = dict(requested)
+    if source.get("path") is not None:
+        source["path"] = corpus_path(source["path"])
+    else:
+        source["path"] = BROADLISTENING_CORPUS
+    if not source["path"]:
+        return None
+
+    sample_size = source.get("sample_size", DEFAULT_SAMPLE_SIZE)
+    if isinstance(sample_size, bool) or not isinstance(sample_size, (int, str)):
+        raise ValueError("broadlistening.sample_size は整数で指定してください")
+    try:
+        sample_size = int(sample_size)
+    except ValueError:
+        raise ValueError("broadlistening.sample_size は整数で指定してください") from None
+    if not 1 <= sample_size <= BROADLISTENING_MAX_SAMPLE_SIZE:
+        raise ValueError(f"broadlistening.sample_size は 1〜{BROADLISTENING_MAX_SAMPLE_SIZE} で指定してください")
+    source["sample_size"] = sample_size
+    return source
+
+async def collect_broadlistening(ctx, citizen_opinion):
+    """ブロードリスニング用JSONの収集（コーパスが指定されていればそこから絞り込み、なければモックを生成）"""
+    source = ctx.broadlistening_source
+    if not source:
+        return await collect_broadlistening_mock(ctx, citizen_opinion)
+
+    query = source.get("query") or await generate_search_query(ctx, citizen_opinion)
+    # コーパスの読み込みはディスクとCPUを使うため、イベントループを止めないよう別スレッドで行う
+    data = await asyncio.to_thread(
+        ingest,
+        source["path"],
+        query,
+        source.get("collection_window"),
+        sample_size=source.get("sample_size", DEFAULT_SAMPLE_SIZE),
+    )
+    return json.dumps(data, ensure_ascii=False)
+
+@tool(context=True)
+async def generate_broadlistening_collection_mock(citizen_opinion: str, tool_context: ToolContext) -> str:
+    """ブロードリスニングのデータ収集（コーパスが指定されていれば実データを絞り込み、なければSNS検索キーワードと架空投稿を生成）。収集データのハンドルを返す"""
+    async with tool_slot(tool_context) as ctx:
+        bl_data = await collect_broadlistening(ctx, citizen_opinion)
+    handle = ctx.put_artifact("bl", bl_data)
+    return json.dumps({"broadlistening_data": handle, "samples": len(json.loads(bl_data).get("samples", []))}, ensure_ascii=False)
+
+async def cluster_broadlistening(data):
+    """収集データ（dict）の投稿をクラスタにまとめた要約（JSON文字列）"""
+    # ベクトル化とk-meansはCPUを使うため、イベントループを止めないよう別スレッドで行う
+    summary = await asyncio.to_thread(summarize_broadlistening, data)
+    return json.dumps(summary, ensure_ascii=False)
+
+def broadlistening_analysis_prompt(citizen_opinion, clustered_data):
+    """ブロードリスニング結果分析のプロンプト（clustered_data はクラスタの要約）"""
+    return f"""
 あなたはブロードリスニング結果分析の専門家です。
 市民意見「{citizen_opinion}」に関連するブロードリスニングデータを分析してください。
 
-ブロードリスニングデータ:
-{broadlistening_data}
+ブロードリスニングデータ（投稿を内容の近さでまとめたクラスタごとの件数・割合・推定投稿数と代表投稿）:
+{clustered_data}
 
 取得したブロードリスニングデータを分析する過程をコードも踏まえて示してください。
 
@@ -126,24 +416,127 @@ def analyze_broadlistening_results(citizen_opinion: str, broadlistening_data: st
 }}
 
 分析では以下の点に注目してください：
-1. 市民の声の中で最も頻繁に言及される課題
+1. 市民の声の中で最も頻繁に言及される課題（クラスタの件数・割合を言及頻度の根拠にする）
 2. 感情的な反応（不満、期待、要望）の傾向
 3. 異なる市民層の異なるニーズ
 4. 実現可能性と優先順位
 5. 政策立案への具体的な示唆
 """
-    
-    result = analysis_agent(prompt)
-    if isinstance(result.message, dict):
-        analysis_text = result.message['content'][0]['text']
-    else:
-        analysis_text = result.message
-    
+
+def broadlistening_merge_prompt(citizen_opinion, partials):
+    """分割して分析した部分結果を1つに統合するプロンプト"""
+    return f"""
+あなたはブロードリスニング結果分析の専門家です。
+市民意見「{citizen_opinion}」に関連するブロードリスニングデータを複数に分割して分析した部分結果があります。
+posts はその部分結果が対象とした投稿数です。
+
+部分結果:
+{json.dumps(partials, ensure_ascii=False)}
+
+部分結果を統合し、部分結果と同じJSON形式（main_themes, sentiment_analysis, priority_issues, demographic_insights,
+policy_recommendations, implementation_considerations）の分析結果を1つだけ出力してください（説明文は不要）。
+- 重複するテーマ・課題・提案はまとめ、投稿数の多い部分結果で言及されたものを優先する
+- sentiment_analysis の各比率は posts で重み付けした平均にする
+- priority_issues の frequency は統合後の全体に対する言及頻度にする
+"""
+
+def parse_analysis(text):
+    """分析結果のJSONを読み込む（JSONのオブジェクトでなければ None）"""
     try:
-        broadlistening_analysis = json.loads(analysis_text)
-        return f"ブロードリスニング分析完了: {len(broadlistening_analysis.get('main_themes', []))}つの主要テーマを特定"
-    except:
-        broadlistening_analysis = {
+        analysis = json.loads(extract_json_text(text.strip()))
+    except (TypeError, ValueError):
+        return None
+    return analysis if isinstance(analysis, dict) else None
+
+async def analyze_broadlistening_once(ctx, citizen_opinion, clustered_data):
+    """クラスタの要約（JSON文字列）を1回のモデル呼び出しで分析"""
+    analysis_agent = Agent(
+        model=ctx.models.model_for("broadlistening")
+    )
+    return parse_analysis(await ask(ctx, analysis_agent, broadlistening_analysis_prompt(citizen_opinion, clustered_data), step="broadlistening_analysis"))
+
+async def map_reduce_broadlistening(ctx, citizen_opinion, data):
+    """投稿をシャードに分けて並行に分析し（map）、部分結果を REDUCE_FAN_IN 件ずつ段階的に統合する（reduce）
+
+    統合の段数はシャード数の対数で増えるだけで、1回のプロンプトの大きさはクラスタ数と REDUCE_FAN_IN で決まる。
+    """
+    samples = data["samples"]
+    shards = [samples[i:i + BROADLISTENING_SHARD_SIZE] for i in range(0, len(samples), BROADLISTENING_SHARD_SIZE)]
+    slots = asyncio.Semaphore(BROADLISTENING_MAP_CONCURRENCY)
+    ctx.emit({"type": "status", "data": f"[ブロードリスニング分析] {len(samples)}件を{len(shards)}シャードに分けて分析中..."})
+
+    progress = {"done": 0}
+    async def analyze_shard(number, shard):
+        meta = {**data.get("meta", {}), "shard": number, "shards": len(shards)}
+        # クラスタの推定投稿数がシャードの取り分になるよう、全体の件数をシャードの大きさで按分する
+        if meta.get("filtered_count"):
+            meta["filtered_count"] = round(meta["filtered_count"] * len(shard) / len(samples))
+        try:
+            async with slots:
+                clustered_data = await cluster_broadlistening({**data, "meta": meta, "samples": shard})
+                analysis = await analyze_broadlistening_once(ctx, citizen_opinion, clustered_data)
+        except Exception:
+            analysis = None
+        progress["done"] += 1
+        ctx.emit({"type": "progress", "step": "broadlistening_map", "data": {
+            "shard": number, "done": progress["done"], "total": len(shards), "failed": analysis is None,
+        }})
+        return {"posts": len(shard), "analysis": analysis} if analysis else None
+
+    # 分析に失敗したシャードは除いて統合する（全シャードが失敗した場合のみ分析失敗）
+    partials = [partial for partial in await asyncio.gather(*(analyze_shard(number, shard) for number, shard in enumerate(shards, 1))) if partial]
+
+    round_number = 0
+    while len(partials) > 1:
+        round_number += 1
+        groups = [partials[i:i + REDUCE_FAN_IN] for i in range(0, len(partials), REDUCE_FAN_IN)]
+        ctx.emit({"type": "status", "data": f"[ブロードリスニング分析] 部分結果{len(partials)}件を統合中（{round_number}段目）..."})
+
+        async def merge(number, group):
+            if len(group) == 1:
+                return group[0]
+            merge_agent = Agent(
+                model=ctx.models.model_for("broadlistening")
+            )
+            try:
+                async with slots:
+                    analysis = parse_analysis(await ask(ctx, merge_agent, broadlistening_merge_prompt(citizen_opinion, group), step="broadlistening_merge"))
+            except Exception:
+                analysis = None
+            ctx.emit({"type": "progress", "step": "broadlistening_reduce", "data": {
+                "round": round_number, "group": number, "total": len(groups), "failed": analysis is None,
+            }})
+            posts = sum(partial["posts"] for partial in group)
+            # 統合に失敗した場合は投稿数の最も多い部分結果で代表させる
+            return {"posts": posts, "analysis": analysis or max(group, key=lambda partial: partial["posts"])["analysis"]}
+
+        partials = list(await asyncio.gather(*(merge(number, group) for number, group in enumerate(groups, 1))))
+
+    return partials[0]["analysis"] if partials else None
+
+async def analyze_broadlistening(ctx, citizen_opinion, broadlistening_data):
+    """ブロードリスニング結果分析エージェント（投稿はクラスタの件数と代表投稿にまとめてから渡す）
+
+    投稿が BROADLISTENING_SHARD_SIZE 件を超える場合は map-reduce で分析する。
+    投稿を含まない・解釈できないデータはそのまま1回で分析する。
+    """
+    try:
+        data = json.loads(broadlistening_data)
+    except (TypeError, ValueError):
+        data = None
+
+    if not isinstance(data, dict) or not data.get("samples"):
+        analysis = await analyze_broadlistening_once(ctx, citizen_opinion, broadlistening_data)
+    elif len(data["samples"]) > BROADLISTENING_SHARD_SIZE:
+        analysis = await map_reduce_broadlistening(ctx, citizen_opinion, data)
+    else:
+        analysis = await analyze_broadlistening_once(ctx, citizen_opinion, await cluster_broadlistening(data))
+
+    if analysis is not None:
+        ctx.broadlistening_analysis = analysis
+        return f"ブロードリスニング分析完了: {len(ctx.broadlistening_analysis.get('main_themes', []))}つの主要テーマを特定"
+    else:
+        ctx.broadlistening_analysis = {
             "main_themes": ["一般的な課題"],
             "sentiment_analysis": {"positive_ratio": 0.3, "negative_ratio": 0.5, "neutral_ratio": 0.2},
             "priority_issues": [{"issue": "基本的な課題", "frequency": "中", "urgency": "中", "impact": "中"}],
@@ -151,13 +544,17 @@ def analyze_broadlistening_results(citizen_opinion: str, broadlistening_data: st
         }
         return "デフォルトブロードリスニング分析設定"
 
-@tool
-def setup_policy_agent(citizen_opinion: str) -> str:
+@tool(context=True)
+async def analyze_broadlistening_results(citizen_opinion: str, broadlistening_data: str, tool_context: ToolContext) -> str:
+    """ブロードリスニング結果分析エージェント（broadlistening_data には収集データのハンドルを指定）"""
+    async with tool_slot(tool_context) as ctx:
+        return await analyze_broadlistening(ctx, citizen_opinion, ctx.resolve(broadlistening_data))
+
+async def configure_policy_agent(ctx, citizen_opinion):
     """政策作成エージェントの設定"""
-    global policy_agent_config
-    
+
     setup_agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model=ctx.models.model_for("setup")
     )
     
     prompt = f"""
@@ -183,11 +580,7 @@ def setup_policy_agent(citizen_opinion: str) -> str:
 }}
 """
     
-    result = setup_agent(prompt)
-    if isinstance(result.message, dict):
-        config_text = result.message['content'][0]['text']
-    else:
-        config_text = result.message
+    config_text = await ask(ctx, setup_agent, prompt, step="policy_agent_setup")
     
     # JSON抽出（マークダウンコードブロック対応）
     config_text = config_text.strip()
@@ -197,14 +590,14 @@ def setup_policy_agent(citizen_opinion: str) -> str:
         config_text = config_text.split('```')[1].split('```')[0].strip()
     
     try:
-        policy_agent_config = json.loads(config_text)
+        ctx.policy_agent_config = json.loads(config_text)
         return json.dumps({
             "status": "success",
-            "role": policy_agent_config['role'],
-            "config": policy_agent_config
+            "role": ctx.policy_agent_config['role'],
+            "config": ctx.policy_agent_config
         }, ensure_ascii=False)
     except Exception as e:
-        policy_agent_config = {
+        ctx.policy_agent_config = {
             "role": "政策立案専門家",
             "specialty": "一般政策",
             "background": "行政経験10年",
@@ -212,25 +605,30 @@ def setup_policy_agent(citizen_opinion: str) -> str:
         }
         return json.dumps({
             "status": "fallback",
-            "role": policy_agent_config['role'],
+            "role": ctx.policy_agent_config['role'],
             "error": str(e),
-            "config": policy_agent_config
+            "config": ctx.policy_agent_config
         }, ensure_ascii=False)
 
-@tool
-def setup_citizen_agents(citizen_opinion: str) -> str:
-    """3つの市民エージェントの設定"""
-    global citizen_agents_config
+@tool(context=True)
+async def setup_policy_agent(citizen_opinion: str, tool_context: ToolContext) -> str:
+    """政策作成エージェントの設定（setup_citizen_agents とは独立しているため同じターンで並行に呼び出せる）"""
+    async with tool_slot(tool_context) as ctx:
+        return await configure_policy_agent(ctx, citizen_opinion)
+
+async def configure_citizen_agents(ctx, citizen_opinion):
+    """市民エージェントの設定（人数は実行ごとの citizen_count）"""
+    citizen_count = ctx.citizen_count
 
     setup_agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model=ctx.models.model_for("setup")
     )
 
     prompt = f"""
-市民意見「{citizen_opinion}」に基づいて、現実的な賛否分布を反映した3つの市民エージェントを設定してください。
+市民意見「{citizen_opinion}」に基づいて、現実的な賛否分布を反映した{citizen_count}人の市民エージェントを設定してください。
 
 【基本方針】
-この政策に対して「実際の市民の何%が賛成しそうか？」を考え、その分布に合わせて3人を設定してください。
+この政策に対して「実際の市民の何%が賛成しそうか？」を考え、その分布に合わせて{citizen_count}人を設定してください。
 全ての政策に機械的に「賛成・中立・反対」を割り当てるのではなく、政策の性質に応じて柔軟に選んでください。
 
 【利害関係の5分類】（同じ分類を複数回選択してもOK）
@@ -241,7 +639,7 @@ def setup_citizen_agents(citizen_opinion: str) -> str:
 • 慎重派: 目的には賛同するが、実現可能性・副作用・コストに懸念
 • 反対派: 政策により不利益を被る立場
 
-【選択パターンの例】
+【選択パターンの例】（3人の場合。人数が異なる場合は同じ比率になるように選んでください）
 
 賛成多数が予想される政策（安全対策、災害対応など）
 → 支持派2人 + 条件付き支持派1人
@@ -277,30 +675,25 @@ def setup_citizen_agents(citizen_opinion: str) -> str:
 あなたの立場からの率直な期待や懸念を表現してください。"
   }},
   "citizen_agent_2": {{ ... }},
-  "citizen_agent_3": {{ ... }}
+  ...（citizen_agent_{citizen_count} まで同じ形式）
 }}
 """
 
-    result = setup_agent(prompt)
-    if isinstance(result.message, dict):
-        config_text = result.message['content'][0]['text']
-    else:
-        config_text = result.message
+    config_text = await ask(ctx, setup_agent, prompt, step="citizen_agents_setup")
 
     try:
         # JSON抽出（マークダウンのコードブロックに囲まれている場合に対応）
-        import re
         json_match = re.search(r'```json\s*(\{.*?\})\s*```', config_text, re.DOTALL)
         if json_match:
             config_text = json_match.group(1)
         elif '```' in config_text:
             config_text = config_text.split('```')[1].replace('json', '').strip()
 
-        citizen_agents_config = json.loads(config_text)
-        names = [citizen_agents_config[f"citizen_agent_{i}"]["name"] for i in range(1, 4)]
+        ctx.citizen_agents_config = json.loads(config_text)
+        names = [config["name"] for _, config in sorted(ctx.citizen_agents_config.items(), key=lambda item: citizen_number(item[0]))]
         return f"市民エージェント設定完了: {', '.join(names)}"
     except:
-        citizen_agents_config = {
+        ctx.citizen_agents_config = {
             "citizen_agent_1": {
                 "name": "田中恵美",
                 "age": 35,
@@ -334,16 +727,28 @@ def setup_citizen_agents(citizen_opinion: str) -> str:
         }
         return "デフォルト市民エージェント設定"
 
-@tool
-def create_policy(citizen_opinion: str) -> str:
+@tool(context=True)
+async def setup_citizen_agents(citizen_opinion: str, tool_context: ToolContext) -> str:
+    """市民エージェントの設定（人数は実行ごとの citizen_count。setup_policy_agent と並行に呼び出せる）"""
+    async with tool_slot(tool_context) as ctx:
+        return await configure_citizen_agents(ctx, citizen_opinion)
+
+def policy_tool_result(handle, policy_text, limit=400):
+    """政策案のツール結果（本文の代わりにハンドルと【政策サマリー】の部分だけを返す）"""
+    summary = policy_text
+    if "【政策サマリー】" in policy_text:
+        summary = policy_text.split("【政策サマリー】", 1)[1].split("【", 1)[0]
+    return json.dumps({"policy": handle, "summary": summary.strip()[:limit]}, ensure_ascii=False)
+
+async def draft_policy(ctx, citizen_opinion):
     """政策作成エージェントによる政策案作成（ブロードリスニング分析結果を含む）"""
-    global policy_agent_config, broadlistening_analysis
-    
+    broadlistening_analysis = ctx.broadlistening_analysis
+
     policy_agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model=ctx.models.model_for("policy")
     )
     
-    system_prompt = policy_agent_config.get("system_prompt", "政策案を作成してください。")
+    system_prompt = ctx.policy_agent_config.get("system_prompt", "政策案を作成してください。")
     
     # ブロードリスニング分析結果を整形
     if broadlistening_analysis:
@@ -403,25 +808,19 @@ def create_policy(citizen_opinion: str) -> str:
 """
 
     
-    result = policy_agent(prompt)
-    if isinstance(result.message, dict):
-        return result.message['content'][0]['text']
-    return result.message
+    return await ask(ctx, policy_agent, prompt, step="policy_draft")
 
-@tool
-def evaluate_policy_citizen1(policy_text: str) -> str:
-    """市民エージェント1による評価"""
-    global citizen_agents_config
+@tool(context=True)
+async def create_policy(citizen_opinion: str, tool_context: ToolContext) -> str:
+    """政策作成エージェントによる政策案作成（ブロードリスニング分析結果を含む）。政策案のハンドルと要約を返す"""
+    async with tool_slot(tool_context) as ctx:
+        policy_text = await draft_policy(ctx, citizen_opinion)
+    return policy_tool_result(ctx.put_artifact("policy", policy_text), policy_text)
 
-    agent_config = citizen_agents_config.get("citizen_agent_1", {})
-    agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
-    )
-
-    system_prompt = agent_config.get("system_prompt", "政策を評価してください。")
-
-    prompt = f"""
-{system_prompt}
+def citizen_evaluation_prompt(policy_text):
+    """全市民で共通の評価プロンプト（政策案と評価形式。システムプロンプトとしてキャッシュする）"""
+    return f"""
+あなたは市民エージェントとして政策案を評価します。あなたが誰であるかはメッセージで指定されます。
 
 政策案: {policy_text}
 
@@ -476,177 +875,111 @@ def evaluate_policy_citizen1(policy_text: str) -> str:
 - innovation: 今までと違う新しい試みとして評価できるか
 """
 
-    result = agent(prompt)
-    if isinstance(result.message, dict):
-        return result.message['content'][0]['text']
-    return result.message
-
-@tool
-def evaluate_policy_citizen2(policy_text: str) -> str:
-    """市民エージェント2による評価"""
-    global citizen_agents_config
-
-    agent_config = citizen_agents_config.get("citizen_agent_2", {})
-    agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
-    )
-
-    system_prompt = agent_config.get("system_prompt", "政策を評価してください。")
-
-    prompt = f"""
+def citizen_persona_prompt(system_prompt):
+    """市民エージェントごとに異なる部分（人物設定）"""
+    return f"""
 {system_prompt}
 
-政策案: {policy_text}
-
-以下の8つの観点で100点満点で評価し、JSON形式で回答してください。
-あなた自身の日常生活、価値観、立場に基づいて率直に評価してください。
-
-{{
-  "personal_impact": {{
-    "score": 0-100,
-    "comment": "この政策があなた自身や家族にどう影響するか（恩恵と負担を総合して）"
-  }},
-  "feasibility": {{
-    "score": 0-100,
-    "comment": "本当に実現できそうか（予算、法制度、実装の難易度）"
-  }},
-  "cost_effectiveness": {{
-    "score": 0-100,
-    "comment": "かかる費用に対して、得られる効果は十分か"
-  }},
-  "coverage": {{
-    "score": 0-100,
-    "comment": "この政策で助かる人はどれくらいいるか、広く恩恵があるか"
-  }},
-  "fairness": {{
-    "score": 0-100,
-    "comment": "特定の人だけが得したり損したりしないか、不公平感はないか"
-  }},
-  "risks": {{
-    "score": 0-100,
-    "comment": "副作用や予期しない悪影響のリスク（高いほど安全）"
-  }},
-  "sustainability": {{
-    "score": 0-100,
-    "comment": "長期的に持続可能か、将来世代にツケを回さないか"
-  }},
-  "innovation": {{
-    "score": 0-100,
-    "comment": "新しい発想やアプローチか、従来の方法を超える可能性があるか"
-  }},
-  "reasoning": "総合評価の理由（あなたの立場と価値観からの率直な意見）",
-  "improvement_suggestions": "改善提案"
-}}
-
-評価のポイント:
-- personal_impact: あなたの生活が良くなる/悪くなる度合い
-- feasibility: あなたの常識や経験から見て「本当にできそう」と思えるか
-- cost_effectiveness: 税金の使い道として納得できるか
-- coverage: あなたと同じような立場の人、それ以外の人も助かるか
-- fairness: あなたから見て「不公平だ」と感じないか
-- risks: あなたやあなたの大切な人に悪影響がないか
-- sustainability: 一時的なものでなく、続けられそうか
-- innovation: 今までと違う新しい試みとして評価できるか
+上記の人物として、システムプロンプトの政策案を評価してください。
 """
 
-    result = agent(prompt)
-    if isinstance(result.message, dict):
-        return result.message['content'][0]['text']
-    return result.message
-
-@tool
-def evaluate_policy_citizen3(policy_text: str) -> str:
-    """市民エージェント3による評価"""
-    global citizen_agents_config
+def shared_system_prompt(text):
+    """複数の呼び出しで共通のシステムプロンプト（末尾にキャッシュポイントを置き、2件目以降はキャッシュから読み込ませる）"""
+    if not PROMPT_CACHE_ENABLED:
+        return text
+    return [{"text": text}, {"cachePoint": {"type": "default"}}]
 
-    agent_config = citizen_agents_config.get("citizen_agent_3", {})
+async def evaluate_as_citizen(ctx, agent_config, policy_text, first_chunk=None):
+    """設定済みの市民エージェント1名で政策案を評価し、評価結果のテキストを返す"""
     agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model=ctx.models.model_for("citizen"),
+        system_prompt=shared_system_prompt(citizen_evaluation_prompt(policy_text))
     )
-
     system_prompt = agent_config.get("system_prompt", "政策を評価してください。")
+    return await ask(ctx, agent, citizen_persona_prompt(system_prompt), step="citizen_panel", first_chunk=first_chunk)
+
+async def evaluate_panel(ctx, policy_text):
+    """設定済みの全市民エージェントによる評価（並行実行し、全員分の評価をまとめて返す）"""
+    members = sorted(ctx.citizen_agents_config.items(), key=lambda item: citizen_number(item[0]))
+    if not members:
+        return json.dumps({"error": "市民エージェントが設定されていません。先に setup_citizen_agents を実行してください"}, ensure_ascii=False)
+
+    slots = asyncio.Semaphore(PANEL_MAX_CONCURRENCY)
+    # 共通のシステムプロンプトのキャッシュが書き込まれるまで（最初の1名が応答を返し始めるまで）残りを待たせる
+    primed = asyncio.Event()
+    if not PROMPT_CACHE_ENABLED:
+        primed.set()
+    before = dict(ctx.step_usage.get("citizen_panel", {}))
+
+    async def evaluate(number, member):
+        key, agent_config = member
+        entry = {"citizen_agent": key, "name": agent_config.get("name", key)}
+        try:
+            if number > 0:
+                await primed.wait()
+            async with slots:
+                entry["evaluation"] = await evaluate_as_citizen(ctx, agent_config, policy_text, first_chunk=primed if number == 0 else None)
+        except Exception as e:
+            entry["error"] = str(e)
+        finally:
+            primed.set()
+        return entry
+
+    # 同時実行数の上限を設けて全員分を並行に評価する（結果は市民エージェントの番号順）
+    evaluations = await asyncio.gather(*(evaluate(number, member) for number, member in enumerate(members)))
+    after = ctx.step_usage.get("citizen_panel", {})
+    ctx.emit(cache_metrics_event("citizen_panel", usage_summary(
+        {key: after.get(key, 0) - before.get(key, 0) for key in after}
+    )))
+
+    return json.dumps({"evaluations": evaluations}, ensure_ascii=False)
+
+@tool(context=True)
+async def evaluate_policy_panel(policy_text: str, tool_context: ToolContext) -> str:
+    """設定済みの全市民エージェントによる評価（並行実行）。policy_text には政策案のハンドルを指定し、全員分の評価のハンドルを返す"""
+    async with tool_slot(tool_context) as ctx:
+        evaluations = await evaluate_panel(ctx, ctx.resolve(policy_text))
+    handle = ctx.put_artifact("evaluations", evaluations)
+    members = json.loads(evaluations).get("evaluations", [])
+    return json.dumps({
+        "evaluations": handle,
+        "evaluated": [member["name"] for member in members if "evaluation" in member],
+        "failed": [member["name"] for member in members if "error" in member],
+    }, ensure_ascii=False)
 
-    prompt = f"""
-{system_prompt}
-
-政策案: {policy_text}
-
-以下の8つの観点で100点満点で評価し、JSON形式で回答してください。
-あなた自身の日常生活、価値観、立場に基づいて率直に評価してください。
-
-{{
-  "personal_impact": {{
-    "score": 0-100,
-    "comment": "この政策があなた自身や家族にどう影響するか（恩恵と負担を総合して）"
-  }},
-  "feasibility": {{
-    "score": 0-100,
-    "comment": "本当に実現できそうか（予算、法制度、実装の難易度）"
-  }},
-  "cost_effectiveness": {{
-    "score": 0-100,
-    "comment": "かかる費用に対して、得られる効果は十分か"
-  }},
-  "coverage": {{
-    "score": 0-100,
-    "comment": "この政策で助かる人はどれくらいいるか、広く恩恵があるか"
-  }},
-  "fairness": {{
-    "score": 0-100,
-    "comment": "特定の人だけが得したり損したりしないか、不公平感はないか"
-  }},
-  "risks": {{
-    "score": 0-100,
-    "comment": "副作用や予期しない悪影響のリスク（高いほど安全）"
-  }},
-  "sustainability": {{
-    "score": 0-100,
-    "comment": "長期的に持続可能か、将来世代にツケを回さないか"
-  }},
-  "innovation": {{
-    "score": 0-100,
-    "comment": "新しい発想やアプローチか、従来の方法を超える可能性があるか"
-  }},
-  "reasoning": "総合評価の理由（あなたの立場と価値観からの率直な意見）",
-  "improvement_suggestions": "改善提案"
-}}
-
-評価のポイント:
-- personal_impact: あなたの生活が良くなる/悪くなる度合い
-- feasibility: あなたの常識や経験から見て「本当にできそう」と思えるか
-- cost_effectiveness: 税金の使い道として納得できるか
-- coverage: あなたと同じような立場の人、それ以外の人も助かるか
-- fairness: あなたから見て「不公平だ」と感じないか
-- risks: あなたやあなたの大切な人に悪影響がないか
-- sustainability: 一時的なものでなく、続けられそうか
-- innovation: 今までと違う新しい試みとして評価できるか
-"""
-
-    result = agent(prompt)
-    if isinstance(result.message, dict):
-        return result.message['content'][0]['text']
-    return result.message
-
-@tool
-def calculate_final_score(eval1: str, eval2: str, eval3: str) -> str:
-    """最終スコア計算"""
+def extract_json_text(text):
+    """JSON抽出（マークダウンのコードブロックに囲まれている場合に対応）"""
+    json_match = re.search(r'```json\s*(\{.*?\})\s*```', text, re.DOTALL)
+    if json_match:
+        return json_match.group(1)
+    elif '```' in text:
+        return text.split('```')[1].replace('json', '').strip()
+    return text
+
+def parse_evaluations(evaluations):
+    """evaluate_policy_panel の結果（または評価のJSON配列）から各市民の評価を取り出す"""
+    data = json.loads(extract_json_text(evaluations)) if isinstance(evaluations, str) else evaluations
+    if isinstance(data, dict):
+        data = data.get("evaluations", [data])
+
+    parsed = []
+    for entry in data:
+        if isinstance(entry, dict) and "evaluation" in entry:
+            entry = entry["evaluation"]
+        elif isinstance(entry, dict) and "error" in entry:
+            # 評価に失敗した市民は集計から除く
+            continue
+        if isinstance(entry, str):
+            entry = json.loads(extract_json_text(entry))
+        parsed.append(entry)
+    return parsed
+
+def score_evaluations(evaluations):
+    """最終スコア計算（evaluate_policy_panel の結果を受け取り、評価した市民全員で平均する）"""
     try:
-        # JSON抽出（マークダウンのコードブロックに囲まれている場合に対応）
-        import re
-
-        def extract_json(text):
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', text, re.DOTALL)
-            if json_match:
-                return json_match.group(1)
-            elif '```' in text:
-                return text.split('```')[1].replace('json', '').strip()
-            return text
-
-        evaluations = [
-            json.loads(extract_json(eval1)),
-            json.loads(extract_json(eval2)),
-            json.loads(extract_json(eval3))
-        ]
+        evaluations = parse_evaluations(evaluations)
+        if not evaluations:
+            raise ValueError("有効な評価がありません")
 
         total_weighted_score = 0
         improvement_points = []
@@ -677,8 +1010,8 @@ def calculate_final_score(eval1: str, eval2: str, eval3: str) -> str:
             total_weighted_score += weighted_score
             improvement_points.append(evaluation.get("improvement_suggestions", ""))
 
-        # 3人の単純平均
-        average_score = total_weighted_score / 3
+        # 評価した市民の単純平均
+        average_score = total_weighted_score / len(evaluations)
 
         # 承認判定
         if average_score >= 70:
@@ -696,22 +1029,31 @@ def calculate_final_score(eval1: str, eval2: str, eval3: str) -> str:
             "status": status,
             "approved": average_score >= 70,
             "needs_improvement": needs_improvement,
+            "evaluator_count": len(evaluations),
             "improvement_points": improvement_points
         }, ensure_ascii=False)
 
     except Exception as e:
         return json.dumps({"error": str(e)}, ensure_ascii=False)
 
-@tool
-def improve_policy(current_policy: str, improvement_points: str) -> str:
-    """政策改善ツール（ブロードリスニング分析結果を考慮）"""
-    global policy_agent_config, broadlistening_analysis
-    
+@tool(context=True)
+async def calculate_final_score(evaluations: str, tool_context: ToolContext) -> str:
+    """最終スコア計算（evaluations には評価のハンドルを指定し、評価した市民全員で平均する）。改善提案はハンドルで返す"""
+    async with tool_slot(tool_context) as ctx:
+        score = json.loads(score_evaluations(ctx.resolve(evaluations)))
+        if "improvement_points" in score:
+            score["improvement_points"] = ctx.put_artifact("improvement_points", json.dumps(score["improvement_points"], ensure_ascii=False))
+    return json.dumps(score, ensure_ascii=False)
+
+async def revise_policy(ctx, current_policy, improvement_points):
+    """市民の改善提案を反映した政策案を作成（ブロードリスニング分析結果を考慮）"""
+    broadlistening_analysis = ctx.broadlistening_analysis
+
     policy_agent = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model=ctx.models.model_for("policy")
     )
     
-    system_prompt = policy_agent_config.get("system_prompt", "政策案を作成してください。")
+    system_prompt = ctx.policy_agent_config.get("system_prompt", "政策案を作成してください。")
     
     # ブロードリスニング分析結果を整形
     if broadlistening_analysis:
@@ -738,86 +1080,231 @@ def improve_policy(current_policy: str, improvement_points: str) -> str:
 上記の改善提案を反映し、ブロードリスニング分析結果も考慮して、より良い政策案を作成してください。
 """
     
-    result = policy_agent(prompt)
-    if isinstance(result.message, dict):
-        return result.message['content'][0]['text']
-    return result.message
+    return await ask(ctx, policy_agent, prompt, step="policy_revision")
 
-@app.entrypoint
-def invoke(payload):
-    """マルチエージェント政策システム（個別エージェント対応）"""
-    user_message = payload.get("prompt", "")
-    
-    if not user_message:
-        return {"error": "プロンプトが必要です"}
-    
-    # ブロードリスニングデータのサンプル（実際の実装では外部システムから取得）
-    sample_broadlistening_data = json.dumps({
-        "query": f"{user_message} lang:ja",
-        "collection_window": {
-            "from": "2025-09-15T00:00:00Z",
-            "to": "2025-10-02T00:00:00Z",
-            "timezone": "Asia/Tokyo"
-        },
-        "meta": {
-            "language": "ja",
-            "total_collected": 480,
-            "filtered_count": 300
-        },
-        "samples": [
-            "保育園の待機児童がまだ解消されていない。もっと枠を増やしてほしい。",
-            "子育て支援の給付申請が分かりづらい。オンライン申請の手順を簡単にしてほしい。",
-            "学童の定員が足りず、仕事を早退せざるを得ない。放課後の受け皿を増やしてほしい。",
-            "交通費負担が大きい。通学や通園の補助があると助かる。"
-        ]
-    }, ensure_ascii=False)
-    
+@tool(context=True)
+async def improve_policy(current_policy: str, improvement_points: str, tool_context: ToolContext) -> str:
+    """政策改善ツール（ブロードリスニング分析結果を考慮）。政策案・改善提案はハンドルで指定し、改善後の政策案のハンドルと要約を返す"""
+    async with tool_slot(tool_context) as ctx:
+        policy_text = await revise_policy(ctx, ctx.resolve(current_policy), ctx.resolve(improvement_points))
+    return policy_tool_result(ctx.put_artifact("policy", policy_text), policy_text)
+
+async def run_supervised(user_message, ctx):
+    """監督エージェント（LLM）がツールの呼び出し順を判断して政策検討を行い、最終報告を返す"""
     # 監督エージェント
     supervisor = Agent(
-        model="us.anthropic.claude-sonnet-4-20250514-v1:0",
+        model=ctx.models.model_for("supervisor"),
         tools=[
             generate_broadlistening_collection_mock,
             analyze_broadlistening_results,
             setup_policy_agent, 
             setup_citizen_agents, 
             create_policy, 
-            evaluate_policy_citizen1, 
-            evaluate_policy_citizen2, 
-            evaluate_policy_citizen3, 
+            evaluate_policy_panel,
             calculate_final_score,
             improve_policy
-        ]
+        ],
+        # 同じターンで呼び出された独立したツール（エージェント設定など）は並行に実行する
+        # 同時実行数は RunContext の tool_slots（TOOL_MAX_CONCURRENCY）で制限する
+        tool_executor=ConcurrentToolExecutor()
     )
     
+    report_outline = "\n".join(f"## {heading}\n（{content}）" for heading, content in REPORT_SECTIONS)
     supervisor_prompt = f"""
 市民意見「{user_message}」に対して、以下の手順で政策検討を行ってください：
 
 1. generate_broadlistening_collection_mock ツールでブロードリスニング用の疑似SNSデータを生成（引数: citizen_opinion="{user_message}"）
-2. 1の結果JSON文字列を broadlistening_data として analyze_broadlistening_resultsツールでブロードリスニング結果を分析（引数: citizen_opinion="{user_message}", broadlistening_data=**ステップ1で得たbl_dataをそのまま**）
+2. analyze_broadlistening_resultsツールでブロードリスニング結果を分析（引数: citizen_opinion="{user_message}", broadlistening_data=**ステップ1で得たハンドル（artifact://bl/...）**）
 3. setup_policy_agentツールで政策作成エージェントを設定
-4. setup_citizen_agentsツールで3つの市民エージェントを設定
+4. setup_citizen_agentsツールで{ctx.citizen_count}人の市民エージェントを設定（3と4は互いに独立しているため、同じターンで同時に呼び出してください）
 5. 最大3回まで繰り返し：
-   a) create_policyツールで政策案を作成（市民意見とブロードリスニング分析結果を考慮）
-   b) evaluate_policy_citizen1, evaluate_policy_citizen2, evaluate_policy_citizen3ツールで各市民エージェントの評価を取得
-   c) calculate_final_scoreツールで最終スコアを計算
-   d) 70点以上なら承認で終了、未満ならimprove_policyツールで改善して次のループへ
+   a) create_policyツールで政策案を作成（市民意見とブロードリスニング分析結果を考慮）。2回目以降はdで改善した政策案を使う
+   b) evaluate_policy_panelツールで全市民エージェントの評価を1回で取得（引数: policy_text=**政策案のハンドル（artifact://policy/...）**）
+   c) calculate_final_scoreツールで最終スコアを計算（引数: evaluations=**bで得たハンドル（artifact://evaluations/...）**）
+   d) 70点以上なら承認で終了、未満ならimprove_policyツールで改善して次のループへ（引数: current_policy=政策案のハンドル, improvement_points=**cで得たハンドル（artifact://improvement_points/...）**）
+
+ツール間の大きなデータは artifact://種類/番号 のハンドルで受け渡されます。ハンドルは本文に展開せず、そのまま引数に指定してください。
 
 承認基準:
 - 70点以上: 承認
 - 50-69点: 改善ループ（最大3回まで）
 - 50点未満: 廃案
 
-最終的に結果をまとめて報告してください。ブロードリスニング分析結果がどのように政策に反映されたかも含めてください。
+最終的に結果を次の見出しの順にまとめて報告してください（見出しの文言は変えず、括弧内の内容を書いてください）。
+# {REPORT_TITLE}
+{report_outline}
 """
     
-    result = supervisor(supervisor_prompt)
+    # 監督エージェントはツール実行（エージェント設定の更新）を伴うためキャッシュしない
+    # ツールが読み書きする状態はこの実行専用の RunContext に閉じ込める
+    result = await supervisor.invoke_async(supervisor_prompt, invocation_state={"run_context": ctx})
+    ctx.add_usage("supervisor", result.metrics.accumulated_usage)
     
     if isinstance(result.message, dict):
         response_text = result.message['content'][0]['text']
     else:
         response_text = result.message
     
-    return {"result": response_text}
+    return ctx.expand_artifacts(response_text)
+
+async def run_orchestrated(user_message, ctx):
+    """監督エージェントを使わず、run_supervised と同じ手順をコードで直接実行し、最終報告を返す
+
+    手順: ブロードリスニング → エージェント設定 → 政策案作成・評価・採点・改善のループ（最大 MAX_POLICY_LOOPS 回）
+    """
+    bl_data = await collect_broadlistening(ctx, user_message)
+    await analyze_broadlistening(ctx, user_message, bl_data)
+
+    # 政策作成エージェントと市民エージェントの設定は互いに独立しているため並行に行う
+    await asyncio.gather(
+        configure_policy_agent(ctx, user_message),
+        configure_citizen_agents(ctx, user_message),
+    )
+
+    policy_text = await draft_policy(ctx, user_message)
+    rounds = []
+    for loop in range(1, MAX_POLICY_LOOPS + 1):
+        evaluations = await evaluate_panel(ctx, policy_text)
+        score = json.loads(score_evaluations(evaluations))
+        rounds.append({"loop": loop, "policy": policy_text, "score": score})
+
+        # 70点以上は承認、50点未満は廃案、スコア計算に失敗した場合もそこで終了
+        if "error" in score or not score["needs_improvement"] or loop == MAX_POLICY_LOOPS:
+            break
+        policy_text = await revise_policy(ctx, policy_text, json.dumps(score["improvement_points"], ensure_ascii=False))
+
+    return build_report(user_message, ctx, rounds)
+
+def build_report(user_message, ctx, rounds):
+    """オーケストレーターの実行結果から最終報告を作成（見出しは監督エージェントと同じ REPORT_SECTIONS）"""
+    analysis = ctx.broadlistening_analysis
+    sentiment = analysis.get("sentiment_analysis", {})
+    final = rounds[-1]
+    final_score = final["score"]
+
+    members = [f"- 政策作成エージェント: {ctx.policy_agent_config.get('role', '不明')}（{ctx.policy_agent_config.get('specialty', '')}）"]
+    for key, config in sorted(ctx.citizen_agents_config.items(), key=lambda item: citizen_number(item[0])):
+        members.append(f"- 市民エージェント: {config.get('name', key)}（{config.get('stake_in_policy', '')}）")
+
+    progress = []
+    for round_ in rounds:
+        score = round_["score"]
+        if "error" in score:
+            progress.append(f"- {round_['loop']}回目: スコア計算エラー（{score['error']}）")
+        else:
+            progress.append(f"- {round_['loop']}回目: {score['average_weighted_score']}点（{score['status']}、評価者{score['evaluator_count']}名）")
+
+    if "error" in final_score:
+        verdict = "判定不能（スコア計算エラー）"
+        points = []
+    else:
+        status = final_score["status"]
+        if status == "改善ループ":
+            status = f"未承認（{MAX_POLICY_LOOPS}回の検討で70点に届かず）"
+        verdict = f"{status}: {final_score['average_weighted_score']}点"
+        points = [p for p in final_score.get("improvement_points", []) if p]
+
+    sections = {
+        "市民意見": [user_message],
+        "ブロードリスニング分析": [
+            f"- 主要テーマ: {', '.join(analysis.get('main_themes', []))}",
+            f"- 市民感情: 肯定的{sentiment.get('positive_ratio', 0)*100:.1f}%, 否定的{sentiment.get('negative_ratio', 0)*100:.1f}%",
+            f"- 優先課題: {', '.join(issue.get('issue', '') for issue in analysis.get('priority_issues', []))}",
+        ],
+        "検討体制": members,
+        "検討経過": progress,
+        "最終判定": [verdict],
+        "市民からの改善提案": [f"- {p}" for p in points] or ["なし"],
+        "ブロードリスニング分析結果の反映": [
+            "政策案の作成・改善の各段階で、上記の主要テーマ・優先課題・政策提案を前提条件として政策作成エージェントに与えています。"
+        ],
+        "最終政策案": [final["policy"]],
+    }
+    lines = [f"# {REPORT_TITLE}"]
+    for heading, _ in REPORT_SECTIONS:
+        lines += ["", f"## {heading}", *sections[heading]]
+    return "\n".join(lines)
+
+async def run_measured(mode, user_message, ctx):
+    """実行全体の所要時間とトークン数を計測し、終了時に metrics イベントを通知する"""
+    run = run_orchestrated if mode == "orchestrated" else run_supervised
+    timer = CallTimer(mode, kind="entrypoint", sinks=(ctx.telemetry,))
+    error = None
+    try:
+        return await run(user_message, ctx)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        for usage in ctx.usage.values():
+            timer.add_usage(usage)
+        ctx.emit(metrics_event(timer.finish(error=error)))
+
+async def stream_run(run):
+    """実行中の進捗イベントを順に返し、最後に最終報告を complete イベント（失敗時は error イベント）で返す
+
+    run は RunContext.events を設定した後に開始したタスク。
+    """
+    ctx, task = run
+    getter = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(ctx.events.get())
+            done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            break
+        while not ctx.events.empty():
+            yield ctx.events.get_nowait()
+        yield {"type": "complete", "data": task.result()}
+    except Exception as e:
+        yield {"type": "error", "data": str(e)}
+    finally:
+        # クライアントが切断した場合は実行も止める
+        if getter is not None:
+            getter.cancel()
+        task.cancel()
+
+@app.entrypoint
+async def invoke(payload):
+    """マルチエージェント政策システム（個別エージェント対応）"""
+    user_message = payload.get("prompt", "")
+    
+    if not user_message:
+        return {"error": "プロンプトが必要です"}
+
+    citizen_count = int(payload.get("citizen_count", DEFAULT_CITIZEN_COUNT))
+
+    # ブロードリスニングの収集元（例: {"path": "posts.jsonl", "query": "保育園 OR 待機児童 lang:ja",
+    #   "collection_window": {"from": "2025-09-01T00:00:00+09:00", "to": "2025-10-01T00:00:00+09:00"}}）
+    # query を省略した場合は市民意見から作成し、collection_window を省略した場合は直近30日間
+    # path は BROADLISTENING_CORPUS_ROOTS の中だけ、sample_size は 1〜BROADLISTENING_MAX_SAMPLE_SIZE を指定できる
+    try:
+        broadlistening_source = broadlistening_source_from(payload)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    # ステップごとのモデル割り当ての上書き（例: {"citizen": "fast", "supervisor": "standard"}）
+    try:
+        models = default_registry.with_request_overrides(payload.get("models"))
+    except ValueError as e:
+        return {"error": str(e)}
+
+    ctx = RunContext(citizen_count, broadlistening_source, models)
+    mode = "orchestrated" if payload.get("mode", DEFAULT_MODE) == "orchestrated" else "supervisor"
+    # モデル呼び出しの再試行・ヘッジの回数（model_resilience）もこの実行の計測値に加算する
+    # （ensure_future で作るタスクは現在のコンテキストを引き継ぐ）
+    counter_sinks.set((ctx.telemetry,))
+
+    # stream を指定した場合は進捗イベント（{"type": "status" / "progress" / "metrics" / "cache_metrics", ...}）を順に返し、
+    # 最後に {"type": "complete", "data": 最終報告} を返す（AgentCoreがSSEで配信する）
+    if payload.get("stream"):
+        ctx.events = asyncio.Queue()
+        return stream_run((ctx, asyncio.ensure_future(run_measured(mode, user_message, ctx))))
+    # metrics はこの実行のツール・モデル呼び出しごとの計測値の集計
+    return {"result": await run_measured(mode, user_message, ctx), "metrics": ctx.telemetry.snapshot()}
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# 偽モデル（fake_model.py）で実行する。応答キャッシュ・カセット・コーパスは使わない
+os.environ["MODEL_DEFAULT"] = "fake:ttft_ms=5,tokens_per_sec=20000"
+os.environ["LLM_CACHE_ENABLED"] = "0"
+for key in ("MODEL_CASSETTE", "MODEL_ROUTING_FILE", "BROADLISTENING_CORPUS", "BROADLISTENING_CORPUS_ROOTS"):
+    os.environ.pop(key, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
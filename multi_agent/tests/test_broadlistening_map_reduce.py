@@ -0,0 +1,56 @@
+import asyncio
+import json
+import os
+import random
+
+import multi_agent_app
+
+# 近似重複として除かれないよう、テーマの語と無作為なひらがなを組み合わせた投稿にする
+WORDS = ["待機児童", "延長保育", "送迎", "保育士", "給食", "園庭", "申請", "入園", "病児保育", "一時預かり"]
+KANA = [chr(code) for code in range(ord("ぁ"), ord("ゖ"))]
+
+def write_corpus(path, posts):
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(posts):
+            text = f"保育園の{rng.choice(WORDS)}について" + "".join(rng.choices(KANA, k=40))
+            f.write(json.dumps({"text": text, "lang": "ja", "created_at": "2025-09-10T12:00:00+09:00"}, ensure_ascii=False) + "\n")
+
+def test_large_sample_is_analyzed_by_map_reduce(monkeypatch, tmp_path):
+    write_corpus(tmp_path / "posts.jsonl", 2500)
+    monkeypatch.setattr(multi_agent_app, "BROADLISTENING_CORPUS_ROOTS", [os.path.realpath(tmp_path)])
+    contexts = []
+
+    class RecordingRunContext(multi_agent_app.RunContext):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            contexts.append(self)
+
+    monkeypatch.setattr(multi_agent_app, "RunContext", RecordingRunContext)
+
+    async def main():
+        stream = await multi_agent_app.invoke({
+            "prompt": "保育園の待機児童を減らしてほしい",
+            "mode": "orchestrated",
+            "stream": True,
+            "citizen_count": 2,
+            "broadlistening": {
+                "path": "posts.jsonl",
+                "query": "保育園 lang:ja",
+                "collection_window": {"from": "2025-09-01T00:00:00+09:00", "to": "2025-10-01T00:00:00+09:00"},
+                "sample_size": 2500,
+            },
+        })
+        return [event async for event in stream]
+
+    events = asyncio.run(main())
+    assert events[-1]["type"] == "complete", events[-1]
+
+    # 既定のシャードの大きさ（収集件数の既定）を超えて収集した投稿は、シャードごとに分析してから統合する
+    assert multi_agent_app.BROADLISTENING_SHARD_SIZE == multi_agent_app.DEFAULT_SAMPLE_SIZE
+    shards = [event["data"] for event in events if event.get("step") == "broadlistening_map"]
+    merges = [event["data"] for event in events if event.get("step") == "broadlistening_reduce"]
+    assert len(shards) == 3 and {shard["total"] for shard in shards} == {3}
+    assert not any(shard["failed"] for shard in shards)
+    assert merges and not any(merge["failed"] for merge in merges)
+    assert contexts[0].broadlistening_analysis.get("main_themes") not in (None, ["一般的な課題"])
@@ -0,0 +1,33 @@
+import asyncio
+import re
+
+import multi_agent_app
+
+PROMPT = "駅前の駐輪場を増やしてほしい"
+
+def report_headings(report):
+    """最終報告の見出し（最終政策案の見出しまで。政策案の本文の見出しは含めない）"""
+    headings = []
+    for heading in re.findall(r"^(#{1,2} .+)$", report, re.M):
+        headings.append(heading)
+        if heading == f"## {multi_agent_app.REPORT_SECTIONS[-1][0]}":
+            break
+    return headings
+
+def run_report(mode):
+    async def main():
+        result = await multi_agent_app.invoke({"prompt": PROMPT, "mode": mode, "citizen_count": 3})
+        return result["result"]
+
+    return asyncio.run(main())
+
+def test_orchestrated_report_has_the_supervisor_structure():
+    expected = [f"# {multi_agent_app.REPORT_TITLE}"] + [f"## {heading}" for heading, _ in multi_agent_app.REPORT_SECTIONS]
+    supervised = run_report("supervisor")
+    orchestrated = run_report("orchestrated")
+    assert report_headings(supervised) == expected
+    assert report_headings(orchestrated) == expected
+    # どちらも最終政策案の見出しの後に政策案の本文が展開されている
+    for report in (supervised, orchestrated):
+        assert "artifact://" not in report
+        assert "【政策サマリー】" in report.split(expected[-1], 1)[1]
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+
+import multi_agent_app
+
+RUNS = 8
+PROMPTS = [f"第{number}地区の公園に照明を増やしてほしい" for number in range(1, RUNS + 1)]
+
+def run_concurrently(monkeypatch, mode):
+    """PROMPTS を同時に invoke し、実行ごとの (RunContext, イベントのリスト) を返す"""
+    contexts = {}
+
+    class RecordingRunContext(multi_agent_app.RunContext):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            contexts[asyncio.current_task()] = self
+
+    monkeypatch.setattr(multi_agent_app, "RunContext", RecordingRunContext)
+
+    async def run(number, prompt):
+        # 実行ごとに市民エージェントの人数を変え、評価・採点が他の実行と混ざらないことも確かめる
+        stream = await multi_agent_app.invoke({"prompt": prompt, "mode": mode, "stream": True, "citizen_count": 2 + number % 3})
+        ctx = contexts[asyncio.current_task()]
+        return ctx, [event async for event in stream]
+
+    async def main():
+        return await asyncio.gather(*(run(number, prompt) for number, prompt in enumerate(PROMPTS)))
+
+    return asyncio.run(main())
+
+def other_prompts(prompt):
+    return [other for other in PROMPTS if other != prompt]
+
+@pytest.mark.parametrize("mode", ["orchestrated", "supervisor"])
+def test_concurrent_runs_do_not_share_state(monkeypatch, mode):
+    results = run_concurrently(monkeypatch, mode)
+
+    assert len({id(ctx) for ctx, _ in results}) == RUNS
+    for number, (prompt, (ctx, events)) in enumerate(zip(PROMPTS, results)):
+        assert events[-1]["type"] == "complete", events[-1]
+        report = events[-1]["data"]
+        assert prompt in report
+
+        # 途中のイベント・保存したデータ・最終報告に他の実行の市民意見が現れない
+        text = json.dumps({"events": events, "artifacts": ctx.artifacts}, ensure_ascii=False)
+        for other in other_prompts(prompt):
+            assert other not in text
+
+        # エージェント設定・採点はこの実行の市民エージェントの人数どおり（最終報告の形式が決まっているのは orchestrated のみ）
+        citizen_count = 2 + number % 3
+        assert len(ctx.citizen_agents_config) == citizen_count
+        if mode == "orchestrated":
+            assert f"評価者{citizen_count}名" in report
+
+        # 計測値はこの実行の分だけ（実行全体の計測は1件）
+        metrics = ctx.telemetry.snapshot()
+        assert metrics["entrypoint"][mode]["count"] == 1
+        assert sum(1 for event in events if event["type"] == "metrics" and event["data"].get("kind") == "entrypoint") == 1
+        # metrics は1回の処理の計測値だけで、ステップの使用量の集計は cache_metrics で返す
+        assert all("kind" in event["data"] for event in events if event["type"] == "metrics")
+        panel = [event for event in events if event["type"] == "cache_metrics"]
+        assert panel and all(event["step"] == "citizen_panel" and "cache_hit_ratio" in event["data"] for event in panel)
@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Flask_Streaming"))
+
+import run_store
+from run_store import RunStore
+
+def test_write_failure_fails_only_the_affected_run(tmp_path):
+    store = RunStore(str(tmp_path / "runs.db"), poll_interval=30.0)
+    broken = store.create_run("broken")
+    healthy = store.create_run("healthy")
+    # 2番目のイベントが主キー重複で書き込めないよう、同じ連番を先に入れておく
+    with store._lock:
+        store._db.execute("INSERT INTO run_events (run_id, seq, event) VALUES (?, 2, '{}')", (broken,))
+        store._db.commit()
+
+    batches = []
+    follower = threading.Thread(target=lambda: batches.extend(store.follow(broken)))
+    follower.start()
+
+    store.append(broken, {"type": "step", "data": 1})
+    store.append(broken, {"type": "step", "data": 2})
+    store.append(healthy, {"type": "step", "data": 1})
+    store.append(healthy, {"type": "step", "data": 2})
+    store.finish(healthy, run_store.COMPLETED)
+    store.finish(broken, run_store.COMPLETED)
+    store.flush()
+
+    # poll_interval を待たずに通知で追従が終わる
+    follower.join(timeout=5)
+    assert not follower.is_alive()
+    assert store.get_run(broken)["status"] == run_store.FAILED
+    events = [event for _, event in store.events_after(broken, 0)]
+    assert events[-1] == {"type": "error", "data": run_store.WRITE_ERROR}
+    assert events[-1] in [event for batch in batches for _, event in batch]
+
+    assert store.get_run(healthy)["status"] == run_store.COMPLETED
+    assert [event["data"] for _, event in store.events_after(healthy, 0)] == [1, 2]
+    assert store._seqs == {}
+
+def test_followers_are_capped(tmp_path):
+    store = RunStore(str(tmp_path / "runs.db"), max_followers=2)
+    assert store.acquire_follower()
+    assert store.acquire_follower()
+    assert not store.acquire_follower()
+    store.release_follower()
+    assert store.acquire_follower()
+
+def test_commit_wakes_only_followers_of_the_written_run(tmp_path):
+    store = RunStore(str(tmp_path / "runs.db"), poll_interval=30.0)
+    followed = store.create_run("followed")
+    other = store.create_run("other")
+    follower = threading.Thread(target=lambda: list(store.follow(followed)))
+    follower.start()
+    while followed not in store._waiters:
+        follower.join(timeout=0.01)
+    assert set(store._waiters) == {followed}
+
+    store.append(other, {"type": "step", "data": 1})
+    store.finish(other, run_store.COMPLETED)
+    store.flush()
+    follower.join(timeout=0.2)
+    assert follower.is_alive()
+
+    store.finish(followed, run_store.COMPLETED)
+    follower.join(timeout=5)
+    assert not follower.is_alive()
+    assert store._waiters == {}
@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "tools"))
+
+import sync_shared_modules
+
+def test_shared_module_copies_match_multi_agent():
+    # 異なる場合は python tools/sync_shared_modules.py で multi_agent/ の版をコピーする
+    assert sync_shared_modules.differing() == []
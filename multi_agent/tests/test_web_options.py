@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Flask_Streaming"))
+os.environ.setdefault("RUN_STORE_DB", os.path.join(tempfile.mkdtemp(), "runs.db"))
+
+import web_app
+
+def test_int_options_are_parsed_and_clamped():
+    options = web_app.pipeline_options({"max_concurrency": "3", "batch_size": 10 ** 6, "evaluation_mode": "batched"})
+    assert options == {
+        "max_concurrency": 3,
+        "batch_size": web_app.INT_OPTION_LIMITS["batch_size"],
+        "evaluation_mode": "batched",
+    }
+
+@pytest.mark.parametrize("body", [
+    {"max_concurrency": 0},
+    {"max_concurrency": -1},
+    {"max_concurrency": "abc"},
+    {"max_concurrency": 2.5},
+    {"max_concurrency": True},
+    {"batch_size": [5]},
+    {"evaluation_mode": "all"},
+])
+def test_invalid_options_are_rejected_before_the_run_starts(body):
+    response = web_app.app.test_client().post("/api/evaluate", json={"prompt": "保育園を増やしてほしい", **body})
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -0,0 +1,55 @@
+"""デプロイ単位ごとに配置している共通モジュールの同期
+
+agentcore/, multi_agent/, multi_agent/Flask_Streaming/ はそれぞれ単独でデプロイするため、共通モジュールを各ディレクトリに
+同一内容で配置している。multi_agent/ の版を正とし、このスクリプトで他のディレクトリへコピーする。
+
+    python tools/sync_shared_modules.py          # multi_agent/ の版を他のディレクトリへコピー
+    python tools/sync_shared_modules.py --check  # 内容が異なるファイルを表示し、あれば終了コード 1
+"""
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIR = "multi_agent"
+TARGET_DIRS = ("agentcore", os.path.join("multi_agent", "Flask_Streaming"))
+SHARED_MODULES = (
+    "fake_model.py",
+    "llm_cache.py",
+    "model_cassette.py",
+    "model_registry.py",
+    "model_resilience.py",
+    "telemetry.py",
+)
+
+def copies():
+    """(正の版のパス, コピー先のパス) の一覧"""
+    return [
+        (os.path.join(ROOT, SOURCE_DIR, name), os.path.join(ROOT, target, name))
+        for target in TARGET_DIRS for name in SHARED_MODULES
+    ]
+
+def differing():
+    """正の版と内容が異なる（または存在しない）コピー先のパス"""
+    return [target for source, target in copies() if not os.path.exists(target) or not filecmp.cmp(source, target, shallow=False)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="コピーせずに差分の有無だけを確認する")
+    args = parser.parse_args()
+
+    targets = differing()
+    if args.check:
+        for target in targets:
+            print(f"{os.path.relpath(target, ROOT)} が {SOURCE_DIR}/ の版と異なります")
+        return 1 if targets else 0
+    for source, target in copies():
+        if target in targets:
+            shutil.copyfile(source, target)
+            print(f"{os.path.relpath(target, ROOT)} を更新しました")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())